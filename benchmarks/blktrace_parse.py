@@ -0,0 +1,101 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import random
+import asyncio
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from hint_sources import (BinaryBlockTraceSource, decode_blk_io_traces, BLK_IO_TRACE, BLK_IO_TRACE_MAGIC,
+                          BLK_IO_TRACE_VERSION, BLK_TA_ISSUE, BLK_TC_SHIFT, BLK_TC_WRITE, BLK_TC_NOTIFY, BLK_TC_DISCARD)
+from trace_records import BlockRecord
+
+DEFAULT_EVENT_COUNT = 200000
+SEED = 42
+BLK_TA_COMPLETE = 8
+BLK_TC_READ = 1 << BLK_TC_SHIFT
+# blkparse's RWBS column for each kind of generated request
+RWBS = {BLK_TC_READ: 'R', BLK_TC_WRITE: 'W', BLK_TC_DISCARD: 'D'}
+
+def generate_events(rng, event_count):
+    """
+    Generate binary blktrace events, as blktrace -a issue -o - writes them: mostly issue events, and every now and
+    then a notify event with a payload.
+
+    Returns the events, and the text blkparse -f "%p,%S,%N,%d\\n" would have printed for the issue events
+    """
+    magic = BLK_IO_TRACE_MAGIC | BLK_IO_TRACE_VERSION
+    events = bytearray()
+    lines = []
+    for sequence in range(event_count):
+        if sequence % 100 == 0:
+            payload = b'kworker/u8:1\0'
+            events += BLK_IO_TRACE.pack(magic, sequence, sequence * 1000, 0, 0, BLK_TC_NOTIFY, 100, 0x800010, 0, 0,
+                                        len(payload))
+            events += payload
+            continue
+        pid = rng.randrange(1000, 1100)
+        sector = rng.randrange(1 << 24) * 8
+        size = rng.choice([4096, 8192, 65536])
+        category = rng.choice([BLK_TC_READ, BLK_TC_WRITE, BLK_TC_WRITE, BLK_TC_DISCARD])
+        # blktrace -a issue only asks for issue events, throw in a few others to check they're filtered
+        action = (BLK_TA_COMPLETE if sequence % 50 == 1 else BLK_TA_ISSUE) | category
+        events += BLK_IO_TRACE.pack(magic, sequence, sequence * 1000, sector, size, action, pid, 0x800010, 0, 0, 0)
+        if action & 0xffff == BLK_TA_ISSUE:
+            lines.append(f"{pid},{sector},{size},{RWBS[category]}\n".encode())
+    return bytes(events), b''.join(lines)
+
+def parse_text(text):
+    """
+    BlockTraceSource's blkparse line parsing
+    """
+    records = []
+    for line in text.splitlines():
+        pid, offset, size, op = line.strip().split(b",")
+        op = op.decode()
+        records.append(BlockRecord(int(pid), int(offset), int(size), op[0] in ['W', 'D']))
+    return records
+
+async def parse_binary(trace_path):
+    source = BinaryBlockTraceSource(None, input_path=trace_path)
+    queue = asyncio.Queue()
+    await source.async_read_into(queue)
+    return [queue.get_nowait() for i in range(queue.qsize())]
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def benchmark(trace_path, text=None):
+    with open(trace_path, 'rb') as trace_file:
+        events = trace_file.read()
+    (records, consumed), elapsed = timed(decode_blk_io_traces, events)
+    count = max(len(records), 1)
+    print(f"binary decode: {len(records)} issue events in {elapsed * 1000:.1f}ms ({elapsed / count * 1e6:.2f}us each)")
+    if text is not None:
+        text_records, text_elapsed = timed(parse_text, text)
+        print(f"text parse:    {len(text_records)} issue events in {text_elapsed * 1000:.1f}ms "
+              f"({text_elapsed / count * 1e6:.2f}us each, not counting blkparse itself)")
+        print("records match" if list(records) == text_records else "RECORDS DIFFER")
+    source_records, elapsed = timed(asyncio.run, parse_binary(trace_path))
+    print(f"BinaryBlockTraceSource into a queue: {elapsed / count * 1e6:.2f}us per issue event")
+
+if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+    if not os.path.exists(sys.argv[1]):
+        print(f"Usage: {sys.argv[0]} [EVENT_COUNT | TRACE_FILE]")
+        print(f"Decode EVENT_COUNT generated blktrace events (default: {DEFAULT_EVENT_COUNT}) with the binary and "
+              "text parsers, or decode TRACE_FILE, as saved by blktrace -o -")
+        sys.exit(1)
+    benchmark(sys.argv[1])
+    sys.exit(0)
+
+event_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_EVENT_COUNT
+events, text = generate_events(random.Random(SEED), event_count)
+with tempfile.NamedTemporaryFile() as trace_file:
+    trace_file.write(events)
+    trace_file.flush()
+    benchmark(trace_file.name, text)
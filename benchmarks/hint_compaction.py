@@ -0,0 +1,128 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import random
+import asyncio
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from hint_generator import HintGenerator
+from trace_records import PostCacheRecord, BlockRecord
+from hint_compaction import COMPACTION_WINDOW, HintCompactor
+from hint_handler import HintHandler
+from btier_control import FakeBtierControl
+from tier_manager import BlockInfo
+
+DEFAULT_RECORD_COUNT = 100000
+SEED = 42
+PIDS = 16
+INODES = 64
+FILE_SIZE = 256 * 1024 * 1024
+BLOCK_COUNT = INODES * FILE_SIZE // (1024 * 1024)
+SLOWEST_TIER = 2
+
+def sequential_records(rng, record_count):
+    """
+    Processes each reading a file from start to end, a few writes mixed in
+    """
+    positions = {}
+    for i in range(record_count // 2):
+        pid = rng.randrange(PIDS)
+        inode, offset = positions.get(pid, (rng.randrange(INODES), 0))
+        size = 65536
+        is_write = rng.random() < 0.05
+        yield PostCacheRecord(pid, 8, 16, inode, offset, size, False, is_write)
+        yield BlockRecord(pid, (inode * FILE_SIZE + offset) // 512, size, is_write)
+        positions[pid] = (inode, (offset + size) % FILE_SIZE)
+
+def random_records(rng, record_count):
+    """
+    Processes reading and writing at random offsets
+    """
+    for i in range(record_count // 2):
+        pid = rng.randrange(PIDS)
+        inode = rng.randrange(INODES)
+        offset = rng.randrange(FILE_SIZE // 4096) * 4096
+        is_write = rng.random() < 0.05
+        yield PostCacheRecord(pid, 8, 16, inode, offset, 4096, False, is_write)
+        yield BlockRecord(pid, (inode * FILE_SIZE + offset) // 512, 4096, is_write)
+
+async def run(records, handler, window):
+    """
+    Generate hints for records and pass them through the generator's compaction (if window) to handler. Returns the number of hints that were sent, and of those that were matches.
+    """
+    generator = HintGenerator()
+    sent = 0
+    matches = 0
+
+    async def send(hint):
+        nonlocal sent, matches
+        sent += 1
+        matches += hint.match
+        await receive(hint)
+
+    receive = handler.handle_hint
+    if window:
+        client = HintCompactor(send, window, name='client.compaction')
+        send_hint = client.handle_hint
+    else:
+        send_hint = send
+    for i, record in enumerate(records):
+        record.timestamp = time.time_ns()
+        hint = await generator.handle_trace_record(record)
+        if hint:
+            await send_hint(hint)
+        if i % 64 == 0:
+            # Let the compaction timers fire
+            await asyncio.sleep(0)
+    if window:
+        await client.flush()
+        await asyncio.sleep(window * 2)
+    handler.flush_injections()
+    await handler.workers.wait_for_injections()
+    return sent, matches
+
+def measure(make_records, record_count, window, tmpdir):
+    control = FakeBtierControl(os.path.join(tmpdir, f'tiercontrol-{make_records.__name__}-{window}'))
+    handler = HintHandler(btier_control=control, inject_batch_size=32)
+    # Pretend every block is on the slowest tier, so every prefetched block is a migration
+    handler.block_stats.resize(BLOCK_COUNT)
+    for blocknr in range(BLOCK_COUNT):
+        handler.block_stats.update(blocknr, BlockInfo(SLOWEST_TIER, 0, 0, 0, 0))
+    start = time.perf_counter()
+    sent, matches = asyncio.run(run(make_records(random.Random(SEED), record_count), handler, window))
+    elapsed = time.perf_counter() - start
+    injected = len(control.read_entries())
+    handler.workers.shutdown()
+    control.close()
+    return sent, matches, injected, handler.migration_scheduler.stats.requested, elapsed
+
+def reduction(before, after):
+    return f"{1 - after / before:.1%}" if before else "n/a"
+
+def benchmark(record_count, window):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for make_records in (sequential_records, random_records):
+            name = make_records.__name__.split('_')[0]
+            plain = measure(make_records, record_count, 0, tmpdir)
+            compacted = measure(make_records, record_count, window, tmpdir)
+            for label, (sent, matches, injected, migrations, elapsed) in (('plain', plain), ('compacted', compacted)):
+                print(f"{name:>10} {label:>9}: {sent} hints sent ({matches} matches, {injected} injected), "
+                      f"{migrations} migrations requested, {record_count / elapsed:.0f} records/sec")
+            print(f"{name:>10} reduction: {reduction(plain[0], compacted[0])} of hints sent, "
+                  f"{reduction(plain[3], compacted[3])} of migrations")
+
+try:
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORD_COUNT
+    window = float(sys.argv[2]) if len(sys.argv) > 2 else COMPACTION_WINDOW
+except ValueError:
+    print(f"Usage: {sys.argv[0]} [RECORD_COUNT [WINDOW]]")
+    print(f"Generate and handle hints for RECORD_COUNT (default: {DEFAULT_RECORD_COUNT}) sequential and random trace "
+          f"records, with and without compaction of WINDOW seconds (default: {COMPACTION_WINDOW})")
+    sys.exit(1)
+
+benchmark(record_count, window)
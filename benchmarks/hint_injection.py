@@ -0,0 +1,51 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import asyncio
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from hint_handler import HintHandler
+from hint_types import HINT_NONE, Hint
+from btier_control import FakeBtierControl
+
+DEFAULT_HINT_COUNT = 200000
+BATCH_SIZES = [1, 8, 32, 128]
+
+async def inject(handler, hints):
+    for hint in hints:
+        handler.inject_to_btier(hint)
+    handler.flush_injections()
+    await handler.workers.wait_for_injections()
+
+def run(tmpdir, hints, batch_size, batch_writes):
+    mode = 'write per batch' if batch_writes else 'write per entry'
+    control = FakeBtierControl(os.path.join(tmpdir, f'tiercontrol-{batch_size}-{batch_writes}'), batch_writes)
+    handler = HintHandler(btier_control=control, inject_batch_size=batch_size)
+    start = time.perf_counter()
+    asyncio.run(inject(handler, hints))
+    elapsed = time.perf_counter() - start
+    handler.workers.shutdown()
+    control.close()
+
+    entries = control.read_entries()
+    assert len(entries) == len(hints), f"injected {len(entries)} of {len(hints)} hints"
+    print(f"{mode}, batch size {batch_size:>4}: {len(hints) / elapsed:.0f} hints/sec, "
+          f"{elapsed / len(hints) * 1e6:.2f}us and {control.syscalls / len(hints):.3f} syscalls per hint")
+
+try:
+    hint_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_HINT_COUNT
+except ValueError:
+    print(f"Usage: {sys.argv[0]} [HINT_COUNT]")
+    print(f"Inject HINT_COUNT match hints (default: {DEFAULT_HINT_COUNT}) into a fake btier control device with different batch sizes, with a write per batch and with a write per entry")
+    sys.exit(1)
+
+hints = [Hint(HINT_NONE, i * 8, 4096, match=True) for i in range(hint_count)]
+with tempfile.TemporaryDirectory() as tmpdir:
+    # Writing every entry on its own is what BtierControl falls back to if btier doesn't take batches
+    for batch_writes in (True, False):
+        for batch_size in BATCH_SIZES:
+            run(tmpdir, hints, batch_size, batch_writes)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import asyncio
+import tempfile
+import multiprocessing
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from hint_client import HintClient
+from hint_receiver import TCPHintReceiver, UnixHintReceiver
+from hint_queues import FairFanIn, FairPriorityLanes
+from hint_types import HINT_NONE, HINT_PREFETCH, PATTERN_SEQUENTIAL, ACCESS_WRITE, Hint
+
+DEFAULT_HINT_COUNT = 100000
+HOST = '127.0.0.1'
+PORT = 13370
+# (transport, protocol) pairs to compare
+RUNS = [('tcp', 'json'), ('tcp', 'binary'), ('unix', 'binary'), ('unix', 'shm')]
+# Every pair is run this many times, and the fastest run is reported, to smooth over a busy machine
+REPEAT = 3
+PIDS = 64
+INODES = 100
+
+def make_hint(i, match_every):
+    """
+    A hint like the generator's: match hints for block writes, with the file access they came from, and prefetch
+    hints in between
+    """
+    if i % match_every == 0:
+        return Hint(HINT_NONE, i * 8, 4096, dict(inode=i % INODES, file_offset=i * 4096, access_class=ACCESS_WRITE),
+                    match=True, timestamp=time.time_ns())
+    return Hint(HINT_PREFETCH, i * 8, 4096, dict(pattern=PATTERN_SEQUENTIAL, pid=1000 + i % PIDS),
+                timestamp=time.time_ns())
+
+def receiver_process(hint_count, unix_path, ready, results, done):
+    """
+    Run a receiver until hint_count hints arrived, then report its CPU time
+    """
+    async def run():
+        # Unbounded, so that the receiver never holds the client back
+        queue = FairFanIn(lane_size=0)
+        lanes = FairPriorityLanes(lambda hint: hint.match, queue, queue)
+        if unix_path:
+            receiver = UnixHintReceiver(lanes, unix_path)
+        else:
+            receiver = TCPHintReceiver(lanes, HOST, PORT)
+        await receiver.start()
+        ready.set()
+        await queue.get()
+        cpu_start = time.process_time()
+        for i in range(hint_count - 1):
+            await queue.get()
+        results.send(time.process_time() - cpu_start)
+        # let the client disconnect first
+        await asyncio.get_event_loop().run_in_executor(None, done.wait)
+        await asyncio.sleep(0.1)
+        await receiver.stop()
+    asyncio.run(run())
+
+def sender_process(protocol, hint_count, match_every, unix_path, receiver_results, results):
+    """
+    Send hint_count hints, and once the receiver got them all, report the time it took, the CPU time of both ends
+    """
+    async def send():
+        client = HintClient(HOST, PORT, protocol=protocol, unix_path=unix_path)
+        await client.start()
+        hints = [make_hint(i, match_every) for i in range(hint_count)]
+        for hint in hints:
+            await client.send_hint(hint)
+        return client
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    async def send_and_wait():
+        client = await send()
+        loop = asyncio.get_event_loop()
+        # keep the client's event loop running until the receiver got everything
+        receiver_cpu = await loop.run_in_executor(None, receiver_results.recv)
+        await client.close()
+        return receiver_cpu
+    receiver_cpu = asyncio.run(send_and_wait())
+    sender_cpu = time.process_time() - cpu_start
+    results.send((time.perf_counter() - start, sender_cpu, receiver_cpu))
+
+def run(transport, protocol, hint_count, match_every, tmpdir):
+    """
+    Run a receiver and a sender, each in a process of its own. This one stays out of it, so that they don't share a
+    resource tracker (see ShmRing.attach()), like a real receiver and generator.
+    """
+    unix_path = os.path.join(tmpdir, 'hints.sock') if transport == 'unix' else None
+    ready = multiprocessing.Event()
+    done = multiprocessing.Event()
+    receiver_results, receiver_child_results = multiprocessing.Pipe()
+    results, child_results = multiprocessing.Pipe()
+    receiver = multiprocessing.Process(target=receiver_process,
+                                       args=(hint_count, unix_path, ready, receiver_child_results, done))
+    receiver.start()
+    ready.wait()
+    sender = multiprocessing.Process(target=sender_process,
+                                     args=(protocol, hint_count, match_every, unix_path, receiver_results, child_results))
+    sender.start()
+    elapsed, sender_cpu, receiver_cpu = results.recv()
+    sender.join()
+    done.set()
+    receiver.join()
+
+    return elapsed, sender_cpu, receiver_cpu
+
+if __name__ == '__main__':
+    try:
+        hint_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_HINT_COUNT
+        match_every = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} [HINT_COUNT] [MATCH_EVERY]")
+        print(f"Send HINT_COUNT hints (default: {DEFAULT_HINT_COUNT}) over TCP loopback, a UNIX socket and shared memory, every MATCH_EVERY-th a match hint (default: 10)")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for transport, protocol in RUNS:
+            elapsed, sender_cpu, receiver_cpu = min(run(transport, protocol, hint_count, match_every, tmpdir)
+                                                    for i in range(REPEAT))
+            print(f"{transport:>4} {protocol:>6}: {hint_count / elapsed:.0f} hints/sec, CPU per hint: "
+                  f"sender {sender_cpu / hint_count * 1e6:.2f}us receiver {receiver_cpu / hint_count * 1e6:.2f}us")
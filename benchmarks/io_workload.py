@@ -0,0 +1,245 @@
+#!/usr/bin/python
+"""
+Reproducible I/O workloads against a file or block device (e.g. the iSCSI LUN of a btier device), for comparing tiering
+policies run to run.
+
+Every worker draws its offsets and read/write choices from its own random generator, seeded from --seed and the
+worker number, so the same options give the same sequence of requests per worker. Results are printed as json, with
+latencies in microseconds.
+"""
+import sys
+import os
+import mmap
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+from metrics import Histogram
+
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_COUNT = 10000
+DEFAULT_SEED = 42
+DEFAULT_ZIPF_THETA = 0.99
+DEFAULT_HOT_FRACTION = 0.1
+DEFAULT_HOT_ACCESS = 0.9
+ENGINES = ['sync', 'threads', 'asyncio']
+DISTRIBUTIONS = ['uniform', 'zipf', 'sequential', 'hotset']
+# Spreads zipf ranks over the file, so the hot blocks aren't all at its start. Prime, so it's a permutation of any
+# block count that isn't a multiple of it.
+ZIPF_SCRAMBLE = 2654435761
+
+class ZipfGenerator:
+    """
+    Zipf distributed integers in [0, n), 0 being the most popular, using the method of Gray et al., "Quickly
+    generating billion-record synthetic databases" (as in YCSB). Setup is O(n), every sample is O(1).
+    """
+    def __init__(self, n, theta, rng):
+        self.n = n
+        self.theta = theta
+        self.rng = rng
+        self.zetan = sum(1 / i ** theta for i in range(1, n + 1))
+        zeta2 = 1 + 1 / 2 ** theta
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / n) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+        self.half_pow_theta = 1 + 0.5 ** theta
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < self.half_pow_theta:
+            return 1
+        return min(int(self.n * (self.eta * u - self.eta + 1) ** self.alpha), self.n - 1)
+
+def block_sampler(options, block_count, rng, worker):
+    """
+    Return a function that returns the next block number for a worker to access
+    """
+    if options.distribution == 'uniform':
+        return lambda: rng.randrange(block_count)
+    if options.distribution == 'zipf':
+        zipf = ZipfGenerator(block_count, options.zipf_theta, rng)
+        return lambda: zipf.next() * ZIPF_SCRAMBLE % block_count
+    if options.distribution == 'hotset':
+        hot_count = max(int(block_count * options.hot_fraction), 1)
+        # Same hot set for all the workers
+        hot_start = random.Random(options.seed).randrange(block_count - hot_count + 1)
+        def hotset():
+            if rng.random() < options.hot_access:
+                return hot_start + rng.randrange(hot_count)
+            return rng.randrange(block_count)
+        return hotset
+    # sequential: every worker streams through its own part of the file
+    position = block_count * worker // options.queue_depth
+    def sequential():
+        nonlocal position
+        blocknr = position
+        position = (position + 1) % block_count
+        return blocknr
+    return sequential
+
+def device_size(fd):
+    """
+    Size of a file or block device, in bytes
+    """
+    return os.lseek(fd, 0, os.SEEK_END)
+
+class Worker:
+    """
+    Issues the requests of one queue slot, one at a time, and keeps their latencies
+    """
+    def __init__(self, options, fd, block_count, number):
+        self.options = options
+        self.fd = fd
+        self.rng = random.Random(options.seed * 1000003 + number)
+        self.next_block = block_sampler(options, block_count, self.rng, number)
+        # Anonymous mmaps are page aligned, as O_DIRECT wants
+        self.buffer = mmap.mmap(-1, options.block_size)
+        # Not zeros, which some devices special case. The data itself isn't part of the workload.
+        self.buffer.write(os.urandom(options.block_size))
+        self.buffers = [self.buffer]
+        self.read_latency = Histogram()
+        self.write_latency = Histogram()
+        self.errors = 0
+
+    def request(self):
+        """
+        Issue the next request. Blocks.
+        """
+        offset = self.next_block() * self.options.block_size
+        is_read = self.rng.random() < self.options.read_ratio
+        start = time.perf_counter_ns()
+        try:
+            if is_read:
+                os.preadv(self.fd, self.buffers, offset)
+            else:
+                os.pwritev(self.fd, self.buffers, offset)
+        except OSError:
+            self.errors += 1
+            return
+        (self.read_latency if is_read else self.write_latency).record(time.perf_counter_ns() - start)
+
+def request_counts(options):
+    """
+    Number of requests each worker issues, splitting --count between them
+    """
+    return [options.count // options.queue_depth + (worker < options.count % options.queue_depth)
+            for worker in range(options.queue_depth)]
+
+def run_sync(workers, options, deadline):
+    for worker, count in zip(workers, request_counts(options)):
+        for i in range(count):
+            if deadline and time.monotonic() > deadline:
+                return
+            worker.request()
+
+def run_threads(workers, options, deadline):
+    def run_worker(worker, count):
+        for i in range(count):
+            if deadline and time.monotonic() > deadline:
+                return
+            worker.request()
+    threads = [threading.Thread(target=run_worker, args=(worker, count))
+               for worker, count in zip(workers, request_counts(options))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_asyncio(workers, options, deadline):
+    async def run_worker(loop, executor, worker, count):
+        for i in range(count):
+            if deadline and time.monotonic() > deadline:
+                return
+            await loop.run_in_executor(executor, worker.request)
+
+    async def run_all():
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=options.queue_depth) as executor:
+            await asyncio.gather(*[run_worker(loop, executor, worker, count)
+                                   for worker, count in zip(workers, request_counts(options))])
+    asyncio.run(run_all())
+
+RUNNERS = dict(sync=run_sync, threads=run_threads, asyncio=run_asyncio)
+
+def latency_summary(histogram):
+    """
+    Latency percentiles of a histogram of nanoseconds, in microseconds
+    """
+    summary = histogram.summary()
+    return dict(count=summary['count'], **{key: round(summary[percentile] / 1000, 1) for key, percentile in
+                                           (('mean', 'mean'), ('p50', 'p50'), ('p99', 'p99'), ('p999', 'p99.9'),
+                                            ('max', 'max'))})
+
+def run(options):
+    flags = os.O_RDWR if options.read_ratio < 1 else os.O_RDONLY
+    if options.direct:
+        flags |= os.O_DIRECT
+    fd = os.open(options.file_name, flags)
+    try:
+        size = options.size or device_size(fd)
+        block_count = size // options.block_size
+        if not block_count:
+            raise ValueError(f"{options.file_name} is smaller than a block, use --size")
+        if options.engine == 'sync':
+            options.queue_depth = 1
+        workers = [Worker(options, fd, block_count, number) for number in range(options.queue_depth)]
+        deadline = time.monotonic() + options.duration if options.duration else None
+        if options.duration:
+            # Run until the deadline
+            options.count = sys.maxsize
+        start = time.perf_counter()
+        RUNNERS[options.engine](workers, options, deadline)
+        elapsed = time.perf_counter() - start
+        if options.fsync and options.read_ratio < 1:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    reads, writes = Histogram(), Histogram()
+    for worker in workers:
+        reads.merge(worker.read_latency)
+        writes.merge(worker.write_latency)
+    requests = reads.count + writes.count
+    return dict(file_name=options.file_name, size=size, block_size=options.block_size, engine=options.engine,
+                queue_depth=options.queue_depth, distribution=options.distribution, read_ratio=options.read_ratio,
+                direct=options.direct, seed=options.seed, requests=requests,
+                errors=sum(worker.errors for worker in workers), elapsed=round(elapsed, 3),
+                iops=round(requests / elapsed, 1), mb_per_sec=round(requests * options.block_size / elapsed / 2 ** 20, 2),
+                read_latency_us=latency_summary(reads), write_latency_us=latency_summary(writes))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_name', help='File or block device to do I/O on. Writes overwrite its contents!')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help=f'Number of requests (default: {DEFAULT_COUNT})')
+    parser.add_argument('--duration', type=float, help='Issue requests for this many seconds, instead of --count requests')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help=f'Bytes per request (default: {DEFAULT_BLOCK_SIZE})')
+    parser.add_argument('--size', type=int, help='Bytes of the file to use, from its start (default: all of it)')
+    parser.add_argument('--engine', type=str, default='threads', choices=ENGINES, help='How requests are issued: sync issues them one by one, threads from --queue-depth threads, asyncio from --queue-depth coroutines on a thread pool. All use os.preadv/os.pwritev (default: threads)')
+    parser.add_argument('--queue-depth', type=int, default=1, help='Requests in flight at a time (default: 1)')
+    parser.add_argument('--read-ratio', type=float, default=1.0, help='Share of requests that are reads, the rest are writes (default: 1)')
+    parser.add_argument('--distribution', type=str, default='uniform', choices=DISTRIBUTIONS, help='Which blocks are accessed: uniform at random, zipf distributed, sequential streams (one per queue slot), or a hot set (default: uniform)')
+    parser.add_argument('--zipf-theta', type=float, default=DEFAULT_ZIPF_THETA, help=f'Skew of the zipf distribution, between 0 and 1 (default: {DEFAULT_ZIPF_THETA})')
+    parser.add_argument('--hot-fraction', type=float, default=DEFAULT_HOT_FRACTION, help=f'Share of the blocks in the hot set (default: {DEFAULT_HOT_FRACTION})')
+    parser.add_argument('--hot-access', type=float, default=DEFAULT_HOT_ACCESS, help=f'Share of the requests that go to the hot set (default: {DEFAULT_HOT_ACCESS})')
+    parser.add_argument('--direct', action='store_true', help='Bypass the page cache with O_DIRECT. --block-size should be a multiple of the logical block size')
+    parser.add_argument('--fsync', action='store_true', help='fsync after the writes, outside of the measured time')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help=f'Seed of the request sequence (default: {DEFAULT_SEED})')
+    options = parser.parse_args()
+    if not 0 <= options.read_ratio <= 1:
+        parser.error('--read-ratio should be between 0 and 1')
+    if options.queue_depth < 1:
+        parser.error('--queue-depth should be at least 1')
+    if options.distribution == 'zipf' and not 0 < options.zipf_theta < 1:
+        parser.error('--zipf-theta should be between 0 and 1')
+    return options
+
+if __name__ == '__main__':
+    print(json.dumps(run(parse_args()), indent=2))
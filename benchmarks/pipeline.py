@@ -0,0 +1,210 @@
+#!/usr/bin/python
+"""
+End to end benchmark of the hint pipeline: synthetic trace records go through consume_trace and HintGenerator, are sent
+by HintClient over TCP to TCPHintReceiver in another process, and are handled by HintHandler, injecting into a fake
+btier control device and migrating through a fake btier sysfs tree, both in a temp dir.
+
+The offered load (trace records per second) is swept, and for every step the throughput, the latency from reading a
+record until its hint is handled and injected, and the CPU time per hint on each side are reported.
+"""
+import sys
+import os
+import time
+import random
+import asyncio
+import tempfile
+import importlib.util
+import multiprocessing
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from hint_generator import HintGenerator
+from hint_client import HintClient
+from hint_receiver import TCPHintReceiver
+from hint_handler import HintHandler, is_match_hint
+from hint_queues import FairFanIn, FairPriorityLanes
+from btier_control import FakeBtierControl
+from tier_manager import BlockInfo
+from trace_records import BlockRecord
+from metrics import REGISTRY
+
+def load_main(name, path):
+    """
+    Load one of the main.py files under its own module name, since both are called main
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BASE_DIR, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+generator_main = load_main('generator_main', 'hint_generator/main.py')
+receiver_main = load_main('receiver_main', 'hint_receiver/main.py')
+
+DEFAULT_LOADS = [1000, 5000, 20000, 50000]
+DEFAULT_DURATION = 3
+HOST = '127.0.0.1'
+PORT = 13371
+SEED = 42
+PIDS = 16
+DEVICE_NAME = 'sdtierbench'
+BLOCK_COUNT = 4096
+SLOWEST_TIER = 2
+WRITE_SHARE = 0.5
+TICK = 0.001
+
+class SyntheticTraceSource:
+    """
+    Puts rate block trace records per second for duration seconds: processes writing at random and reading
+    sequentially, which produces both match and prefetch hints
+    """
+    def __init__(self, rate, duration, seed=SEED):
+        self.rate = rate
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.positions = [self.rng.randrange(BLOCK_COUNT * 2048) for pid in range(PIDS)]
+        self.records = 0
+
+    def _record(self):
+        pid = self.rng.randrange(PIDS)
+        if self.rng.random() < WRITE_SHARE:
+            offset = self.rng.randrange(BLOCK_COUNT * 2048 // 8) * 8
+            return BlockRecord(pid, offset, 4096, True, time.time_ns())
+        offset = self.positions[pid]
+        self.positions[pid] = (offset + 128) % (BLOCK_COUNT * 2048)
+        return BlockRecord(pid, offset, 65536, False, time.time_ns())
+
+    async def async_read_into(self, queue):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        total = int(self.rate * self.duration)
+        while self.records < total:
+            # Catch up with where the offered load should be by now
+            due = min(int((loop.time() - start) * self.rate) + 1, total)
+            while self.records < due:
+                await queue.put(self._record())
+                self.records += 1
+            await asyncio.sleep(TICK)
+
+def make_sysfs(root):
+    """
+    A fake btier sysfs tree: writes to it land in regular files
+    """
+    tier_dir = os.path.join(root, DEVICE_NAME, 'tier')
+    os.makedirs(tier_dir)
+    with open(os.path.join(root, DEVICE_NAME, 'size'), 'w') as size:
+        size.write(f"{BLOCK_COUNT * 2048}\n")
+    for entry in ('migrate_block', 'migration_enabled', 'show_blockinfo'):
+        open(os.path.join(tier_dir, entry), 'w').close()
+    return os.path.join(tier_dir, 'migrate_block')
+
+def receiver_process(tmpdir, ready, done, results):
+    """
+    Receive and handle hints until the generator is done, then report
+    """
+    async def run():
+        # Forked with the generator's metrics
+        REGISTRY.counters.clear()
+        REGISTRY.histograms.clear()
+        control = FakeBtierControl(os.path.join(tmpdir, 'tiercontrol'))
+        migrate_block = make_sysfs(os.path.join(tmpdir, 'sys'))
+        handler = HintHandler(DEVICE_NAME, DEVICE_NAME, btier_control=control, inject_batch_size=32,
+                              max_migrations_per_sec=1e6, sysfs_root=os.path.join(tmpdir, 'sys'))
+        # show_blockinfo can't be faked with a regular file, so start with every block known to be on the slowest tier
+        handler.block_stats.resize(BLOCK_COUNT)
+        for blocknr in range(BLOCK_COUNT):
+            handler.block_stats.update(blocknr, BlockInfo(SLOWEST_TIER, 0, 0, 0, 0))
+        match_queue = FairFanIn()
+        advisory_queue = FairFanIn()
+        receiver = TCPHintReceiver(FairPriorityLanes(is_match_hint, match_queue, advisory_queue), HOST, PORT)
+        await receiver.start()
+        tasks = [asyncio.ensure_future(receiver_main.consume_hints(match_queue, handler.handle_hint)),
+                 asyncio.ensure_future(receiver_main.consume_hints(advisory_queue, handler.handle_hint)),
+                 asyncio.ensure_future(handler.migration_scheduler.run())]
+        ready.set()
+        cpu_start = time.process_time()
+        await asyncio.get_event_loop().run_in_executor(None, done.wait)
+        while receiver.connections or match_queue.qsize() or advisory_queue.qsize():
+            await asyncio.sleep(0.01)
+        handler.flush_injections()
+        await handler.workers.wait_for_injections()
+        cpu = time.process_time() - cpu_start
+        for task in tasks:
+            task.cancel()
+        await receiver.stop()
+        handler.workers.shutdown()
+        control.close()
+        with open(migrate_block) as migrations:
+            migration_count = sum(1 for line in migrations)
+        results.send(dict(cpu=cpu, hints=REGISTRY.counters['receiver.hints'].value,
+                          injected=len(control.read_entries()), migrations=migration_count,
+                          read_to_handle=REGISTRY.histograms['handler.read_to_handle'].summary(),
+                          read_to_inject=REGISTRY.histograms['handler.read_to_inject'].summary()))
+    asyncio.run(run())
+
+async def generate(rate, duration):
+    """
+    Run the generator side at rate records per second. Returns its CPU time and the number of records and hints.
+    """
+    queue = asyncio.Queue(maxsize=1000)
+    source = SyntheticTraceSource(rate, duration)
+    generator = HintGenerator()
+    client = HintClient(HOST, PORT)
+    await client.start()
+    cpu_start = time.process_time()
+    consumer = asyncio.ensure_future(generator_main.consume_trace(queue, generator.handle_trace_record,
+                                                                  client.send_hint))
+    await source.async_read_into(queue)
+    await queue.join()
+    while client.pending_bytes:
+        await asyncio.sleep(0.01)
+    cpu = time.process_time() - cpu_start
+    consumer.cancel()
+    await client.close()
+    return cpu, source.records, REGISTRY.counters['generator.hints'].value
+
+def run(rate, duration):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ready = multiprocessing.Event()
+        done = multiprocessing.Event()
+        results, child_results = multiprocessing.Pipe()
+        receiver = multiprocessing.Process(target=receiver_process, args=(tmpdir, ready, done, child_results))
+        receiver.start()
+        ready.wait()
+        REGISTRY.counters.clear()
+        REGISTRY.histograms.clear()
+        start = time.perf_counter()
+        generator_cpu, records, hints = asyncio.run(generate(rate, duration))
+        done.set()
+        received = results.recv()
+        elapsed = time.perf_counter() - start
+        receiver.join()
+    return elapsed, generator_cpu, records, hints, received
+
+def format_latency(summary):
+    return "p50 {:.0f}us p99 {:.0f}us p999 {:.0f}us".format(*(summary[p] / 1000 for p in ('p50', 'p99', 'p99.9')))
+
+def benchmark(loads, duration):
+    for rate in loads:
+        elapsed, generator_cpu, records, hints, received = run(rate, duration)
+        lost = hints - received['hints']
+        print(f"offered {rate} records/sec: {records / elapsed:.0f} records/sec, {received['hints'] / elapsed:.0f} "
+              f"hints/sec ({received['injected']} injected, {received['migrations']} migrations"
+              f"{f', {lost} LOST' if lost else ''})")
+        print(f"    read to handle: {format_latency(received['read_to_handle'])}")
+        print(f"    read to inject: {format_latency(received['read_to_inject'])}")
+        print(f"    CPU per hint: generator {generator_cpu / max(hints, 1) * 1e6:.1f}us "
+              f"receiver {received['cpu'] / max(received['hints'], 1) * 1e6:.1f}us")
+
+if __name__ == '__main__':
+    try:
+        loads = [int(load) for load in sys.argv[1].split(',')] if len(sys.argv) > 1 else DEFAULT_LOADS
+        duration = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DURATION
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} [LOADS [DURATION]]")
+        print(f"Offer each of the comma separated LOADS, in trace records per second (default: "
+              f"{','.join(map(str, DEFAULT_LOADS))}), to the hint pipeline for DURATION seconds (default: "
+              f"{DEFAULT_DURATION}) and report throughput, latency and CPU per hint")
+        sys.exit(1)
+    benchmark(loads, duration)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import random
+import itertools
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hint_receiver'))
+from placement import TierLayout, HeatPlacementPolicy
+from tier_manager import BTIER_BLOCK_SIZE, SECTOR_SIZE
+
+DEFAULT_ACCESS_COUNT = 500000
+# A 1G / 16G / 64G btier device, in 1M blocks
+TIER_CAPACITIES = [1024, 16 * 1024, 64 * 1024]
+ZIPF_EXPONENT = 1.1
+SEED = 42
+# One in WRITE_SHARE accesses is a write
+WRITE_SHARE = 3
+SECTORS_PER_BLOCK = BTIER_BLOCK_SIZE // SECTOR_SIZE
+
+def zipf_trace(rng, block_count, access_count):
+    """
+    Zipf-distributed accesses, hot blocks scattered over the device
+    """
+    weights = [1 / (rank ** ZIPF_EXPONENT) for rank in range(1, block_count + 1)]
+    blocks = list(range(block_count))
+    rng.shuffle(blocks)
+    return rng.choices(blocks, cum_weights=list(itertools.accumulate(weights)), k=access_count)
+
+def scan_trace(rng, block_count, access_count):
+    """
+    Repeated sequential scans over a region twice the size of the fastest tier
+    """
+    region = 2 * TIER_CAPACITIES[0]
+    start = rng.randrange(block_count - region)
+    return [start + i % region for i in range(access_count)]
+
+def run(name, trace):
+    layout = TierLayout(TIER_CAPACITIES)
+    policy = HeatPlacementPolicy(layout)
+    fast_tier_hits = 0
+    unplaced = 0
+
+    start = time.perf_counter()
+    for i, blocknr in enumerate(trace):
+        sector = blocknr * SECTORS_PER_BLOCK
+        # Placed by the heat the block had before the access, as the hint handler does
+        target_tier = policy.target_tier(policy.block_of(sector))
+        if target_tier == 0:
+            fast_tier_hits += 1
+        elif target_tier is None:
+            # First accesses are left to btier
+            unplaced += 1
+        policy.record(sector, 4096, i % WRITE_SHARE == 0)
+    elapsed = time.perf_counter() - start
+
+    # The best a static placement could do: the most accessed blocks on the fastest tier
+    counts = Counter(trace)
+    ideal_hits = sum(count for block, count in counts.most_common(TIER_CAPACITIES[0]))
+    print(f"{name}: {len(trace) / elapsed:.0f} accesses/sec ({elapsed / len(trace) * 1e6:.2f}us each), "
+          f"placed on tier 0: {fast_tier_hits / len(trace):.1%} (static optimum {ideal_hits / len(trace):.1%}), "
+          f"left to btier: {unplaced / len(trace):.1%}")
+
+try:
+    access_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ACCESS_COUNT
+except ValueError:
+    print(f"Usage: {sys.argv[0]} [ACCESS_COUNT]")
+    print(f"Feed ACCESS_COUNT synthetic block reads and writes (default: {DEFAULT_ACCESS_COUNT}) through the heat placement policy")
+    sys.exit(1)
+
+block_count = sum(TIER_CAPACITIES)
+run("zipf", zipf_trace(random.Random(SEED), block_count, access_count))
+run("scan", scan_trace(random.Random(SEED), block_count, access_count))
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""
+Memory and allocation time per trace record and per hint: as the dicts they used to be, as slotted objects (see
+trace_records and hint_types), and as a RecordBatch.
+"""
+import sys
+import os
+import time
+import tracemalloc
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from trace_records import PostCacheRecord, BlockRecord, RecordBatch
+from hint_sources import PostCacheTraceSource
+from hint_types import HINT_NONE, Hint
+
+DEFAULT_COUNT = 100000
+TIMESTAMP = time.time_ns()
+
+def post_cache_values(count):
+    return [(1000 + i % 7, 8, 16, i % 1000, i * 4096, 4096, bool(i % 2), bool(i % 3)) for i in range(count)]
+
+def block_values(count):
+    return [(1000 + i % 7, i * 8, 4096, bool(i % 3)) for i in range(count)]
+
+def as_dicts(fields, record_type):
+    """
+    The way sources used to make records
+    """
+    def make(values):
+        records = []
+        for unpacked_data in values:
+            record = dict(zip(fields, unpacked_data))
+            record['type'] = record_type
+            record['timestamp'] = TIMESTAMP
+            records.append(record)
+        return records
+    return make
+
+def as_objects(record_class):
+    def make(values):
+        return [record_class(*unpacked_data, TIMESTAMP) for unpacked_data in values]
+    return make
+
+def as_batch(record_class):
+    def make(values):
+        return RecordBatch.from_tuples(record_class, values, TIMESTAMP)
+    return make
+
+def hint_dicts(count):
+    return [dict(offset=i * 8, size=4096, hint_type=HINT_NONE, match=True, timestamp=TIMESTAMP) for i in range(count)]
+
+def hint_objects(count):
+    return [Hint(HINT_NONE, i * 8, 4096, match=True, timestamp=TIMESTAMP) for i in range(count)]
+
+def measure(make, arg, count):
+    """
+    Bytes per item that make(arg) keeps allocated, and nanoseconds per item it takes
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = make(arg)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del items
+    start = time.perf_counter_ns()
+    items = make(arg)
+    elapsed = time.perf_counter_ns() - start
+    del items
+    return size / count, elapsed / count
+
+def report(name, make, arg, count, baseline=None):
+    size, elapsed = measure(make, arg, count)
+    saving = f" ({1 - size / baseline:.0%} less memory)" if baseline else ""
+    print(f"{name:>28}: {size:6.1f} bytes, {elapsed:6.0f}ns each{saving}")
+    return size
+
+def benchmark(count):
+    print(f"{count} of each")
+    values = post_cache_values(count)
+    fields = PostCacheRecord.fields
+    baseline = report("post cache record dicts", as_dicts(fields, PostCacheTraceSource.type), values, count)
+    report("PostCacheRecords", as_objects(PostCacheRecord), values, count, baseline)
+    report("post cache RecordBatch", as_batch(PostCacheRecord), values, count, baseline)
+    values = block_values(count)
+    baseline = report("block record dicts", as_dicts(BlockRecord.fields, BlockRecord.type), values, count)
+    report("BlockRecords", as_objects(BlockRecord), values, count, baseline)
+    report("block RecordBatch", as_batch(BlockRecord), values, count, baseline)
+    baseline = report("hint dicts", hint_dicts, count, count)
+    report("Hints", hint_objects, count, count, baseline)
+
+if __name__ == '__main__':
+    try:
+        count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} [COUNT]")
+        print(f"Make COUNT records and hints (default: {DEFAULT_COUNT}) of every kind, and report the memory and time "
+              "each takes")
+        sys.exit(1)
+    benchmark(count)
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import glob
+import struct
+import pickle
+import random
+import signal
+import asyncio
+import tempfile
+import functools
+import multiprocessing
+from collections import defaultdict
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from hint_types import SECTOR_SIZE
+from hint_generator import HintGenerator
+from hint_sources import (FileTraceSource, PostCacheTraceSource, BinaryBlockTraceSource, BLK_IO_TRACE,
+                          BLK_IO_TRACE_MAGIC, BLK_IO_TRACE_VERSION, BLK_TA_ISSUE, BLK_TC_SHIFT, BLK_TC_WRITE)
+from sharded_generator import ShardedGenerator
+
+DEFAULT_ITERATION_COUNT = 50000
+SHARD_COUNTS = [1, 2, 4]
+SEED = 42
+INODES = 100
+PIDS = 64
+# Files are laid out this far apart on the device, so that they're spread over the shards' regions
+FILE_SPACING = 16 * 1024 * 1024
+# Match hints are checked to be in order per btier block
+BTIER_BLOCK_SIZE = 1024 * 1024
+BLK_TC_READ = 1 << BLK_TC_SHIFT
+CHUNK_RECORDS = 256
+RESTART_SUPERVISE_INTERVAL = 0.1
+STOP_TIMEOUT = 600
+
+class RecordingClient:
+    """
+    Stands in for HintClient in the shards: counts hints, and keeps the sector offsets of match hints. They're written
+    to a file in directory once the shard stops, or as they're sent if log_matches is set.
+    """
+    def __init__(self, directory, log_matches=False):
+        self.directory = directory
+        self.log_matches = log_matches
+        self.hints = 0
+        self.matches = []
+        self._log = None
+
+    async def start(self):
+        if self.log_matches:
+            self._log = open(os.path.join(self.directory, f'{os.getpid()}.log'), 'w', buffering=1)
+        open(os.path.join(self.directory, f'{os.getpid()}.ready'), 'w').close()
+
+    async def send_hint(self, hint):
+        self.hints += 1
+        if hint.match:
+            self.matches.append(hint.offset)
+            if self._log:
+                self._log.write(f'{hint.offset}\n')
+
+    async def close(self):
+        with open(os.path.join(self.directory, f'{os.getpid()}.hints'), 'wb') as f:
+            pickle.dump((self.hints, self.matches), f)
+
+def synthetic_traces(rng, iteration_count):
+    """
+    A made up workload, as the trace sources would read it: processes reading and writing files sequentially, with
+    the writes going through writeback. Returns the file, post cache and block traces.
+    """
+    file_format = FileTraceSource._unpack_format
+    post_cache_format = PostCacheTraceSource._unpack_format
+    magic = BLK_IO_TRACE_MAGIC | BLK_IO_TRACE_VERSION
+    file_trace, post_cache_trace, block_trace = bytearray(), bytearray(), bytearray()
+    file_offsets = [0] * INODES
+    for sequence in range(iteration_count):
+        pid = rng.randrange(PIDS)
+        inode = rng.randrange(INODES)
+        offset = file_offsets[inode]
+        sector = (inode * FILE_SPACING + offset) // SECTOR_SIZE
+        size = rng.choice([4096, 16384, 65536])
+        is_write = rng.random() < 0.3
+        file_trace += struct.pack(file_format, pid, 8, 16, inode, offset, size, is_write)
+        post_cache_trace += struct.pack(post_cache_format, pid, 8, 16, inode, offset, size,
+                                         not is_write and rng.random() < 0.5, is_write)
+        action = BLK_TA_ISSUE | (BLK_TC_WRITE if is_write else BLK_TC_READ)
+        block_trace += BLK_IO_TRACE.pack(magic, sequence, sequence * 1000, sector, size, action, pid, 0x800010, 0, 0, 0)
+        file_offsets[inode] += size
+    return bytes(file_trace), bytes(post_cache_trace), bytes(block_trace)
+
+def write_order(block_trace):
+    """
+    Sector offsets of the block writes, per btier block, in the order they were traced
+    """
+    order = defaultdict(list)
+    for event in BLK_IO_TRACE.iter_unpack(block_trace):
+        sector, action = event[3], event[5]
+        if action & BLK_TC_WRITE:
+            order[sector * SECTOR_SIZE // BTIER_BLOCK_SIZE].append(sector)
+    return order
+
+async def read_chunks(directory, traces):
+    """
+    Read the traces from files with the sources, a chunk of each in turn, the way they'd be put into a
+    ShardedGenerator. Returns the sources and the (source type, chunk) pairs.
+    """
+    paths = []
+    for name, trace in zip(['file', 'post_cache', 'block'], traces):
+        paths.append(os.path.join(directory, name))
+        with open(paths[-1], 'wb') as f:
+            f.write(trace)
+    sources = [FileTraceSource(paths[0], max_batch_records=CHUNK_RECORDS),
+               PostCacheTraceSource(paths[1], max_batch_records=CHUNK_RECORDS),
+               BinaryBlockTraceSource(None, input_path=paths[2], read_size=CHUNK_RECORDS * BLK_IO_TRACE.size)]
+    await sources[2].start()
+    chunks = []
+    done = False
+    while not done:
+        done = True
+        for source in sources:
+            data = await source.read_chunk() if source is sources[2] else source.read_chunk()
+            if data:
+                chunks.append((source.type, data))
+                done = False
+    await sources[2].stop()
+    return sources, chunks
+
+async def generate_in_process(sources, chunks):
+    """
+    Decode the chunks and generate hints for them in this process. Returns the hint count, the match hints' sector
+    offsets and the CPU time it took.
+    """
+    generator = HintGenerator()
+    decoders = {source.type: source.make_decoder() for source in sources}
+    hints = 0
+    matches = []
+    start = time.process_time()
+    for source_type, data in chunks:
+        for record in decoders[source_type].decode(data, time.time_ns()):
+            hint = await generator.handle_trace_record(record)
+            if hint:
+                hints += 1
+                if hint.match:
+                    matches.append(hint.offset)
+    return hints, matches, time.process_time() - start
+
+async def generate_sharded(sources, chunks, shard_count, directory, kill_shard=False):
+    """
+    Generate hints for the chunks on shard_count shards. If kill_shard is set, a shard is killed halfway through.
+
+    Returns the wall clock time, the CPU time of this process and of each shard, and per shard process, the hint count
+    and the match hints' sector offsets.
+    """
+    for path in glob.glob(os.path.join(directory, '*.*')):
+        os.unlink(path)
+    client_factory = functools.partial(RecordingClient, directory, log_matches=kill_shard)
+    sharded = ShardedGenerator(shard_count, sources, client_factory, supervise_interval=RESTART_SUPERVISE_INTERVAL)
+    sharded.start()
+    # Wait for the shards to come up, so that their start up time isn't counted
+    while len(glob.glob(os.path.join(directory, '*.ready'))) < shard_count:
+        await asyncio.sleep(0.01)
+    runner = asyncio.ensure_future(sharded.run())
+    start, start_cpu = time.perf_counter(), time.process_time()
+    for i, (source_type, data) in enumerate(chunks):
+        if kill_shard and i == len(chunks) // 2:
+            os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+        await sharded.put_chunk(source_type, data, time.time_ns())
+    if kill_shard:
+        # Let the supervisor notice, if it didn't already
+        await asyncio.sleep(3 * RESTART_SUPERVISE_INTERVAL)
+    runner.cancel()
+    # With fewer CPUs than shards, they may take a while to catch up
+    await sharded.close(timeout=STOP_TIMEOUT)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    results = []
+    if kill_shard:
+        # The killed shard never wrote its hints file
+        for path in glob.glob(os.path.join(directory, '*.log')):
+            with open(path) as f:
+                results.append((None, [int(line) for line in f]))
+    else:
+        for path in glob.glob(os.path.join(directory, '*.hints')):
+            with open(path, 'rb') as f:
+                results.append(pickle.load(f))
+    return elapsed, cpu, sharded.cpu_times(), results
+
+def order_kept(shard_matches, expected_order):
+    """
+    Whether every block write got its match hint, in the order of the block's writes
+    """
+    order = defaultdict(list)
+    for matches in shard_matches:
+        for offset in matches:
+            order[offset * SECTOR_SIZE // BTIER_BLOCK_SIZE].append(offset)
+    return order == expected_order
+
+def check_restart(shard_matches, expected_order):
+    """
+    Returns (block writes with no match hint, match hints sent more than once) after a shard was restarted
+    """
+    counts = defaultdict(int)
+    for matches in shard_matches:
+        for offset in matches:
+            counts[offset] += 1
+    expected = [offset for offsets in expected_order.values() for offset in offsets]
+    missing = sum(1 for offset in expected if not counts.get(offset))
+    return missing, sum(counts.values()) - len(set(counts))
+
+def benchmark(iteration_count):
+    with tempfile.TemporaryDirectory() as directory:
+        traces = synthetic_traces(random.Random(SEED), iteration_count)
+        expected_order = write_order(traces[2])
+        sources, chunks = asyncio.run(read_chunks(directory, traces))
+        record_count = 3 * iteration_count
+        print(f"Generating hints for {record_count} records in {len(chunks)} chunks, "
+              f"{sum(map(len, expected_order.values()))} of them block writes")
+
+        hints, matches, in_process_cpu = asyncio.run(generate_in_process(sources, chunks))
+        in_process = record_count / in_process_cpu
+        print(f"in process: {in_process:.0f} records/CPU sec, {hints} hints, "
+              f"match order {'kept' if order_kept([matches], expected_order) else 'BROKEN'}")
+
+        print(f"{os.cpu_count()} CPUs. Projected is records / CPU time of the busiest process, the rate with a CPU "
+              f"per process")
+        for shard_count in SHARD_COUNTS:
+            elapsed, cpu, shard_cpus, results = asyncio.run(generate_sharded(sources, chunks, shard_count, directory))
+            projected = record_count / max([cpu] + shard_cpus)
+            print(f"{shard_count} shards: {record_count / elapsed:.0f} records/sec here, "
+                  f"CPU sec main {cpu:.2f} shards {' '.join(f'{shard_cpu:.2f}' for shard_cpu in shard_cpus)}, "
+                  f"projected {projected:.0f} records/sec ({projected / in_process:.1f}x), "
+                  f"{sum(hints for hints, matches in results)} hints, match order "
+                  f"{'kept' if order_kept([matches for hints, matches in results], expected_order) else 'BROKEN'}")
+
+        shard_count = SHARD_COUNTS[-1]
+        elapsed, cpu, shard_cpus, results = asyncio.run(generate_sharded(sources, chunks, shard_count, directory,
+                                                                         kill_shard=True))
+        missing, repeated = check_restart([matches for hints, matches in results], expected_order)
+        print(f"{shard_count} shards, one killed halfway: {missing} block writes without a match hint, "
+              f"{repeated} match hints sent again by its replacement")
+
+# The shards' processes import this module, don't run the benchmark in them
+if __name__ == '__main__':
+    try:
+        iteration_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ITERATION_COUNT
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} [ITERATION_COUNT]")
+        print(f"Generate hints for ITERATION_COUNT (default: {DEFAULT_ITERATION_COUNT}) synthetic file, post cache and "
+              f"block records each, in process and on {', '.join(map(str, SHARD_COUNTS))} shards")
+        sys.exit(1)
+    benchmark(iteration_count)
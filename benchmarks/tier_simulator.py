@@ -0,0 +1,380 @@
+#!/usr/bin/python
+"""
+Offline btier simulator, for judging placement policies on recorded traces without btier.
+
+Trace records (as recorded by the hint generator's --record, or a synthetic workload) go through HintGenerator and a
+HintHandler with the policy under test, as they would live. The handler's injections and migrations go to a model of
+btier: tiers with a capacity, access latency and bandwidth each, new blocks placed by the injected hints (or on the
+fastest tier with room), and btier's own periodic auto migration. Time is the trace's time, so heat decay and rate
+limits behave as they did when the trace was recorded, however fast it's simulated.
+
+The generator and the handler see every record, as they're what's being judged. The model of btier works on NumPy
+arrays a batch of I/Os at a time, so it adds little to their cost.
+
+Reports the share of I/Os served by each tier, migration traffic and the modeled I/O latency, as json.
+"""
+import sys
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from itertools import islice
+
+import numpy as np
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from hint_generator import HintGenerator
+from trace_replay import ReplayTraceSource
+from trace_records import BlockRecord
+from hint_handler import HintHandler
+from btier_control import HINT_ENTRY
+from btier_workers import WorkerStats
+from placement import TierLayout, HeatPlacementPolicy
+from tier_manager import BlockInfo, BTIER_BLOCK_SIZE, SECTOR_SIZE
+from metrics import Histogram
+
+# /dev/ram0:/dev/sda:/dev/sdb2 as set up by server_configure.sh: 1G of RAM, an SSD and a disk, in 1M blocks
+DEFAULT_CAPACITIES = [1024, 16 * 1024, 64 * 1024]
+# Per tier: microseconds per I/O, and MB/sec
+DEFAULT_LATENCIES = [5, 100, 8000]
+DEFAULT_BANDWIDTHS = [4000, 500, 150]
+# btier's defaults
+BTIER_MIGRATION_INTERVAL = 14400
+BTIER_MAX_AGE = 86400
+DEFAULT_MAX_MIGRATIONS_PER_SEC = 100
+BATCH_RECORDS = 4096
+UNALLOCATED = -1
+POLICIES = dict(none=lambda layout, clock: None,
+                heat=lambda layout, clock: HeatPlacementPolicy(layout, clock=clock))
+
+class ImmediateWorkers:
+    """
+    A stand-in for BtierWorkers that does btier work right away, so the simulated btier sees it in trace order
+    """
+    def __init__(self):
+        self.inject_stats = WorkerStats('inject')
+        self.migration_stats = WorkerStats('migration')
+
+    def submit_injection(self, func, *args):
+        func(*args)
+
+    def submit_migration(self, func, *args):
+        func(*args)
+
+    async def wait_for_injections(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+class SimulatedBtier:
+    """
+    A model of a btier device. Serves as HintHandler's btier control (see inject()), and models I/O (see
+    access_many()), migrations (see migrate()) and btier's auto migration.
+
+    A block is allocated on its first access: on the tier the last injected hint for it asked for, if it has room,
+    or on the fastest tier with room otherwise. Every migration_interval seconds, auto migration demotes blocks that
+    weren't accessed for max_age seconds, and promotes blocks that were accessed more than the average block of
+    their tier since the last pass.
+
+    on_change(blocknr, tier), if set, is called whenever a block is allocated or moved.
+    """
+    def __init__(self, capacities, latencies, bandwidths, migration_interval=BTIER_MIGRATION_INTERVAL,
+                 max_age=BTIER_MAX_AGE, auto_migration=True):
+        self.capacities = capacities
+        self.latencies = np.array(latencies, dtype=np.float64) * 1000
+        # nanoseconds per byte
+        self.byte_times = 1e3 / np.array(bandwidths, dtype=np.float64)
+        self.migration_interval = migration_interval
+        self.max_age = max_age
+        self.auto_migration = auto_migration
+        self.on_change = None
+        self.block_count = sum(capacities)
+        self.tier = np.full(self.block_count, UNALLOCATED, dtype=np.int8)
+        self.last_access = np.zeros(self.block_count, dtype=np.float64)
+        self.accesses = np.zeros(self.block_count, dtype=np.int64)
+        self.used = [0] * len(capacities)
+        self.now = 0.0
+        self._next_pass = migration_interval
+        self._placement = {}
+        self.reads = np.zeros(len(capacities), dtype=np.int64)
+        self.writes = np.zeros(len(capacities), dtype=np.int64)
+        self.hinted_migrations = 0
+        self.auto_migrations = 0
+        self.out_of_range = 0
+        self.latency = Histogram()
+
+    def inject(self, entries, count):
+        for offset, size, tier in HINT_ENTRY.iter_unpack(bytes(entries[:count * HINT_ENTRY.size])):
+            if tier < 0:
+                continue
+            first = offset * SECTOR_SIZE // BTIER_BLOCK_SIZE
+            last = (offset * SECTOR_SIZE + max(size, 1) - 1) // BTIER_BLOCK_SIZE
+            for blocknr in range(first, min(last, self.block_count - 1) + 1):
+                self._placement[blocknr] = tier
+
+    def access_many(self, times, sectors, sizes, is_write):
+        """
+        Model a batch of I/Os, given as arrays, in time order: their time in seconds since the start of the trace,
+        sector offset, size and direction. An I/O's latency is that of the slowest tier it touches.
+
+        Auto migration passes that are due before an I/O run before it.
+        """
+        first = sectors * SECTOR_SIZE // BTIER_BLOCK_SIZE
+        in_range = first < self.block_count
+        if not in_range.all():
+            self.out_of_range += int(np.count_nonzero(~in_range))
+            times, sectors, sizes, is_write, first = (times[in_range], sectors[in_range], sizes[in_range],
+                                                      is_write[in_range], first[in_range])
+        last = np.minimum((sectors * SECTOR_SIZE + np.maximum(sizes, 1) - 1) // BTIER_BLOCK_SIZE,
+                          self.block_count - 1)
+        start = 0
+        while start < len(times):
+            end = len(times)
+            if self.auto_migration:
+                end = int(np.searchsorted(times, self._next_pass, side='left'))
+            if end > start:
+                self._access(times[start:end], first[start:end], last[start:end], sizes[start:end],
+                             is_write[start:end])
+            if end == len(times):
+                break
+            self.now = float(times[end])
+            self._auto_migrate()
+            self._next_pass = self.now + self.migration_interval
+            start = end
+        if len(times):
+            self.now = max(self.now, float(times[-1]))
+
+    def _access(self, times, first, last, sizes, is_write):
+        counts = last - first + 1
+        if (counts == 1).all():
+            blocks = first
+            io_starts = np.arange(len(first))
+        else:
+            io_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            blocks = np.repeat(first, counts) + np.arange(int(counts.sum())) - np.repeat(io_starts, counts)
+        tiers = self.tier[blocks]
+        unallocated = tiers == UNALLOCATED
+        if unallocated.any():
+            new_blocks = blocks[unallocated]
+            # In the order of their first access
+            unique_blocks, first_seen = np.unique(new_blocks, return_index=True)
+            for blocknr in new_blocks[np.sort(first_seen)].tolist():
+                self._allocate(blocknr, self._placement.pop(blocknr, None))
+            tiers = self.tier[blocks]
+        # Times are in order, so where a block is accessed more than once the last time sticks
+        self.last_access[blocks] = np.repeat(times, counts)
+        np.add.at(self.accesses, blocks, 1)
+
+        slowest = np.maximum.reduceat(tiers, io_starts)
+        tier_count = len(self.capacities)
+        self.writes += np.bincount(slowest[is_write], minlength=tier_count)
+        self.reads += np.bincount(slowest[~is_write], minlength=tier_count)
+        latencies = (self.latencies[slowest] + sizes * self.byte_times[slowest]).astype(np.int64)
+        for latency, count in zip(*(values.tolist() for values in np.unique(latencies, return_counts=True))):
+            self.latency.record(latency, count)
+
+    def _allocate(self, blocknr, wanted_tier):
+        tiers = range(len(self.capacities))
+        if wanted_tier is not None and wanted_tier < len(self.capacities):
+            # The wanted tier, then slower ones, then faster ones
+            tiers = list(range(wanted_tier, len(self.capacities))) + list(range(wanted_tier - 1, -1, -1))
+        for tier in tiers:
+            if self.used[tier] < self.capacities[tier]:
+                self._place(blocknr, tier)
+                return tier
+        raise ValueError("all tiers are full")
+
+    def _place(self, blocknr, tier):
+        old_tier = self.tier[blocknr]
+        if old_tier != UNALLOCATED:
+            self.used[old_tier] -= 1
+        self.used[tier] += 1
+        self.tier[blocknr] = tier
+        if self.on_change:
+            self.on_change(blocknr, tier)
+
+    def migrate(self, blocknr, dest_tier):
+        """
+        Move an allocated block to dest_tier, if it has room. Returns whether the block moved.
+        """
+        tier = self.tier[blocknr]
+        if tier == UNALLOCATED or tier == dest_tier or self.used[dest_tier] >= self.capacities[dest_tier]:
+            return False
+        self._place(blocknr, dest_tier)
+        return True
+
+    def migrate_many(self, migrations):
+        """
+        Like TierManager.migrate_many()
+        """
+        for blocknr, dest_tier in migrations:
+            if self.migrate(blocknr, dest_tier):
+                self.hinted_migrations += 1
+
+    def _auto_migrate(self):
+        """
+        Demote blocks that weren't accessed for max_age seconds by a tier, then promote blocks that were accessed
+        more than the average block of their tier by a tier. Each goes slowest tiers first and in block order, for as
+        long as the destination tier has room.
+        """
+        tier_count = len(self.capacities)
+        allocated = self.tier != UNALLOCATED
+        tier_accesses = np.bincount(self.tier[allocated], weights=self.accesses[allocated], minlength=tier_count)
+        averages = tier_accesses / np.maximum(np.array(self.used), 1)
+        stale = allocated & (self.last_access < self.now - self.max_age)
+        hot = allocated & ~stale & (self.accesses > averages[np.maximum(self.tier, 0)])
+        for tier in range(tier_count - 2, -1, -1):
+            self._move(np.flatnonzero(stale & (self.tier == tier)), tier + 1)
+        for tier in range(tier_count - 1, 0, -1):
+            self._move(np.flatnonzero(hot & (self.tier == tier)), tier - 1)
+        self.accesses[:] = 0
+
+    def _move(self, blocks, dest_tier):
+        moved = blocks[:max(self.capacities[dest_tier] - self.used[dest_tier], 0)]
+        if not len(moved):
+            return
+        source_tier = int(self.tier[moved[0]])
+        self.tier[moved] = dest_tier
+        self.used[source_tier] -= len(moved)
+        self.used[dest_tier] += len(moved)
+        self.auto_migrations += len(moved)
+        if self.on_change:
+            for blocknr in moved.tolist():
+                self.on_change(blocknr, dest_tier)
+
+    def report(self):
+        reads = self.reads.tolist()
+        writes = self.writes.tolist()
+        ios = sum(reads) + sum(writes)
+        summary = self.latency.summary()
+        return dict(ios=ios, out_of_range=self.out_of_range,
+                    tiers=[dict(capacity=capacity, used=used, reads=tier_reads, writes=tier_writes,
+                                hit_ratio=round((tier_reads + tier_writes) / max(ios, 1), 4))
+                           for capacity, used, tier_reads, tier_writes in zip(self.capacities, self.used, reads,
+                                                                              writes)],
+                    migrations=dict(hinted=self.hinted_migrations, auto=self.auto_migrations,
+                                    traffic_mb=(self.hinted_migrations + self.auto_migrations) * BTIER_BLOCK_SIZE
+                                    // 2 ** 20),
+                    latency_us={key: round(summary[percentile] / 1000, 1) for key, percentile in
+                                (('mean', 'mean'), ('p50', 'p50'), ('p99', 'p99'), ('p999', 'p99.9'))})
+
+async def simulate(records, btier, handler, generator, max_migrations_per_sec):
+    """
+    Run (seconds, record) pairs through generator, handler and the simulated btier, in batches of BATCH_RECORDS.
+
+    btier holds a write until its hint arrives, so the generator and handler go through a batch first, record by
+    record, and then the batch's block I/Os are modeled together. Placement hints of the batch apply to blocks it
+    allocates, and migrations the handler asks for are carried out after the batch, within its migration budget.
+    """
+    start = None
+    tokens = 0.0
+    last_refill = 0.0
+    records = iter(records)
+    while True:
+        batch = list(islice(records, BATCH_RECORDS))
+        if not batch:
+            break
+        if start is None:
+            start = batch[0][0]
+        times = []
+        sectors = []
+        sizes = []
+        writes = []
+        for timestamp, record in batch:
+            # The generator's and the policy's clock
+            btier.now = timestamp - start
+            hint = await generator.handle_trace_record(record)
+            if hint:
+                await handler.handle_hint(hint)
+            if record.type == 'block':
+                times.append(btier.now)
+                sectors.append(record.offset)
+                sizes.append(record.size)
+                writes.append(record.is_write)
+        btier.access_many(np.array(times, dtype=np.float64), np.array(sectors, dtype=np.int64),
+                          np.array(sizes, dtype=np.int64), np.array(writes, dtype=bool))
+        tokens = min(tokens + (btier.now - last_refill) * max_migrations_per_sec, max_migrations_per_sec)
+        last_refill = btier.now
+        migrations = handler.migration_scheduler.take(int(tokens))
+        tokens -= len(migrations)
+        btier.migrate_many(migrations)
+
+def synthetic_records(count, rate, seed):
+    """
+    Zipf distributed block I/O at rate I/Os per second, two thirds reads, hot blocks scattered over the device
+    """
+    rng = np.random.default_rng(seed)
+    block_count = sum(DEFAULT_CAPACITIES)
+    hot = rng.permutation(block_count)
+    cum_weights = np.cumsum(1 / np.arange(1, block_count + 1) ** 1.1)
+    sectors_per_block = BTIER_BLOCK_SIZE // SECTOR_SIZE
+    for start in range(0, count, BATCH_RECORDS):
+        size = min(BATCH_RECORDS, count - start)
+        blocks = hot[np.searchsorted(cum_weights, rng.random(size) * cum_weights[-1], side='right')]
+        sectors = blocks * sectors_per_block + rng.integers(sectors_per_block // 8, size=size) * 8
+        pids = rng.integers(16, size=size)
+        writes = rng.random(size) < 1 / 3
+        for i, pid, sector, is_write in zip(range(start, start + size), pids.tolist(), sectors.tolist(),
+                                            writes.tolist()):
+            yield i / rate, BlockRecord(pid, sector, 4096, is_write)
+
+def run(options):
+    random.seed(options.seed)
+    capacities = options.capacities
+    btier = SimulatedBtier(capacities, options.latencies, options.bandwidths, options.migration_interval,
+                           options.max_age, not options.no_auto_migration)
+    policy = POLICIES[options.policy](TierLayout(capacities), lambda: btier.now)
+    handler = HintHandler(btier_control=btier, workers=ImmediateWorkers(), placement_policy=policy,
+                          max_migrations_per_sec=options.max_migrations_per_sec)
+    handler.block_stats.resize(btier.block_count)
+
+    def update_block_stats(blocknr, tier):
+        # btier's stats, as the handler would see them after a sweep
+        handler.block_stats.update(blocknr, BlockInfo(int(tier), 0, 0, 0, 0))
+
+    btier.on_change = update_block_stats
+    if options.trace_file:
+        records = ReplayTraceSource(options.trace_file).records()
+    else:
+        records = synthetic_records(options.synthetic, options.synthetic_rate, options.seed)
+
+    start = time.perf_counter()
+    asyncio.run(simulate(records, btier, handler, HintGenerator(read_hints=options.hint_reads, clock=lambda: btier.now),
+                         options.max_migrations_per_sec))
+    elapsed = time.perf_counter() - start
+    report = btier.report()
+    report.update(policy=options.policy, hint_reads=options.hint_reads, trace_seconds=round(btier.now, 1),
+                  elapsed=round(elapsed, 2), ios_per_sec=round(report['ios'] / elapsed))
+    return report
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace_file', nargs='?', help="Trace to simulate, as recorded by the hint generator's --record")
+    parser.add_argument('--synthetic', type=int, default=1000000, help='Without a trace file, simulate this many synthetic zipf distributed I/Os (default: 1000000)')
+    parser.add_argument('--synthetic-rate', type=float, default=1000, help='I/Os per second of the synthetic workload (default: 1000)')
+    parser.add_argument('--policy', type=str, default='heat', choices=sorted(POLICIES), help='Placement policy of the handler (default: heat)')
+    parser.add_argument('--hint-reads', action='store_true', help="Run the generator with read_hints, so the handler's placement policy sees reads too (see the generator's --read-hints)")
+    parser.add_argument('--capacities', type=int_list, default=DEFAULT_CAPACITIES, help=f"Tier capacities in 1M blocks, fastest first (default: {','.join(map(str, DEFAULT_CAPACITIES))})")
+    parser.add_argument('--latencies', type=int_list, default=DEFAULT_LATENCIES, help=f"Per I/O latency of each tier in microseconds (default: {','.join(map(str, DEFAULT_LATENCIES))})")
+    parser.add_argument('--bandwidths', type=int_list, default=DEFAULT_BANDWIDTHS, help=f"Bandwidth of each tier in MB/sec (default: {','.join(map(str, DEFAULT_BANDWIDTHS))})")
+    parser.add_argument('--max-migrations-per-sec', type=float, default=DEFAULT_MAX_MIGRATIONS_PER_SEC, help=f"The handler's migration budget (default: {DEFAULT_MAX_MIGRATIONS_PER_SEC})")
+    parser.add_argument('--migration-interval', type=float, default=BTIER_MIGRATION_INTERVAL, help=f"Seconds between btier's auto migration passes (default: {BTIER_MIGRATION_INTERVAL})")
+    parser.add_argument('--max-age', type=float, default=BTIER_MAX_AGE, help=f"Seconds without access before btier demotes a block (default: {BTIER_MAX_AGE})")
+    parser.add_argument('--no-auto-migration', action='store_true', help="Don't model btier's auto migration")
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic workload and of the policy (default: 42)')
+    options = parser.parse_args()
+    if not len(options.capacities) == len(options.latencies) == len(options.bandwidths):
+        parser.error('--capacities, --latencies and --bandwidths should have an entry per tier')
+    return options
+
+if __name__ == '__main__':
+    print(json.dumps(run(parse_args()), indent=2))
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""
+Read a post cache trace where most I/O is to a local disk, with and without a TraceFilter for the LUN, and check
+how well the weights of the records an AdaptiveSampler keeps at every level add up to the records it saw.
+"""
+import sys
+import os
+import time
+import struct
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from hint_sources import PostCacheTraceSource
+from hint_generator import is_write_path
+from trace_filter import MAX_SAMPLE_LEVEL, TraceFilter, AdaptiveSampler
+
+DEFAULT_RECORD_COUNT = 200000
+LUN_DEVICE = (8, 16)
+LOCAL_DEVICE = (8, 0)
+# One in LUN_SHARE records is of the LUN
+LUN_SHARE = 10
+STREAMS = 1000
+
+def write_trace(trace_file, record_count):
+    record_struct = struct.Struct(PostCacheTraceSource._unpack_format)
+    for i in range(record_count):
+        major, minor = LUN_DEVICE if i % LUN_SHARE == 0 else LOCAL_DEVICE
+        # Busier streams have lower numbers
+        stream = int(STREAMS * (i * 7919 % record_count / record_count) ** 2)
+        trace_file.write(record_struct.pack(1000 + stream % 97, major, minor, stream, i * 4096, 4096, False,
+                                            i % 50 == 0))
+    trace_file.flush()
+
+def read_trace(trace_path, record_filter=None):
+    """
+    Read the whole trace, making record objects as they would be queued. Returns them all.
+    """
+    source = PostCacheTraceSource(trace_path, record_filter=record_filter)
+    records = []
+    while True:
+        batch = source.read_records()
+        if batch is None:
+            return records
+        records.extend(batch)
+
+def benchmark_filter(trace_path, record_count):
+    for name, record_filter in [("unfiltered", None), ("LUN only", TraceFilter(devices=[LUN_DEVICE]))]:
+        start = time.perf_counter()
+        records = read_trace(trace_path, record_filter)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {record_count / elapsed:8.0f} records/sec read, {len(records)} kept")
+
+def benchmark_sampler(trace_path, record_count):
+    records = read_trace(trace_path)
+    for level in range(MAX_SAMPLE_LEVEL + 1):
+        sampler = AdaptiveSampler(PostCacheTraceSource.type, is_write_path, watermark=0, max_level=level,
+                                  adjust_interval=0)
+        for i in range(level):
+            sampler.adjust(1)
+        for record in records:
+            record.weight = 1
+        kept = [record for record in records if sampler.sample(record)]
+        estimate = sum(record.weight for record in kept)
+        print(f"level {level}: {len(kept):6} kept, weighing {estimate} ({estimate / len(records) - 1:+.1%})")
+
+if __name__ == '__main__':
+    try:
+        record_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORD_COUNT
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} [RECORD_COUNT]")
+        print(f"Read RECORD_COUNT post cache records (default: {DEFAULT_RECORD_COUNT}), one in {LUN_SHARE} of them "
+              "of the LUN, with and without filtering, and sample them at every level")
+        sys.exit(1)
+
+    with tempfile.NamedTemporaryFile() as trace_file:
+        write_trace(trace_file, record_count)
+        print(f"Reading {record_count} records from {trace_file.name}")
+        benchmark_filter(trace_file.name, record_count)
+        benchmark_sampler(trace_file.name, record_count)
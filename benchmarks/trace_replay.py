@@ -0,0 +1,97 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import random
+import asyncio
+import hashlib
+import tempfile
+from queue import SimpleQueue
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_receiver'))
+from trace_replay import TraceRecorder, ReplayTraceSource
+from trace_records import FileRecord, PostCacheRecord, BlockRecord
+from hint_generator import HintGenerator
+from hint_handler import HintHandler
+from btier_control import FakeBtierControl
+
+DEFAULT_RECORD_COUNT = 100000
+SEED = 42
+INODES = 100
+PIDS = 16
+
+def record_synthetic_trace(path, rng, record_count):
+    """
+    Record a made up workload: processes reading files sequentially, and writes going through writeback
+    """
+    recorder = TraceRecorder(path, SimpleQueue())
+    file_offsets = [0] * INODES
+    while recorder.records < record_count:
+        pid = rng.randrange(PIDS)
+        inode = rng.randrange(INODES)
+        sector = inode * (1 << 20) + file_offsets[inode] // 512
+        size = rng.choice([4096, 16384, 65536])
+        is_write = rng.random() < 0.3
+        offset = file_offsets[inode]
+        recorder.record(FileRecord(pid, 8, 16, inode, offset, size, is_write))
+        recorder.record(PostCacheRecord(pid, 8, 16, inode, offset, size, not is_write and rng.random() < 0.5,
+                                        is_write))
+        recorder.record(BlockRecord(pid, sector, size, is_write))
+        file_offsets[inode] += size
+    recorder.close()
+
+async def replay(path, handler):
+    source = ReplayTraceSource(path, speed=0)
+    generator = HintGenerator(clock=source.clock)
+    digest = hashlib.sha1()
+    hint_count = 0
+
+    async def handle_record(record):
+        nonlocal hint_count
+        hint = await generator.handle_trace_record(record)
+        if hint:
+            hint_count += 1
+            # timestamps are of the replay, not of the recording
+            digest.update(repr({key: value for key, value in hint.to_dict().items() if key != 'timestamp'}).encode())
+            await handler.handle_hint(hint)
+
+    await source.replay(handle_record)
+    handler.flush_injections()
+    await handler.workers.wait_for_injections()
+    return hint_count, digest.hexdigest()
+
+def run(trace_path, control_path):
+    control = FakeBtierControl(control_path)
+    handler = HintHandler(btier_control=control, inject_batch_size=32)
+    start = time.perf_counter()
+    hint_count, digest = asyncio.run(replay(trace_path, handler))
+    elapsed = time.perf_counter() - start
+    handler.workers.shutdown()
+    control.close()
+    return elapsed, hint_count, digest
+
+def benchmark(trace_path, tmpdir):
+    record_count = sum(1 for record in ReplayTraceSource(trace_path).records())
+    results = [run(trace_path, os.path.join(tmpdir, f'tiercontrol-{i}')) for i in range(2)]
+    for elapsed, hint_count, digest in results:
+        print(f"{record_count / elapsed:.0f} records/sec, {hint_count} hints, digest {digest[:12]}")
+    print("replays match" if len(set(result[1:] for result in results)) == 1 else "REPLAYS DIFFER")
+
+if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+    if not os.path.exists(sys.argv[1]):
+        print(f"Usage: {sys.argv[0]} [RECORD_COUNT | TRACE_FILE]")
+        print(f"Replay RECORD_COUNT synthetic trace records (default: {DEFAULT_RECORD_COUNT}), or TRACE_FILE as recorded "
+              "by the hint generator's --record, through HintGenerator and HintHandler twice, as fast as possible")
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        benchmark(sys.argv[1], tmpdir)
+    sys.exit(0)
+
+record_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORD_COUNT
+with tempfile.TemporaryDirectory() as tmpdir:
+    trace_path = os.path.join(tmpdir, 'trace')
+    record_synthetic_trace(trace_path, random.Random(SEED), record_count)
+    benchmark(trace_path, tmpdir)
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import struct
+import asyncio
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from hint_sources import FileTraceSource
+
+DEFAULT_RECORD_COUNT = 200000
+
+async def drain_per_record(source, queue, record_count):
+    """
+    The old read path: one executor hop and one decode per record
+    """
+    loop = asyncio.get_event_loop()
+    for i in range(record_count):
+        record = await loop.run_in_executor(None, source.read_record)
+        await queue.put(record)
+        queue.get_nowait()
+
+async def drain_batched(source, queue, record_count):
+    """
+    The bulk read path: one executor hop and one decode pass per batch
+    """
+    loop = asyncio.get_event_loop()
+    read = 0
+    while read < record_count:
+        records = await loop.run_in_executor(None, source.read_records)
+        for record in records:
+            await queue.put(record)
+            queue.get_nowait()
+        read += len(records)
+
+def run(trace_path, record_count, drain):
+    source = FileTraceSource(trace_path)
+    queue = asyncio.Queue(maxsize=1000)
+    start = time.perf_counter()
+    asyncio.run(drain(source, queue, record_count))
+    elapsed = time.perf_counter() - start
+    return record_count / elapsed
+
+try:
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORD_COUNT
+except ValueError:
+    print(f"Usage: {sys.argv[0]} [RECORD_COUNT]")
+    print(f"Decode RECORD_COUNT file trace records (default: {DEFAULT_RECORD_COUNT}) using the per-record and batched read paths")
+    sys.exit(1)
+
+with tempfile.NamedTemporaryFile() as trace_file:
+    record_struct = struct.Struct(FileTraceSource._unpack_format)
+    for i in range(record_count):
+        trace_file.write(record_struct.pack(1000 + i % 7, 8, 16, i % 1000, i * 4096, 4096, i % 2))
+    trace_file.flush()
+
+    print(f"Decoding {record_count} records from {trace_file.name}")
+    per_record = run(trace_file.name, record_count, drain_per_record)
+    print(f"per-record: {per_record:.0f} records/sec")
+    batched = run(trace_file.name, record_count, drain_batched)
+    print(f"batched:    {batched:.0f} records/sec ({batched / per_record:.1f}x)")
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+import sys
+import os
+import time
+import struct
+import asyncio
+import tempfile
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(BASE_DIR, 'common'))
+sys.path.insert(0, os.path.join(BASE_DIR, 'hint_generator'))
+from hint_sources import FileTraceSource
+
+DEFAULT_SAMPLES = 50
+IDLE_TIME = 0.05
+
+async def measure(fifo_path, samples, polled):
+    """
+    Write a record into the fifo after an idle period and measure how long it takes to reach the queue.
+    Returns the wake-up latencies and the CPU time used while idle.
+    """
+    writer = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+    source = FileTraceSource(fifo_path)
+    if not polled:
+        source._can_poll = lambda loop: False
+    record = struct.pack(FileTraceSource._unpack_format, 1, 8, 16, 2, 0, 4096, True)
+    queue = asyncio.Queue()
+    reader = asyncio.ensure_future(source.async_read_into(queue))
+
+    latencies = []
+    idle_cpu = 0
+    for i in range(samples):
+        cpu_start = time.process_time()
+        await asyncio.sleep(IDLE_TIME)
+        idle_cpu += time.process_time() - cpu_start
+        write_time = time.perf_counter()
+        os.write(writer, record)
+        await queue.get()
+        latencies.append(time.perf_counter() - write_time)
+
+    reader.cancel()
+    try:
+        await reader
+    except asyncio.CancelledError:
+        pass
+    os.close(writer)
+    return latencies, idle_cpu
+
+async def measure_blocked(fifo_path):
+    """
+    Keep a record pending in the fifo while the source is blocked on a full queue, and measure the CPU time used
+    """
+    writer = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+    source = FileTraceSource(fifo_path)
+    record = struct.pack(FileTraceSource._unpack_format, 1, 8, 16, 2, 0, 4096, True)
+    queue = asyncio.Queue(maxsize=1)
+    reader = asyncio.ensure_future(source.async_read_into(queue))
+    # One record fills the queue and the next blocks the source, then another one stays pending in the fifo
+    os.write(writer, record * 2)
+    await asyncio.sleep(IDLE_TIME)
+    os.write(writer, record)
+    cpu_start = time.process_time()
+    await asyncio.sleep(IDLE_TIME * 10)
+    blocked_cpu = time.process_time() - cpu_start
+    reader.cancel()
+    try:
+        await reader
+    except asyncio.CancelledError:
+        pass
+    os.close(writer)
+    return blocked_cpu
+
+def report(name, latencies, idle_cpu):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    print(f"{name}: wake-up latency p50={p50:.0f}us p99={p99:.0f}us, idle CPU {idle_cpu * 1e3:.1f}ms")
+
+try:
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLES
+except ValueError:
+    print(f"Usage: {sys.argv[0]} [SAMPLES]")
+    print(f"Measure trace source wake-up latency after {IDLE_TIME}s idle periods (default: {DEFAULT_SAMPLES} samples)")
+    sys.exit(1)
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    fifo_path = os.path.join(tmpdir, 'file_trace')
+    os.mkfifo(fifo_path)
+    report("readiness", *asyncio.run(measure(fifo_path, samples, polled=True)))
+    report("backoff  ", *asyncio.run(measure(fifo_path, samples, polled=False)))
+    blocked_cpu = asyncio.run(measure_blocked(fifo_path))
+    print(f"blocked on a full queue for {IDLE_TIME * 10}s with data pending: CPU {blocked_cpu * 1e3:.1f}ms")
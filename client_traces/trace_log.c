@@ -3,6 +3,8 @@
 #include <linux/slab.h>
 #include <linux/uaccess.h>
 #include <linux/spinlock.h>
+#include <linux/wait.h>
+#include <linux/poll.h>
 
 #include "trace_log.h"
 
@@ -16,13 +18,16 @@ struct trace_log {
     char* device_name;
     int dev_major;
     spinlock_t lock;
+    wait_queue_head_t readers_wait;
 };
 
 static int logger_open(struct inode*, struct file*);
 static ssize_t logger_read(struct file*, char*, size_t, loff_t*);
+static unsigned int logger_poll(struct file*, poll_table*);
 static int logger_release(struct inode*, struct file*);
 static struct file_operations log_fops = {
     .read = logger_read,
+    .poll = logger_poll,
     .open = logger_open,
     .release = logger_release
 };
@@ -34,6 +39,7 @@ int log_init(unsigned int entry_size, unsigned int entry_count, char* device_nam
     log.entry_size = entry_size;
     log.entries = kmalloc(entry_size * entry_count, GFP_KERNEL);
     spin_lock_init(&log.lock);
+    init_waitqueue_head(&log.readers_wait);
     log.dev_major = register_chrdev(0, device_name, &log_fops);
     log.device_name = device_name;
     if (!log.entries || log.dev_major == -1) {
@@ -82,6 +88,9 @@ void log_write_entry(void* data) {
     log_increment_write_head();
     memcpy(log_entry, data, log.entry_size);
     spin_unlock_bh(&log.lock);
+    // Wake up readers waiting in poll/select/epoll. Unconditionally: checking waitqueue_active() first needs a full
+    // barrier to not miss a reader that's just going to sleep (see the comment above it in linux/wait.h)
+    wake_up_interruptible(&log.readers_wait);
 }
 
 static int logger_open(struct inode* in, struct file* fd) {
@@ -98,6 +107,16 @@ static char* _logger_read(char *buffer, size_t count) {
     return buffer + count * log.entry_size;
 }
 
+static unsigned int logger_poll(struct file *fd, poll_table *wait) {
+    unsigned int mask = 0;
+    poll_wait(fd, &log.readers_wait, wait);
+    spin_lock_bh(&log.lock);
+    if (log_entries_count() > 0)
+        mask |= POLLIN | POLLRDNORM;
+    spin_unlock_bh(&log.lock);
+    return mask;
+}
+
 static ssize_t logger_read(struct file *fd, char *buffer, size_t byte_count, loff_t *offset) {
     size_t first_read_size, second_read_size;
     size_t count = byte_count / log.entry_size;
@@ -0,0 +1,191 @@
+"""
+Compaction of advisory hints into extents.
+
+Sequential workloads produce runs of hints for adjacent or overlapping ranges, e.g. a prefetch hint for every read of
+a stream, each reaching a bit further ahead. The generator's HintCompactor holds such hints for a short window and
+merges them, so that what's sent is one hint per extent.
+
+The receiver doesn't compact hints. btier migrates one 1M block at a time, and the receiver's MigrationScheduler
+already requests a block only once while it's pending, so merged hints come down to the very same migrations (see
+benchmarks/hint_compaction.py), only later.
+
+Match hints hold a write in btier and are never held. Null hints aren't compacted either: every one of them is an
+access that the placement policy counts.
+"""
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+
+from hint_types import SECTOR_SIZE, HINT_NONE, HINT_FILE_PREFETCH, Hint
+from metrics import counter
+
+COMPACTION_WINDOW = 0.005
+MAX_PENDING_EXTENTS = 1024
+
+def is_compactable(hint):
+    """
+    Whether the hint can be held and merged with others
+    """
+    return not hint.match and hint.hint_type != HINT_NONE
+
+def extent_key(hint):
+    """
+    Hints are only merged with hints of the same key: the same type and, for file hints, the same file
+    """
+    if hint.hint_type == HINT_FILE_PREFETCH:
+        return (hint.hint_type, (hint.hint_data or {}).get('inode'))
+    return (hint.hint_type, None)
+
+def extent_unit(hint_type):
+    """
+    Bytes per offset unit: file hints are in bytes, block hints in sectors (see hint_types)
+    """
+    return 1 if hint_type == HINT_FILE_PREFETCH else SECTOR_SIZE
+
+class ExtentSet:
+    """
+    Sorted, disjoint extents [start, end), each with the latest hint that went into it, and the oldest timestamp of
+    the hints that went into it (0 if none had one).
+
+    Adding an extent merges it with every extent it overlaps or touches.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.hints = []
+        self.timestamps = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end, hint, timestamp=0):
+        """
+        Add an extent. Returns True if it was already covered by a single extent, i.e. it's superseded.
+        """
+        # The first extent that ends at or after start, and the first that starts after end
+        first = bisect_left(self.ends, start)
+        last = bisect_right(self.starts, end)
+        if first == last:
+            self.starts.insert(first, start)
+            self.ends.insert(first, end)
+            self.hints.insert(first, hint)
+            self.timestamps.insert(first, timestamp)
+            return False
+        covered = last - first == 1 and self.starts[first] <= start and end <= self.ends[first]
+        start = min(start, self.starts[first])
+        end = max(end, self.ends[last - 1])
+        timestamps = [t for t in self.timestamps[first:last] + [timestamp] if t]
+        timestamp = min(timestamps) if timestamps else 0
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        self.hints[first:last] = [hint]
+        self.timestamps[first:last] = [timestamp]
+        return covered
+
+class HintCompactor:
+    """
+    Sits in front of handle_hint (an asyncio coroutine) and passes hints on to it, merging compactable hints (see
+    is_compactable()) of the same key (see extent_key()) whose ranges overlap or touch.
+
+    A compactable hint is held for at most window seconds, and all held hints are passed on once max_extents extents
+    are pending. A merged hint has the type and hint_data of the latest hint that went into it, and the timestamp of
+    the oldest one. Other hints are passed on right away.
+
+    The window is timed on the event loop, unless a clock (returning seconds) is given, e.g. a replay's (see
+    ReplayTraceSource). Then held hints are passed on once a hint arrives window seconds of that clock after the first
+    of them was held, and whatever is held at the end should be passed on with flush().
+
+    close() passes on whatever is held when shutting down.
+
+    Metrics are kept under {name}.*: hints_in and hints_out count the compactable hints, and superseded those that
+    were already covered by a held extent.
+    """
+    def __init__(self, handle_hint, window=COMPACTION_WINDOW, max_extents=MAX_PENDING_EXTENTS, name='compactor',
+                 clock=None):
+        self._handle_hint = handle_hint
+        self.window = window
+        self.max_extents = max_extents
+        self.clock = clock
+        self._extents = {}
+        self._pending = 0
+        self._flush_handle = None
+        # Flushes started by the window timer that are still running
+        self._flush_tasks = set()
+        # When the oldest held hint was held, by clock
+        self._held_since = None
+        self._logger = logging.getLogger('hint_compaction')
+        self._hints_in = counter(f'{name}.hints_in')
+        self._hints_out = counter(f'{name}.hints_out')
+        self._superseded = counter(f'{name}.superseded')
+
+    async def handle_hint(self, hint):
+        """
+        Pass a hint on, or hold it for merging
+
+        This is an asyncio coroutine
+        """
+        if self.clock and self._held_since is not None and self.clock() - self._held_since >= self.window:
+            await self.flush()
+        if not is_compactable(hint):
+            await self._handle_hint(hint)
+            return
+        self._hints_in.inc()
+        key = extent_key(hint)
+        extents = self._extents.get(key)
+        if extents is None:
+            extents = self._extents[key] = ExtentSet()
+        unit = extent_unit(hint.hint_type)
+        start = hint.offset
+        end = start + (max(hint.size, 1) + unit - 1) // unit
+        count = len(extents)
+        if extents.add(start, end, hint, hint.timestamp):
+            self._superseded.inc()
+        self._pending += len(extents) - count
+        if self._pending >= self.max_extents:
+            await self.flush()
+        elif self.clock:
+            if self._held_since is None:
+                self._held_since = self.clock()
+        elif not self._flush_handle:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.window, self._flush_soon)
+
+    def _flush_soon(self):
+        self._flush_handle = None
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def close(self):
+        """
+        Wait for running flushes, then pass on whatever is still held
+
+        This is an asyncio coroutine
+        """
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Pass on all the held hints, in offset order
+
+        This is an asyncio coroutine
+        """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        extents, self._extents = self._extents, {}
+        self._pending = 0
+        self._held_since = None
+        for key, extent_set in extents.items():
+            unit = extent_unit(key[0])
+            for start, end, hint, timestamp in zip(extent_set.starts, extent_set.ends, extent_set.hints,
+                                                   extent_set.timestamps):
+                merged = Hint(hint.hint_type, start, (end - start) * unit, hint.hint_data, hint.match, timestamp)
+                self._hints_out.inc()
+                try:
+                    await self._handle_hint(merged)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self._logger.exception('Error handling compacted hint, skipping')
@@ -0,0 +1,187 @@
+"""
+Wire protocol between the hint generator (HintClient) and the hint receiver (TCPHintReceiver).
+
+A connection starts in json mode: every message is a json-encoded hint on its own line.
+A client that wants the binary protocol sends HELLO first. A receiver that supports it answers with the same line,
+and from then on the client sends frames. If the receiver doesn't answer, the client stays in json mode, which is
+also handy for debugging with netcat.
+
+Binary frames pack several hints together. All fields are little endian:
+    * frame header: payload length (uint32), hint count (uint16)
+    * per hint: offset (int64), size (uint64), hint_type (int32), flags (uint8), timestamp (int64), hint_data length
+      (uint16), followed by hint_data encoded as json. A zero length means hint_data is missing, and a zero timestamp
+      means there's no timestamp (see metrics).
+
+Clients on the receiver's host can ask for the shm protocol instead, over a UNIX socket (see UnixHintReceiver). The
+client creates a shared memory ring of SHM_SLOT sized slots (see ShmSlotRing) and a doorbell (see Doorbell), and sends
+SHM_HELLO, then the ring's name and the doorbell's path, each after a space, on a line. A receiver that attached to
+both answers with SHM_HELLO on a line. From then on the client writes hints into the ring, one per slot, rather than
+to the socket, and rings the doorbell after every batch of them, to wake up the receiver. A receiver that doesn't
+answer may have taken the line for a bad json message and stayed in json mode, so the client reconnects and carries on
+with HELLO as above.
+
+Slots are fixed size, with no json, so a batch of them is encoded and decoded with a struct call per hint. All fields
+are little endian: offset (int64), size (uint64), hint_type (int32), flags (uint8), pattern and access_class (uint8,
+1 + their index in PATTERNS and ACCESS_CLASSES, 0 if missing), a padding byte, timestamp (int64), pid and weight
+(uint32, a zero weight if missing), inode (uint64), file_offset (int64), and padding up to 64 bytes. Besides
+FLAG_MATCH, flags say whether pid, inode and file_offset are there. That's all the hint_data keys hint_types knows
+of: any others are dropped.
+
+In binary and shm mode the receiver acknowledges match hints: after every frame (or in shm mode, every batch of slots)
+that had any, it sends the number of match hints it got on this connection so far (uint64). The client uses this to
+replay unacknowledged match hints after a reconnect.
+
+The offset/size part mirrors the layout btier expects in TIER_HINTINJECT (see HINT_ENTRY in hint_receiver/btier_control.py).
+"""
+import json
+import struct
+import asyncio
+
+from hint_types import Hint, PATTERNS, ACCESS_CLASSES
+
+PROTOCOL_VERSION = 3
+# The shm protocol went its own way when its ring changed from frames to slots
+SHM_PROTOCOL_VERSION = 4
+HELLO = 'HINTPROTO binary {}\n'.format(PROTOCOL_VERSION).encode()
+SHM_HELLO = 'HINTPROTO shm {}'.format(SHM_PROTOCOL_VERSION).encode()
+PROTOCOLS = ['binary', 'json', 'shm']
+
+FRAME_HEADER = struct.Struct('<IH')
+HINT_HEADER = struct.Struct('<qQiBqH')
+MATCH_ACK = struct.Struct('<Q')
+MAX_FRAME_HINTS = 0xFFFF
+SHM_SLOT = struct.Struct('<qQiBBBxqIIQq8x')
+
+FLAG_MATCH = 0x1
+FLAG_PID = 0x2
+FLAG_INODE = 0x4
+FLAG_FILE_OFFSET = 0x8
+
+# hint_data strings to their codes in slots, and back
+PATTERN_CODES = {pattern: code for code, pattern in enumerate(PATTERNS, 1)}
+ACCESS_CLASS_CODES = {access_class: code for code, access_class in enumerate(ACCESS_CLASSES, 1)}
+SLOT_PATTERNS = [None] + PATTERNS
+SLOT_ACCESS_CLASSES = [None] + ACCESS_CLASSES
+
+def encode_json(hint):
+    """
+    Encode a hint as a json line
+    """
+    return (json.dumps(hint.to_dict()) + "\n").encode()
+
+def decode_json(line):
+    """
+    Decode a json line into a hint. Raises ValueError on bad input.
+    """
+    return Hint.from_dict(json.loads(line.decode().strip()))
+
+def encode_hint(hint):
+    """
+    Encode a single hint into its binary representation, to be put into a frame by encode_frame()
+    """
+    hint_data = hint.hint_data
+    encoded_data = json.dumps(hint_data).encode() if hint_data is not None else b''
+    flags = FLAG_MATCH if hint.match else 0
+    return HINT_HEADER.pack(hint.offset, hint.size, hint.hint_type, flags, hint.timestamp,
+                            len(encoded_data)) + encoded_data
+
+def encode_frame(encoded_hints):
+    """
+    Pack a list of hints encoded by encode_hint() into a single frame
+    """
+    if len(encoded_hints) > MAX_FRAME_HINTS:
+        raise ValueError(f"too many hints for one frame: {len(encoded_hints)}")
+    payload = b''.join(encoded_hints)
+    return FRAME_HEADER.pack(len(payload), len(encoded_hints)) + payload
+
+def decode_frame_payload(payload, hint_count):
+    """
+    Decode the payload of a frame into a list of hints. Raises ValueError on bad input.
+    """
+    hints = []
+    position = 0
+    payload = memoryview(payload)
+    try:
+        for i in range(hint_count):
+            offset, size, hint_type, flags, timestamp, data_length = HINT_HEADER.unpack_from(payload, position)
+            position += HINT_HEADER.size
+            hint_data = None
+            if data_length:
+                hint_data = json.loads(bytes(payload[position:position + data_length]))
+                position += data_length
+            hints.append(Hint(hint_type, offset, size, hint_data, bool(flags & FLAG_MATCH), timestamp))
+    except struct.error as e:
+        raise ValueError(f"truncated frame: {e}")
+    if position != len(payload):
+        raise ValueError(f"frame has {len(payload) - position} trailing bytes")
+    return hints
+
+def encode_slot(hint):
+    """
+    Encode a hint into a shm ring slot. Raises ValueError if a hint_data value doesn't fit its field.
+    """
+    flags = FLAG_MATCH if hint.match else 0
+    hint_data = hint.hint_data
+    if not hint_data:
+        return SHM_SLOT.pack(hint.offset, hint.size, hint.hint_type, flags, 0, 0, hint.timestamp, 0, 0, 0, 0)
+    pid = hint_data.get('pid')
+    inode = hint_data.get('inode')
+    file_offset = hint_data.get('file_offset')
+    if pid is not None:
+        flags |= FLAG_PID
+    if inode is not None:
+        flags |= FLAG_INODE
+    if file_offset is not None:
+        flags |= FLAG_FILE_OFFSET
+    try:
+        return SHM_SLOT.pack(hint.offset, hint.size, hint.hint_type, flags,
+                             PATTERN_CODES.get(hint_data.get('pattern'), 0),
+                             ACCESS_CLASS_CODES.get(hint_data.get('access_class'), 0), hint.timestamp, pid or 0,
+                             hint_data.get('weight', 0), inode or 0, file_offset or 0)
+    except struct.error as e:
+        raise ValueError(f"can't fit {hint} into a slot: {e}")
+
+def decode_slots(slots):
+    """
+    Decode slots read from a shm ring into a list of hints. Raises ValueError on bad input.
+    """
+    hints = []
+    try:
+        for (offset, size, hint_type, flags, pattern, access_class, timestamp, pid, weight, inode,
+             file_offset) in SHM_SLOT.iter_unpack(slots):
+            hint_data = None
+            if flags & ~FLAG_MATCH or pattern or access_class or weight:
+                hint_data = {}
+                if pattern:
+                    hint_data['pattern'] = SLOT_PATTERNS[pattern]
+                if flags & FLAG_PID:
+                    hint_data['pid'] = pid
+                if flags & FLAG_INODE:
+                    hint_data['inode'] = inode
+                if flags & FLAG_FILE_OFFSET:
+                    hint_data['file_offset'] = file_offset
+                if access_class:
+                    hint_data['access_class'] = SLOT_ACCESS_CLASSES[access_class]
+                if weight:
+                    hint_data['weight'] = weight
+            hints.append(Hint(hint_type, offset, size, hint_data, bool(flags & FLAG_MATCH), timestamp))
+    except struct.error as e:
+        raise ValueError(f"truncated slots: {e}")
+    except IndexError:
+        raise ValueError(f"bad pattern or access class code in slot: {pattern}, {access_class}")
+    return hints
+
+async def read_frame(reader):
+    """
+    Read one frame from an asyncio stream reader and decode it.
+    Returns a list of hints, or None if the stream ended.
+
+    This is an asyncio coroutine
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        payload_length, hint_count = FRAME_HEADER.unpack(header)
+        payload = await reader.readexactly(payload_length)
+    except asyncio.IncompleteReadError:
+        return None
+    return decode_frame_payload(payload, hint_count)
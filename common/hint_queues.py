@@ -0,0 +1,218 @@
+"""
+Queues for the generator and receiver pipelines.
+
+Match hints (and the block write records that produce them) hold a pending write request in btier, so they get their
+own fast lane and consumer, instead of waiting behind advisory traffic in a single FIFO (see PriorityLanes).
+
+When many producers feed one consumer, each gets a bounded lane of its own, drained in weighted round-robin (see
+FairFanIn), so one busy producer can't starve the others, and a producer that's too fast blocks on its own lane.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+
+STATS_INTERVAL = 10
+LANE_SIZE = 1000
+
+logger = logging.getLogger('queues')
+
+class DelayStats:
+    """
+    Aggregated queueing delay of items, in seconds
+    """
+    def __init__(self):
+        self.reset()
+
+    def add(self, delay):
+        self.count += 1
+        self.total += delay
+        if delay > self.max:
+            self.max = delay
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __str__(self):
+        average = self.total / self.count if self.count else 0
+        return "{} items, avg delay {:.3f}ms, max delay {:.3f}ms".format(self.count, average * 1e3, self.max * 1e3)
+
+class TimedQueue(asyncio.Queue):
+    """
+    An asyncio queue that measures how long items wait in it. See self.delay
+    """
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.delay = DelayStats()
+
+    def _put(self, item):
+        super()._put((time.monotonic(), item))
+
+    def _get(self):
+        put_time, item = super()._get()
+        self.delay.add(time.monotonic() - put_time)
+        return item
+
+class PriorityLanes:
+    """
+    Routes items into a fast lane or a slow lane queue, according to is_urgent(item).
+
+    Producers can use it in place of an asyncio queue (put/put_nowait/qsize). Each lane should have its own consumer,
+    so urgent items never wait behind the slow lane.
+
+    With a shedder (see LoadShedder), items that don't fit in a full slow lane are dropped if it says so, instead of
+    blocking the producer.
+    """
+    def __init__(self, is_urgent, fast, slow, shedder=None):
+        self.is_urgent = is_urgent
+        self.fast = fast
+        self.slow = slow
+        self.shedder = shedder
+
+    async def put(self, item):
+        if self.is_urgent(item):
+            await self.fast.put(item)
+        elif not (self.shedder and self.slow.full() and self.shedder.shed_full(item)):
+            await self.slow.put(item)
+
+    def put_nowait(self, item):
+        if self.is_urgent(item):
+            self.fast.put_nowait(item)
+        elif not (self.shedder and self.slow.full() and self.shedder.shed_full(item)):
+            self.slow.put_nowait(item)
+
+    def qsize(self):
+        return self.fast.qsize() + self.slow.qsize()
+
+class FanInLane(TimedQueue):
+    """
+    A producer's lane in a FairFanIn. Producers use it like an asyncio queue, and block once it's full.
+    """
+    def __init__(self, fan_in, name, weight, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.weight = weight
+        # Items served in the current round
+        self.served = 0
+        self.active = False
+        self._fan_in = fan_in
+        # Delays are reported for the whole fan-in
+        self.delay = fan_in.delay
+
+    def _put(self, item):
+        super()._put(item)
+        self._fan_in._activate(self)
+
+class FairFanIn:
+    """
+    Merges the lanes of many producers (see add_lane()) into one queue-like consumer end (get/get_nowait/qsize).
+
+    Lanes that have items are served in round-robin, weight items at a time, so a lane of weight 2 gets twice the
+    share of one of weight 1 when both are busy. An idle lane takes no turns.
+    """
+    def __init__(self, lane_size=LANE_SIZE):
+        self.lane_size = lane_size
+        self.delay = DelayStats()
+        self.lanes = set()
+        self._active = deque()
+        self._getters = deque()
+
+    def add_lane(self, name, weight=1):
+        """
+        Return a new lane, for a producer called name
+        """
+        lane = FanInLane(self, name, weight, self.lane_size)
+        self.lanes.add(lane)
+        return lane
+
+    def remove_lane(self, lane):
+        """
+        Forget a lane once its producer is gone. Items left in it are still served.
+        """
+        self.lanes.discard(lane)
+
+    def _activate(self, lane):
+        if not lane.active:
+            lane.active = True
+            self._active.append(lane)
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def get_nowait(self):
+        if not self._active:
+            raise asyncio.QueueEmpty
+        lane = self._active[0]
+        item = lane.get_nowait()
+        lane.served += 1
+        if lane.empty():
+            self._active.popleft()
+            lane.active = False
+            lane.served = 0
+        elif lane.served >= lane.weight:
+            lane.served = 0
+            self._active.rotate(-1)
+        return item
+
+    async def get(self):
+        while not self._active:
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+        return self.get_nowait()
+
+    def task_done(self):
+        """
+        Like asyncio.Queue.task_done(), for consumers that call it. Nothing joins a fan-in, so it does nothing.
+        """
+
+    def qsize(self):
+        return sum(lane.qsize() for lane in self._active)
+
+class FairPriorityLanes:
+    """
+    Gives each producer its own PriorityLanes (see open()), whose fast and slow lanes are lanes of the fast and slow
+    FairFanIn. Each fan-in should have its own consumer, like with PriorityLanes.
+
+    shedder, if given, is passed on to every producer's PriorityLanes, so producers never block on their slow lane.
+    """
+    def __init__(self, is_urgent, fast, slow, shedder=None):
+        self.is_urgent = is_urgent
+        self.fast = fast
+        self.slow = slow
+        self.shedder = shedder
+
+    def open(self, name, weight=1):
+        """
+        Return the PriorityLanes for a new producer called name
+        """
+        return PriorityLanes(self.is_urgent, self.fast.add_lane(name, weight), self.slow.add_lane(name, weight),
+                             self.shedder)
+
+    def close(self, lanes):
+        """
+        Forget a producer's lanes, as returned by open()
+        """
+        self.fast.remove_lane(lanes.fast)
+        self.slow.remove_lane(lanes.slow)
+
+async def report_queue_delays(queues, interval=STATS_INTERVAL):
+    """
+    Periodically log the queueing delay and depth of each queue, and reset the delay stats.
+
+    queues - a dict of name to TimedQueue or FairFanIn
+    This is an asyncio coroutine
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for name, queue in queues.items():
+            logger.info("%s queue: %s, depth %d", name, queue.delay, queue.qsize())
+            queue.delay.reset()
@@ -0,0 +1,102 @@
+"""
+Hint types, and the hint_data that goes with each of them.
+
+Block hints have offset in sectors of the iSCSI LUN and size in bytes, like the block trace they come from.
+
+    * HINT_NONE - no extra knowledge. No hint_data. Block writes get one of these if there's nothing better to say,
+      since btier waits for a hint for every write.
+    * HINT_PREFETCH - the block range is expected to be read soon, so it should be on a fast tier.
+      hint_data: dict(pattern=one of PATTERNS, pid=...)
+    * HINT_FILE_PREFETCH - like HINT_PREFETCH, but offset and size are a byte range of a file, which the generator
+      couldn't map to blocks. hint_data: dict(pattern=one of PATTERNS, pid=..., inode=...). The receiver can't act
+      on these, so the generator doesn't send them; the type is kept for older generators.
+
+Block hints of any type may also carry the file access that caused them, if the generator could tell, as
+hint_data keys inode, file_offset and access_class (one of ACCESS_CLASSES). Those of sampled records (see
+hint_generator/trace_filter.py) carry the number of records theirs stands for as the hint_data key weight, see
+hint_weight().
+
+Hints travel through the pipeline as Hint objects, from the generator to the handler.
+"""
+HINT_NONE = 0
+HINT_PREFETCH = 1
+HINT_FILE_PREFETCH = 2
+
+# Block hint offsets are in sectors of this many bytes
+SECTOR_SIZE = 512
+
+PATTERN_SEQUENTIAL = 'sequential'
+PATTERN_STRIDED = 'strided'
+PATTERN_RANDOM = 'random'
+PATTERNS = [PATTERN_SEQUENTIAL, PATTERN_STRIDED, PATTERN_RANDOM]
+
+ACCESS_READ = 'read'
+ACCESS_READAHEAD = 'readahead'
+ACCESS_WRITE = 'write'
+ACCESS_CLASSES = [ACCESS_READ, ACCESS_READAHEAD, ACCESS_WRITE]
+
+class Hint:
+    """
+    A hint of hint_type (one of the above) for size bytes at offset.
+
+    hint_data is None for hints without it. match is set on the hints of block writes, which btier holds until their
+    hint arrives. timestamp is when the trace record the hint came from was read (see metrics), or 0 if that's unknown.
+    """
+    __slots__ = ['hint_type', 'offset', 'size', 'hint_data', 'match', 'timestamp']
+
+    def __init__(self, hint_type, offset, size, hint_data=None, match=False, timestamp=0):
+        self.hint_type = hint_type
+        self.offset = offset
+        self.size = size
+        self.hint_data = hint_data
+        self.match = match
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        """
+        The hint as a dict, e.g. for encoding as json. Missing parts are left out.
+        """
+        hint = dict(offset=self.offset, size=self.size, hint_type=self.hint_type)
+        if self.hint_data is not None:
+            hint['hint_data'] = self.hint_data
+        if self.match:
+            hint['match'] = True
+        if self.timestamp:
+            hint['timestamp'] = self.timestamp
+        return hint
+
+    @classmethod
+    def from_dict(cls, hint):
+        """
+        The opposite of to_dict(). Raises ValueError if hint isn't a dict or is missing offset, size or hint_type.
+        """
+        try:
+            return cls(hint['hint_type'], hint['offset'], hint['size'], hint.get('hint_data'),
+                       bool(hint.get('match')), hint.get('timestamp', 0))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"bad hint {hint!r}: {e!r}")
+
+    def __eq__(self, other):
+        if not isinstance(other, Hint):
+            return NotImplemented
+        return (self.hint_type, self.offset, self.size, self.hint_data, self.match, self.timestamp) == \
+               (other.hint_type, other.offset, other.size, other.hint_data, other.match, other.timestamp)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Hint({self.to_dict()})"
+
+def hint_weight(hint):
+    """
+    The number of accesses a hint stands for, 1 unless it came from a sampled record
+    """
+    if hint.hint_data is None:
+        return 1
+    return hint.hint_data.get('weight', 1)
+
+def make_hint(hint_type, offset, size, **hint_data):
+    """
+    Build a Hint of the given type. Keyword arguments become its hint_data.
+    """
+    return Hint(hint_type, offset, size, hint_data or None)
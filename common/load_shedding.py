@@ -0,0 +1,67 @@
+"""
+Load shedding of advisory work.
+
+Match hints, and the block write records that produce them, hold a write in btier and are never shed. Everything else
+is advice, which is worthless once it's stale, and is better dropped than left to hold up the trace readers when the
+pipeline can't keep up. See LoadShedder.
+"""
+import time
+
+from metrics import counter
+
+SHED_DEADLINE = 1.0
+SHED_WATERMARK = 500
+SHED_SAMPLE_EVERY = 4
+
+class LoadShedder:
+    """
+    Decides which advisory items to drop. Items for which is_urgent(item) is true are never dropped. Others are
+    dropped:
+        * if they're older than deadline seconds, according to their timestamp (see metrics). On the receiver this is
+          only as good as the clock sync with the generator.
+        * if the queue they come from has more than watermark items, except for one in every sample_every of them
+        * if the queue they're put into is full (see PriorityLanes), instead of blocking the producer, unless
+          when_full is false
+    A deadline or watermark of 0 disables that check.
+
+    Counts are kept under {name}.*: shed_stale, shed_overload and shed_full count the dropped items by reason, and
+    sampled the items that were kept while over the watermark.
+    """
+    def __init__(self, name, is_urgent, deadline=SHED_DEADLINE, watermark=SHED_WATERMARK,
+                 sample_every=SHED_SAMPLE_EVERY, when_full=True):
+        self.is_urgent = is_urgent
+        self.deadline_ns = int(deadline * 1e9)
+        self.watermark = watermark
+        self.sample_every = max(sample_every, 1)
+        self.when_full = when_full
+        self._overloaded = 0
+        self._stale = counter(f'{name}.shed_stale')
+        self._overload = counter(f'{name}.shed_overload')
+        self._full = counter(f'{name}.shed_full')
+        self._sampled = counter(f'{name}.sampled')
+
+    def should_shed(self, item, queue_depth):
+        """
+        Whether to drop an item just taken from a queue that has queue_depth items left
+        """
+        if self.is_urgent(item):
+            return False
+        if self.deadline_ns and item.timestamp and time.time_ns() - item.timestamp > self.deadline_ns:
+            self._stale.inc()
+            return True
+        if self.watermark and queue_depth > self.watermark:
+            self._overloaded += 1
+            if self._overloaded % self.sample_every:
+                self._overload.inc()
+                return True
+            self._sampled.inc()
+        return False
+
+    def shed_full(self, item):
+        """
+        Whether to drop an item instead of waiting for room in a full queue
+        """
+        if not self.when_full or self.is_urgent(item):
+            return False
+        self._full.inc()
+        return True
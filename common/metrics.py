@@ -0,0 +1,226 @@
+"""
+Low overhead metrics: counters, latency histograms and gauges.
+
+Metrics live in a registry, and are looked up by name once, like loggers (see counter(), histogram() and gauge()).
+Updating a metric is then a couple of integer operations, so it's fine to do for every record and hint.
+
+Latencies through the pipeline are measured from the time a trace record was read, which records and the hints made
+from them carry along as their timestamp (wall clock nanoseconds, see time.time_ns(), or 0 if unknown). Latencies
+measured on the receiver are only as good as the clock sync between the two hosts.
+"""
+import json
+import asyncio
+import logging
+
+from hint_queues import STATS_INTERVAL
+
+# Histograms keep 2 ** (SUB_BUCKET_BITS - 1) buckets per power of two, i.e. about 6% relative error
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+# Values are clamped to 2 ** MAX_VALUE_BITS - 1, about 18 minutes in nanoseconds
+MAX_VALUE_BITS = 40
+PERCENTILES = [50, 99, 99.9]
+
+logger = logging.getLogger('metrics')
+
+class Counter:
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+class Histogram:
+    """
+    HDR-style histogram of non negative integer values, e.g. latencies in nanoseconds.
+
+    Values below 2 ** SUB_BUCKET_BITS are counted exactly. Above that, every power of two is split into
+    SUB_BUCKET_HALF linear buckets, so record() is O(1) and memory is fixed, and percentiles are accurate to a bucket.
+    """
+    __slots__ = ['counts', 'count', 'total', 'max']
+
+    BUCKET_COUNT = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKET_HALF + SUB_BUCKET_HALF
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value, count=1):
+        """
+        Record value, count times
+        """
+        if value < 0:
+            value = 0
+        elif value >> MAX_VALUE_BITS:
+            value = (1 << MAX_VALUE_BITS) - 1
+        self.counts[self._bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def _bucket(value):
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return shift * SUB_BUCKET_HALF + (value >> shift)
+
+    @staticmethod
+    def _bucket_value(bucket):
+        """
+        Highest value that falls in bucket
+        """
+        if bucket < 2 * SUB_BUCKET_HALF:
+            return bucket
+        shift = bucket // SUB_BUCKET_HALF - 1
+        return ((bucket - shift * SUB_BUCKET_HALF + 1) << shift) - 1
+
+    def percentile(self, percent):
+        """
+        The value percent% of the recorded values are at or below (up to the bucket's precision)
+        """
+        if not self.count:
+            return 0
+        rank = max(self.count * percent / 100, 1)
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self._bucket_value(bucket), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def merge(self, other):
+        """
+        Add the values recorded in another histogram to this one
+        """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        self.counts = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self):
+        summary = dict(count=self.count, mean=self.mean, max=self.max)
+        for percent in PERCENTILES:
+            summary[f'p{percent:g}'] = self.percentile(percent)
+        return summary
+
+class Metrics:
+    """
+    A registry of named counters, histograms and gauges. Gauges are functions that are called for the current value
+    whenever the metrics are reported.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        return self.counters.setdefault(name, Counter())
+
+    def histogram(self, name):
+        return self.histograms.setdefault(name, Histogram())
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def snapshot(self):
+        """
+        Current values of all metrics, as a json-serializable dict. Histograms are summarized (see
+        Histogram.summary()).
+        """
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = None
+                logger.debug("Gauge %s failed: %s", name, e)
+        return dict(counters={name: counter.value for name, counter in self.counters.items()},
+                    histograms={name: histogram.summary() for name, histogram in self.histograms.items()},
+                    gauges=gauges)
+
+    def reset_histograms(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+REGISTRY = Metrics()
+
+def counter(name):
+    """
+    Get the counter called name from the registry, creating it if needed
+    """
+    return REGISTRY.counter(name)
+
+def histogram(name):
+    """
+    Get the histogram called name from the registry, creating it if needed
+    """
+    return REGISTRY.histogram(name)
+
+def gauge(name, func):
+    """
+    Register func as the gauge called name
+    """
+    REGISTRY.gauge(name, func)
+
+def format_snapshot(snapshot):
+    """
+    Format a snapshot as log lines. Latencies are assumed to be nanoseconds and shown in microseconds.
+    """
+    lines = []
+    if snapshot['counters']:
+        lines.append("counters: " + ", ".join(f"{name}={value}" for name, value in sorted(snapshot['counters'].items())))
+    if snapshot['gauges']:
+        lines.append("gauges: " + ", ".join(f"{name}={value}" for name, value in sorted(snapshot['gauges'].items())))
+    for name, summary in sorted(snapshot['histograms'].items()):
+        if not summary['count']:
+            continue
+        percentiles = " ".join(f"p{percent:g}={summary[f'p{percent:g}'] / 1000:.0f}us" for percent in PERCENTILES)
+        lines.append(f"{name}: {summary['count']} samples, mean={summary['mean'] / 1000:.0f}us {percentiles} "
+                     f"max={summary['max'] / 1000:.0f}us")
+    return lines
+
+async def report_metrics(interval=STATS_INTERVAL, metrics=REGISTRY):
+    """
+    Periodically log all the metrics, then reset the histograms so every report covers its own interval
+
+    This is an asyncio coroutine
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for line in format_snapshot(metrics.snapshot()):
+            logger.info(line)
+        metrics.reset_histograms()
+
+async def serve_metrics(path, metrics=REGISTRY):
+    """
+    Serve metric snapshots on a UNIX socket at path: every connection gets the current snapshot as json, then gets
+    closed (e.g. socat - UNIX-CONNECT:path). Histograms cover the time since the last periodic report.
+
+    Returns the asyncio server. This is an asyncio coroutine
+    """
+    async def send_snapshot(reader, writer):
+        try:
+            writer.write(json.dumps(metrics.snapshot()).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(send_snapshot, path=path)
+    logger.info("Serving metrics on %s", path)
+    return server
@@ -0,0 +1,283 @@
+"""
+Single producer, single consumer ring buffers in shared memory, for passing data between processes without pickling or
+syscalls: ShmRing holds variable length messages, and ShmSlotRing fixed size slots.
+
+The shared memory starts with the read and write positions (uint64 byte counters that only grow, on separate cache
+lines), followed by the data area. Each message is a uint32 length followed by the message itself. A message never
+wraps around the end of the data area: if it doesn't fit in what's left, a WRAP marker is written instead, and the
+message starts over at the beginning.
+
+The producer only ever writes the write position and the consumer only the read position, each after it's done with
+the data. This relies on aligned 8 byte stores being atomic and not reordered with earlier stores, as on x86-64.
+
+Neither end is told when the other moved: they poll, or the reader waits on a Doorbell the writer rings.
+
+multiprocessing.shared_memory is imported when a ring is made, as it needs Python 3.8.
+"""
+import os
+import errno
+import struct
+import asyncio
+import tempfile
+
+POSITION = struct.Struct('=Q')
+LENGTH = struct.Struct('=I')
+READ_POSITION_OFFSET = 0
+WRITE_POSITION_OFFSET = 64
+DATA_OFFSET = 128
+WRAP = 0xFFFFFFFF
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+MIN_POLL_DELAY = 0.00005
+MAX_POLL_DELAY = 0.001
+DOORBELL_RING = b'\x01'
+# Rings are read this many at a time, so a backlog of them is cleared at once
+DOORBELL_READ_SIZE = 4096
+
+class ShmRing:
+    """
+    One end of a ring buffer. The creating process makes one with ShmRing.create(), and passes ring.name to the other
+    process, which attaches with ShmRing.attach(name). The creator should unlink() the ring once both are done, or
+    once the other process attached, since an unlinked ring stays usable until both close() it.
+    """
+    def __init__(self, shm):
+        self._shm = shm
+        self._buffer = shm.buf
+        self.name = shm.name
+        self.capacity = shm.size - DATA_OFFSET
+
+    @classmethod
+    def create(cls, size=DEFAULT_RING_SIZE, **kwargs):
+        """
+        Make a new ring of about size bytes. kwargs are passed on to the constructor.
+        """
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=size + DATA_OFFSET)
+        shm.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+        return cls(shm, **kwargs)
+
+    @classmethod
+    def attach(cls, name, track=True, **kwargs):
+        """
+        Attach to a ring made by another process. Unless track is set, the ring is left alone when this process exits,
+        which is what processes that aren't children of the creator want: otherwise Python unlinks the ring at exit
+        (and warns that it leaked).
+        """
+        from multiprocessing import shared_memory, resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        if not track:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm, **kwargs)
+
+    def _position(self, offset):
+        return POSITION.unpack_from(self._buffer, offset)[0]
+
+    def __len__(self):
+        """
+        Bytes in the ring, including framing
+        """
+        return self._position(WRITE_POSITION_OFFSET) - self._position(READ_POSITION_OFFSET)
+
+    def try_write(self, message):
+        """
+        Append a message. Returns False if there's no room for it right now.
+        """
+        length = LENGTH.size + len(message)
+        if length > self.capacity // 2:
+            raise ValueError(f"message of {len(message)} bytes is too big for the ring")
+        write_position = self._position(WRITE_POSITION_OFFSET)
+        free = self.capacity - (write_position - self._position(READ_POSITION_OFFSET))
+        index = write_position % self.capacity
+        padding = 0
+        if self.capacity - index < length:
+            padding = self.capacity - index
+        if free < padding + length:
+            return False
+        if padding:
+            if padding >= LENGTH.size:
+                LENGTH.pack_into(self._buffer, DATA_OFFSET + index, WRAP)
+            write_position += padding
+            index = 0
+        LENGTH.pack_into(self._buffer, DATA_OFFSET + index, len(message))
+        start = DATA_OFFSET + index + LENGTH.size
+        self._buffer[start:start + len(message)] = message
+        POSITION.pack_into(self._buffer, WRITE_POSITION_OFFSET, write_position + length)
+        return True
+
+    def read_many(self, max_messages=None):
+        """
+        Take up to max_messages messages (default: all of them) out of the ring. Returns a list, which is empty if
+        the ring is empty.
+        """
+        read_position = self._position(READ_POSITION_OFFSET)
+        write_position = self._position(WRITE_POSITION_OFFSET)
+        messages = []
+        while read_position < write_position and (max_messages is None or len(messages) < max_messages):
+            index = read_position % self.capacity
+            if self.capacity - index < LENGTH.size:
+                read_position += self.capacity - index
+                continue
+            length, = LENGTH.unpack_from(self._buffer, DATA_OFFSET + index)
+            if length == WRAP:
+                read_position += self.capacity - index
+                continue
+            start = DATA_OFFSET + index + LENGTH.size
+            messages.append(bytes(self._buffer[start:start + length]))
+            read_position += LENGTH.size + length
+        POSITION.pack_into(self._buffer, READ_POSITION_OFFSET, read_position)
+        return messages
+
+    async def write(self, message):
+        """
+        Append a message, waiting for room if the ring is full
+
+        This is an asyncio coroutine
+        """
+        delay = MIN_POLL_DELAY
+        while not self.try_write(message):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_DELAY)
+
+    async def read(self, max_messages=None):
+        """
+        Take messages out of the ring like read_many(), waiting for at least one
+
+        This is an asyncio coroutine
+        """
+        delay = MIN_POLL_DELAY
+        while True:
+            messages = self.read_many(max_messages)
+            if messages:
+                return messages
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_DELAY)
+
+    def close(self):
+        self._buffer = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+class ShmSlotRing(ShmRing):
+    """
+    A ring of slots of slot_size bytes each, rather than of messages. Writes and reads take and return whole slots,
+    packed back to back, so a batch of them is one copy each way, and needs no framing. Both ends must agree on
+    slot_size: pass it to create() and attach().
+    """
+    def __init__(self, shm, slot_size):
+        super().__init__(shm)
+        self.slot_size = slot_size
+        self.capacity = (shm.size - DATA_OFFSET) // slot_size * slot_size
+
+    def try_write(self, slots):
+        """
+        Append slots, given as bytes. Returns False if there's no room for all of them right now.
+        """
+        length = len(slots)
+        if length % self.slot_size:
+            raise ValueError(f"{length} bytes aren't a whole number of {self.slot_size} byte slots")
+        if length > self.capacity // 2:
+            raise ValueError(f"{length // self.slot_size} slots are too many for the ring")
+        write_position = self._position(WRITE_POSITION_OFFSET)
+        if self.capacity - (write_position - self._position(READ_POSITION_OFFSET)) < length:
+            return False
+        index = write_position % self.capacity
+        first = min(length, self.capacity - index)
+        self._buffer[DATA_OFFSET + index:DATA_OFFSET + index + first] = slots[:first]
+        if first < length:
+            self._buffer[DATA_OFFSET:DATA_OFFSET + length - first] = slots[first:]
+        POSITION.pack_into(self._buffer, WRITE_POSITION_OFFSET, write_position + length)
+        return True
+
+    def read_many(self, max_slots=None):
+        """
+        Take up to max_slots slots (default: all of them) out of the ring. Returns them as bytes, which are empty if
+        the ring is.
+        """
+        read_position = self._position(READ_POSITION_OFFSET)
+        length = self._position(WRITE_POSITION_OFFSET) - read_position
+        if max_slots is not None:
+            length = min(length, max_slots * self.slot_size)
+        if not length:
+            return b''
+        index = read_position % self.capacity
+        first = min(length, self.capacity - index)
+        slots = bytes(self._buffer[DATA_OFFSET + index:DATA_OFFSET + index + first])
+        if first < length:
+            slots += self._buffer[DATA_OFFSET:DATA_OFFSET + length - first]
+        POSITION.pack_into(self._buffer, READ_POSITION_OFFSET, read_position + length)
+        return slots
+
+class Doorbell:
+    """
+    Wakes up the reader of a ring, through a named pipe: the writer ring()s it after writing, and the reader waits
+    for it with wait(). Rings that come while the reader is busy add up to a single wake up, and cost the writer a
+    1 byte write() and nothing more, unlike a message on a socket.
+
+    The creating process makes one with Doorbell.create() and passes doorbell.path to the other process, which opens
+    it with Doorbell.open(path). The creator should unlink() it once the other process opened it. Both ends open the
+    pipe for reading and writing, so neither blocks or sees end of file when the other goes away: the reader has to
+    find out some other way, and can wake itself up with ring().
+    """
+    def __init__(self, path, fd):
+        self.path = path
+        self._fd = fd
+
+    @classmethod
+    def create(cls):
+        path = os.path.join(tempfile.mkdtemp(prefix='doorbell-'), 'doorbell')
+        os.mkfifo(path, 0o600)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        return cls(path, os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def ring(self):
+        try:
+            os.write(self._fd, DOORBELL_RING)
+        except BlockingIOError:
+            # The pipe is full of rings already, the reader will wake up either way
+            pass
+
+    def _drain(self):
+        """
+        Clear the rings so far. Returns whether there were any.
+        """
+        rang = False
+        try:
+            while os.read(self._fd, DOORBELL_READ_SIZE):
+                rang = True
+        except BlockingIOError:
+            pass
+        return rang
+
+    async def wait(self):
+        """
+        Wait for the doorbell to ring, unless it rang since the last wait()
+
+        This is an asyncio coroutine
+        """
+        if self._drain():
+            return
+        loop = asyncio.get_event_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self._fd, readable.set)
+        try:
+            await readable.wait()
+        finally:
+            loop.remove_reader(self._fd)
+        self._drain()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+            os.rmdir(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
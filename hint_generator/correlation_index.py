@@ -0,0 +1,264 @@
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from itertools import repeat
+
+from hint_types import SECTOR_SIZE, ACCESS_READ, ACCESS_READAHEAD, ACCESS_WRITE
+
+CORRELATION_WINDOW = 0.1
+MAX_PIDS = 1024
+MAX_ACCESSES_PER_PID = 64
+MAX_JOIN_CANDIDATES = 8
+MAX_EXTENTS = 65536
+EXTENT_WINDOW = 60
+# Extents are kept in buckets of this many sectors, split at bucket boundaries
+EXTENT_BUCKET_SECTORS = 2048
+MAX_OVERLAP_CANDIDATES = 8
+
+class FileAccess:
+    __slots__ = ['time', 'inode', 'offset', 'size', 'is_write', 'access_class']
+
+    def __init__(self, time, inode, offset, size, is_write, access_class):
+        self.time = time
+        self.inode = inode
+        self.offset = offset
+        self.size = size
+        self.is_write = is_write
+        self.access_class = access_class
+
+def access_class(record):
+    """
+    Access class of a file or post cache trace record (see hint_types)
+    """
+    if record.is_write:
+        return ACCESS_WRITE
+    if record.is_readahead:
+        return ACCESS_READAHEAD
+    return ACCESS_READ
+
+class CorrelationStats:
+    def __init__(self):
+        self.by_pid = 0
+        self.by_extent = 0
+        self.unmatched = 0
+
+    def __str__(self):
+        return "correlation: {} by pid, {} by extent, {} unmatched".format(self.by_pid, self.by_extent, self.unmatched)
+
+class CorrelationIndex:
+    """
+    Links block trace records to the file accesses that caused them.
+
+    The kernel issues block requests in the context of whoever submitted them: the reading process, the writeback
+    thread that submitted a post cache write, or a process doing direct io. So a block record is joined with the
+    latest file access of the same pid and direction seen in the last window seconds, preferring one of the same size.
+    Each pid's recent accesses are kept in time order, and expired with bisect.
+
+    Joins are remembered as extents (sector range -> inode and file offset), so block records with no recent file
+    access, e.g. writeback of a file written a while ago, can still be looked up. Extents are kept in sorted lists per
+    bucket of extent_bucket_sectors sectors, split where they cross into the next bucket, so adding and removing one
+    only shifts a bucket's worth of entries. A block record is matched with an extent that covers its first sector,
+    or failing that, with the first extent that starts inside it.
+
+    Memory is bounded by max_pids * max_accesses_per_pid accesses and max_extents extents, and the order extents were
+    added in by twice that, as entries of extents that were replaced since are dropped once there are that many. The
+    least recently seen pids and the oldest extents are evicted first, and extents expire extent_window seconds after they were added,
+    since the file blocks they map may have been freed and reused since.
+
+    Time is taken from clock, which returns seconds (default: time.monotonic). A replay can pass its own (see
+    ReplayTraceSource), so windows are those of the recording.
+    """
+    def __init__(self, window=CORRELATION_WINDOW, max_pids=MAX_PIDS, max_accesses_per_pid=MAX_ACCESSES_PER_PID,
+                 max_extents=MAX_EXTENTS, extent_window=EXTENT_WINDOW, extent_bucket_sectors=EXTENT_BUCKET_SECTORS,
+                 clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.max_pids = max_pids
+        self.max_accesses_per_pid = max_accesses_per_pid
+        self.max_extents = max_extents
+        self.extent_window = extent_window
+        self.extent_bucket_sectors = extent_bucket_sectors
+        self.stats = CorrelationStats()
+        # pid -> (access times, FileAccess list), both in time order
+        self._pids = OrderedDict()
+        # bucket number -> (start sectors, extents), sorted by start sector. An extent is
+        # (end sector, inode, file offset, access class, serial)
+        self._buckets = {}
+        # (time added, bucket number, start sector, serial) in insertion order, for expiry and eviction
+        self._extent_order = deque()
+        self._extent_serial = 0
+        self._extent_count = 0
+
+    def add_file_access(self, record, now=None):
+        """
+        Index a file or post cache trace record
+        """
+        if now is None:
+            now = self.clock()
+        self._add_access(record.pid, FileAccess(now, record.inode, record.offset, record.size, record.is_write,
+                                                access_class(record)))
+
+    def add_file_accesses(self, batch, now=None):
+        """
+        Index a RecordBatch (see trace_records) of file or post cache trace records, without making record objects
+        """
+        if now is None:
+            now = self.clock()
+        columns = dict(zip(batch.record_class.fields, batch.columns))
+        is_readaheads = columns.get('is_readahead', repeat(False))
+        for pid, inode, offset, size, is_write, is_readahead in zip(columns['pid'], columns['inode'], columns['offset'],
+                                                                   columns['size'], columns['is_write'], is_readaheads):
+            if is_write:
+                kind = ACCESS_WRITE
+            elif is_readahead:
+                kind = ACCESS_READAHEAD
+            else:
+                kind = ACCESS_READ
+            self._add_access(pid, FileAccess(now, inode, offset, size, is_write, kind))
+
+    def _add_access(self, pid, access):
+        entry = self._pids.get(pid)
+        if entry is None:
+            entry = self._pids[pid] = ([], [])
+            if len(self._pids) > self.max_pids:
+                self._pids.popitem(last=False)
+        else:
+            self._pids.move_to_end(pid)
+        times, accesses = entry
+        times.append(access.time)
+        accesses.append(access)
+        if len(times) > self.max_accesses_per_pid:
+            del times[0]
+            del accesses[0]
+
+    def correlate(self, record, now=None):
+        """
+        Find the file access behind a block trace record.
+
+        Returns dict(inode=..., file_offset=..., access_class=...) or None
+        """
+        if now is None:
+            now = self.clock()
+        self._expire_extents(now)
+        access = self._recent_access(record, now)
+        if access is not None:
+            self.stats.by_pid += 1
+            self._add_extent(record.offset, record.size, access.inode, access.offset, access.access_class, now)
+            return dict(inode=access.inode, file_offset=access.offset, access_class=access.access_class)
+
+        found = self._find_extent(record.offset, record.offset + max(record.size // SECTOR_SIZE, 1))
+        if found is not None:
+            start, (end, inode, file_offset, extent_class, serial) = found
+            self.stats.by_extent += 1
+            # The file offset of where the record and the extent start to overlap
+            return dict(inode=inode, file_offset=file_offset + max(record.offset - start, 0) * SECTOR_SIZE,
+                        access_class=extent_class)
+        self.stats.unmatched += 1
+        return None
+
+    def _find_extent(self, sector, end):
+        """
+        An extent that overlaps [sector, end), as (start sector, extent), or None
+        """
+        bucket_sectors = self.extent_bucket_sectors
+        first_bucket = sector // bucket_sectors
+        bucket = self._buckets.get(first_bucket)
+        if bucket is not None:
+            starts, extents = bucket
+            index = bisect_right(starts, sector) - 1
+            # Extents may overlap each other, so one that starts a bit earlier may still cover sector
+            for candidate in range(index, max(index - MAX_OVERLAP_CANDIDATES, -1), -1):
+                if extents[candidate][0] > sector:
+                    return starts[candidate], extents[candidate]
+            if index + 1 < len(starts) and starts[index + 1] < end:
+                return starts[index + 1], extents[index + 1]
+        for bucket_number in range(first_bucket + 1, (end - 1) // bucket_sectors + 1):
+            bucket = self._buckets.get(bucket_number)
+            if bucket is not None and bucket[0][0] < end:
+                return bucket[0][0], bucket[1][0]
+        return None
+
+    def _recent_access(self, record, now):
+        entry = self._pids.get(record.pid)
+        if entry is None:
+            return None
+        times, accesses = entry
+        expired = bisect_left(times, now - self.window)
+        if expired:
+            del times[:expired]
+            del accesses[:expired]
+
+        best = None
+        for access in reversed(accesses[-MAX_JOIN_CANDIDATES:]):
+            if access.is_write != record.is_write:
+                continue
+            if access.size == record.size:
+                return access
+            if best is None:
+                best = access
+        return best
+
+    def _add_extent(self, sector, size, inode, file_offset, extent_class, now):
+        end = sector + max(size // SECTOR_SIZE, 1)
+        bucket_sectors = self.extent_bucket_sectors
+        while sector < end:
+            bucket_number = sector // bucket_sectors
+            piece_end = min(end, (bucket_number + 1) * bucket_sectors)
+            self._extent_serial += 1
+            self._insert_extent(bucket_number, sector, (piece_end, inode, file_offset, extent_class,
+                                                        self._extent_serial))
+            self._extent_order.append((now, bucket_number, sector, self._extent_serial))
+            file_offset += (piece_end - sector) * SECTOR_SIZE
+            sector = piece_end
+
+        while self._extent_count > self.max_extents:
+            self._remove_oldest_extent()
+        # Ranges that are added over and over replace their extents, but leave their old entries in the order
+        if len(self._extent_order) > 2 * self.max_extents:
+            self._extent_order = deque(entry for entry in self._extent_order if self._is_live(*entry[1:]))
+
+    def _insert_extent(self, bucket_number, sector, extent):
+        bucket = self._buckets.get(bucket_number)
+        if bucket is None:
+            bucket = self._buckets[bucket_number] = ([], [])
+        starts, extents = bucket
+        index = bisect_left(starts, sector)
+        if index < len(starts) and starts[index] == sector:
+            extents[index] = extent
+        else:
+            starts.insert(index, sector)
+            extents.insert(index, extent)
+            self._extent_count += 1
+
+    def _is_live(self, bucket_number, sector, serial):
+        """
+        Whether the extent added with serial wasn't replaced or removed since
+        """
+        bucket = self._buckets.get(bucket_number)
+        if bucket is None:
+            return False
+        starts, extents = bucket
+        index = bisect_left(starts, sector)
+        return index < len(starts) and starts[index] == sector and extents[index][4] == serial
+
+    def _remove_oldest_extent(self):
+        added, bucket_number, sector, serial = self._extent_order.popleft()
+        # Skip extents that were replaced since
+        if not self._is_live(bucket_number, sector, serial):
+            return
+        starts, extents = self._buckets[bucket_number]
+        index = bisect_left(starts, sector)
+        del starts[index]
+        del extents[index]
+        self._extent_count -= 1
+        if not starts:
+            del self._buckets[bucket_number]
+
+    def _expire_extents(self, now):
+        deadline = now - self.extent_window
+        extent_order = self._extent_order
+        while extent_order and extent_order[0][0] < deadline:
+            self._remove_oldest_extent()
+
+    def __len__(self):
+        return self._extent_count
@@ -1,19 +1,373 @@
+import time
 import asyncio
 import socket
 import logging
-import json
+from collections import deque
+
+from hint_protocol import (HELLO, SHM_HELLO, SHM_SLOT, MATCH_ACK, MAX_FRAME_HINTS, encode_json, encode_hint, encode_frame,
+                           encode_slot)
+from metrics import counter, histogram
+from shm_ring import DEFAULT_RING_SIZE, ShmSlotRing, Doorbell
+
+HANDSHAKE_TIMEOUT = 1
+MAX_BATCH_HINTS = 128
+MAX_BATCH_DELAY = 0.005
+HIGH_WATERMARK = 1024 * 1024
+LOW_WATERMARK = 256 * 1024
+MAX_REPLAY_HINTS = 4096
+MIN_RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5
+# How hints are encoded for each protocol
+ENCODERS = dict(json=encode_json, binary=encode_hint, shm=encode_slot)
 
 class HintClient:
-    def __init__(self, target_host, target_port):
+    """
+    Sends hints to a hint receiver (see TCPHintReceiver) over an asyncio connection: over TCP, or over the UNIX socket
+    at unix_path (see UnixHintReceiver), where the shm protocol moves hints through a shared memory ring of ring_size
+    bytes instead of the socket.
+
+    Hints are coalesced in an outgoing buffer and written by a background task (see start()), so a slow receiver never
+    blocks the event loop:
+        * With the binary and shm protocols, hints are batched into frames or runs of ring slots (see hint_protocol).
+          Advisory hints wait until there are max_batch_hints of them, or for max_batch_delay seconds. Match hints are
+          written right away and ahead of advisory hints, since a write request in btier waits for them.
+        * Once more than high_watermark bytes are waiting to be sent, send_hint() blocks until the buffer drains below
+          low_watermark. This pushes back on the trace consumer.
+        * If the connection drops, the client reconnects with exponential backoff. Match hints that the receiver
+          didn't acknowledge yet are replayed on the new connection (up to max_replay_hints of them).
+        * Hints are encoded as they're queued, in the format of the current protocol, and kept along with their
+          encoding. If a new connection negotiates a protocol with another format, whatever is pending is re-encoded.
+
+    Metrics are kept under client.*. client.read_to_send is the time from reading the trace record of the oldest hint
+    in a write until the write.
+    """
+    def __init__(self, target_host, target_port, protocol='binary', max_batch_hints=MAX_BATCH_HINTS, max_batch_delay=MAX_BATCH_DELAY,
+                 high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK, max_replay_hints=MAX_REPLAY_HINTS,
+                 unix_path=None, ring_size=DEFAULT_RING_SIZE):
         self._logger = logging.getLogger('client')
-        self._logger.info(f"Connecting to {target_host}:{target_port}")
-        self._socket = socket.create_connection((target_host, target_port))
-        self._logger.info("Connected")
+        self.target_host = target_host
+        self.target_port = target_port
+        self.unix_path = unix_path
+        self.ring_size = ring_size
+        self.requested_protocol = protocol
+        self.protocol = None
+        self.max_batch_hints = min(max_batch_hints, MAX_FRAME_HINTS)
+        self.max_batch_delay = max_batch_delay
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+        # (hint, encoded hint) pairs
+        self._match_pending = []
+        self._advisory_pending = []
+        self._encode = ENCODERS[protocol]
+        self._pending_bytes = 0
+        # timestamp (see metrics) of the oldest hint that wasn't written yet
+        self._oldest_pending = None
+        # (sequence number, hint, encoded hint) of match hints sent on this connection and not acknowledged yet
+        self._unacked = deque(maxlen=max_replay_hints)
+        self._match_sequence = 0
+        self._acked_sequence = 0
+        # Match hints the receiver acknowledged over all connections, or that won't be replayed (see max_replay_hints).
+        # The json protocol has no acknowledgements, so with it they count once they're written.
+        self.acked_matches = 0
+
+        self._reader = None
+        self._writer = None
+        self._ring = None
+        self._doorbell = None
+        self._flush_handle = None
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._task = None
+
+        self._hints_sent = counter('client.hints')
+        self._bytes_sent = counter('client.bytes')
+        self._reconnects = counter('client.reconnects')
+        self._replayed = counter('client.replayed')
+        self._read_to_send = histogram('client.read_to_send')
+
+    @property
+    def pending_bytes(self):
+        """
+        Bytes waiting to be written
+        """
+        return self._pending_bytes
+
+    async def start(self):
+        """
+        Connect to the receiver and start sending hints in the background.
+
+        This is an asyncio coroutine
+        """
+        await self._connect()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        Stop sending, dropping any hints that weren't sent yet.
+
+        This is an asyncio coroutine
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._disconnect()
 
     async def send_hint(self, hint):
-        self._logger.debug("Sending hint")
-        serialized = json.dumps(hint) + "\n"
-        self._socket.send(serialized.encode())
+        """
+        Queue a hint to be sent. Blocks while the outgoing buffer is above the high watermark.
+
+        This is an asyncio coroutine
+        """
+        while not self._writable.is_set():
+            await self._writable.wait()
+
+        encoded = self._encode(hint)
+        self._pending_bytes += len(encoded)
+        self._hints_sent.inc()
+        if not self._oldest_pending:
+            self._oldest_pending = hint.timestamp
+        if hint.match:
+            self._match_pending.append((hint, encoded))
+            self._wakeup.set()
+        else:
+            self._advisory_pending.append((hint, encoded))
+            if len(self._advisory_pending) >= self.max_batch_hints:
+                self._wakeup.set()
+            elif not self._flush_handle:
+                self._flush_handle = asyncio.get_event_loop().call_later(self.max_batch_delay, self._wakeup.set)
+        self._update_writable()
+
+    async def _run(self):
+        """
+        Write out the outgoing buffer and reconnect whenever the connection drops
+        """
+        while True:
+            try:
+                tasks = [asyncio.ensure_future(self._write_pending())]
+                if self.protocol != 'json':
+                    tasks.append(asyncio.ensure_future(self._read_acks()))
+                try:
+                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                for task in done:
+                    task.result()
+                raise ConnectionResetError("connection closed by receiver")
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self._logger.warning(f"Lost connection to {self._target}: {e}")
+            self._disconnect()
+            self._requeue_unacked()
+            self._reconnects.inc()
+            await asyncio.sleep(MIN_RECONNECT_DELAY)
+            await self._connect()
+
+    async def _write_pending(self):
+        """
+        Write everything that's pending in as few writes as possible, and wait for the socket to drain
+        """
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            oldest_pending, self._oldest_pending = self._oldest_pending, None
+            chunks = self._take_pending()
+            if chunks:
+                if self._ring is not None:
+                    for chunk in chunks:
+                        if not self._ring.try_write(chunk):
+                            # The receiver only reads the ring when the doorbell rings, so ring it for what's already
+                            # in there before waiting for room
+                            self._doorbell.ring()
+                            await self._ring.write(chunk)
+                    self._doorbell.ring()
+                else:
+                    self._writer.write(b''.join(chunks))
+                self._bytes_sent.inc(sum(len(chunk) for chunk in chunks))
+                if oldest_pending:
+                    self._read_to_send.record(time.time_ns() - oldest_pending)
+                await self._writer.drain()
+            self._update_writable()
+
+    def _take_pending(self):
+        """
+        Return all the pending data as a list of chunks (frames, or runs of slots with shm, unless it's json), match
+        hints first
+        """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        match_pending, self._match_pending = self._match_pending, []
+        advisory_pending, self._advisory_pending = self._advisory_pending, []
+        self._pending_bytes = 0
+
+        if self.protocol == 'json':
+            self.acked_matches += len(match_pending)
+            return [encoded for hint, encoded in match_pending + advisory_pending]
+
+        for hint, encoded in match_pending:
+            self._unacked.append((self._match_sequence, hint, encoded))
+            self._match_sequence += 1
+        chunks = []
+        for pending in (match_pending, advisory_pending):
+            encoded_hints = [encoded for hint, encoded in pending]
+            for i in range(0, len(encoded_hints), self.max_batch_hints):
+                batch = encoded_hints[i:i + self.max_batch_hints]
+                chunks.append(b''.join(batch) if self.protocol == 'shm' else encode_frame(batch))
+        return chunks
+
+    async def _read_acks(self):
+        """
+        Forget match hints once the receiver acknowledged them
+        """
+        while True:
+            ack = await self._reader.readexactly(MATCH_ACK.size)
+            acked_count, = MATCH_ACK.unpack(ack)
+            while self._unacked and self._unacked[0][0] < acked_count:
+                self._unacked.popleft()
+            self.acked_matches += acked_count - self._acked_sequence
+            self._acked_sequence = acked_count
+
+    def _requeue_unacked(self):
+        """
+        Put match hints that weren't acknowledged back at the front of the outgoing buffer
+        """
+        if self._unacked:
+            self._logger.info(f"Replaying {len(self._unacked)} unacknowledged match hints")
+        replay = [(hint, encoded) for sequence, hint, encoded in self._unacked]
+        self._replayed.inc(len(replay))
+        # The ones that fell out of the replay buffer are as good as acknowledged, nothing more will come of them
+        self.acked_matches += self._match_sequence - self._acked_sequence - len(replay)
+        self._unacked.clear()
+        self._match_pending = replay + self._match_pending
+        self._pending_bytes += sum(len(encoded) for hint, encoded in replay)
+        self._match_sequence = 0
+        self._acked_sequence = 0
+
+    def _reencode_pending(self):
+        """
+        Encode the pending hints in the format of the current protocol, if they were encoded in another one
+        """
+        encode = ENCODERS[self.protocol]
+        if encode is self._encode:
+            return
+        self._logger.info(f"Re-encoding pending hints for the {self.protocol} protocol")
+        self._encode = encode
+        self._match_pending = [(hint, encode(hint)) for hint, encoded in self._match_pending]
+        self._advisory_pending = [(hint, encode(hint)) for hint, encoded in self._advisory_pending]
+        self._pending_bytes = sum(len(encoded) for hint, encoded in self._match_pending + self._advisory_pending)
+
+    def _update_writable(self):
+        buffered = self._pending_bytes
+        if self._writer:
+            buffered += self._writer.transport.get_write_buffer_size()
+        if buffered >= self.high_watermark:
+            self._writable.clear()
+        elif buffered <= self.low_watermark:
+            self._writable.set()
+
+    async def _connect(self):
+        """
+        Connect and negotiate the protocol, retrying with exponential backoff until it succeeds
+        """
+        delay = MIN_RECONNECT_DELAY
+        while True:
+            self._logger.info(f"Connecting to {self._target}")
+            try:
+                await self._open()
+                self.protocol = await self._negotiate(self.requested_protocol)
+                break
+            except OSError as e:
+                self._disconnect()
+                self._logger.warning(f"Connection failed: {e}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        self._logger.info(f"Connected, using {self.protocol} protocol")
+        self._reencode_pending()
+        if self._match_pending or self._advisory_pending:
+            self._wakeup.set()
+
+    async def _open(self):
+        if self.unix_path:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.target_host, self.target_port)
+            sock = self._writer.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @property
+    def _target(self):
+        return self.unix_path or f"{self.target_host}:{self.target_port}"
+
+    async def _negotiate(self, protocol):
+        """
+        Ask the receiver for the shm or binary protocol. Fall back to binary, then to json, if it doesn't agree in
+        time.
+
+        A receiver that doesn't know the shm protocol took its handshake for a json message, and stays in json mode, so
+        binary is asked for on a new connection.
+        """
+        if protocol == 'json':
+            return 'json'
+        if protocol == 'shm':
+            if await self._negotiate_shm():
+                return 'shm'
+            self._logger.warning("Receiver doesn't support the shm protocol, reconnecting to fall back to binary")
+            self._disconnect()
+            await self._open()
+        self._writer.write(HELLO)
+        try:
+            reply = await asyncio.wait_for(self._reader.readline(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            reply = None
+        if reply != HELLO:
+            self._logger.warning("Receiver doesn't support the binary protocol, falling back to json")
+            return 'json'
+        return 'binary'
+
+    async def _negotiate_shm(self):
+        """
+        Ask the receiver to read hints from a new shared memory ring, when a new doorbell rings. Returns whether it
+        agreed in time.
+        """
+        if not self.unix_path:
+            return False
+        ring = ShmSlotRing.create(self.ring_size, slot_size=SHM_SLOT.size)
+        doorbell = Doorbell.create()
+        try:
+            self._writer.write(b' '.join([SHM_HELLO, ring.name.encode(), doorbell.path.encode()]) + b'\n')
+            try:
+                reply = await asyncio.wait_for(self._reader.readline(), HANDSHAKE_TIMEOUT)
+            except asyncio.TimeoutError:
+                reply = None
+        finally:
+            # Either the receiver opened them by now, or it never will
+            ring.unlink()
+            doorbell.unlink()
+        if reply != SHM_HELLO + b'\n':
+            ring.close()
+            doorbell.close()
+            return False
+        self._ring = ring
+        self._doorbell = doorbell
+        return True
+
+    def _disconnect(self):
+        if self._writer:
+            self._writer.close()
+        if self._ring is not None:
+            self._ring.close()
+            self._doorbell.close()
+        self._reader = None
+        self._writer = None
+        self._ring = None
+        self._doorbell = None
 
 async def stdout_hint_consumer(hint):
     print(f'Got hint: {hint}')
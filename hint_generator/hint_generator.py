@@ -1,38 +1,111 @@
 import json
+import time
 import asyncio
 import logging
 
+from hint_types import SECTOR_SIZE, HINT_NONE, HINT_PREFETCH, Hint, make_hint
+from stream_detector import StreamDetector
+from correlation_index import CorrelationIndex
+
 logger = logging.getLogger('hints_generator')
 
+def is_block_write(record):
+    """
+    Whether the trace record is of a block write, which btier holds until it gets a matching hint
+    """
+    return record.type == 'block' and record.is_write
+
+def empty_hint(block_record):
+    """
+    A null hint for a block record, for when there's nothing better to say about it
+    """
+    return Hint(HINT_NONE, block_record.offset, block_record.size)
+
+def is_write_path(record):
+    """
+    Whether the trace record is on the path of a block write: the block write itself, or the post cache write
+    that submitted it. Both should be handled ahead of other records, the former so btier isn't held for long and the
+    latter so the write can be correlated with its file.
+    """
+    return record.is_write and record.type in ('block', 'post_cache')
+
 class HintGenerator:
+    """
+    Generates hints (see hint_types) from trace records (see trace_records).
+
+    Block reads are fed to a StreamDetector, per pid. Reads of sequential or strided streams produce a prefetch hint
+    (HINT_PREFETCH) for the range the stream is expected to read next. Post cache reads aren't: the receiver can't
+    place a range of a file, so prefetch hints in file space (HINT_FILE_PREFETCH) would only be dropped there.
+
+    File and post cache records are indexed in a CorrelationIndex, and block hints carry the file access the block
+    record was correlated with, if any.
+
+    Block writes always make a hint (see handle_trace_record()). With read_hints, so do block reads that make no
+    other hint: a null hint without the match flag, so a receiver that places blocks by heat sees reads as well.
+
+    clock is the time the correlation window is measured in (see CorrelationIndex).
+    """
+    def __init__(self, stream_detector=None, correlation_index=None, read_hints=False, clock=time.monotonic):
+        self.stream_detector = stream_detector or StreamDetector()
+        self.correlation_index = correlation_index or CorrelationIndex(clock=clock)
+        self.read_hints = read_hints
+        # Decided once, so the hot path doesn't even format log messages unless debug logging is on
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+
     async def handle_trace_record(self, record):
         """
         Digest a trace record and optionally return a hint based on it.
         
         Record that correspond to a block write always return a hint and have a 'match' flag set.
         This is because the code on the other side holds write requests until a hint arrives.
+
+        Hints carry the timestamp of the record they came from (see metrics), and its weight if it was sampled (see
+        hint_weight()).
         """
-        logger.debug(f"Processing record: {record}");
+        if self._debug:
+            logger.debug("Processing record: %s", record)
         hint = self._handle_trace_record(record)
 
-        if record['type'] == 'block' and record['is_write']:
-            if hint is None:
-                logger.debug("Generating empty hint for block write")
-                hint = self._empty_hint(record)
-            hint['match'] = True
+        if record.type == 'block':
+            file_access = self.correlation_index.correlate(record)
+            if hint is None and (record.is_write or self.read_hints):
+                hint = empty_hint(record)
+            if hint is not None and file_access:
+                if hint.hint_data is None:
+                    hint.hint_data = file_access
+                else:
+                    hint.hint_data.update(file_access)
+            if is_block_write(record):
+                hint.match = True
+        elif record.type in ('file', 'post_cache'):
+            self.correlation_index.add_file_access(record)
+        if hint is not None:
+            hint.timestamp = record.timestamp
+            if record.weight != 1:
+                hint.hint_data = dict(hint.hint_data or {}, weight=record.weight)
         return hint
 
+    def index_file_records(self, batch):
+        """
+        Digest a RecordBatch (see trace_records) of file or post cache records in one go. They never make a hint, and
+        are only indexed for correlation, like handle_trace_record() does one by one.
+        """
+        if self._debug:
+            for record in batch:
+                logger.debug("Processing record: %s", record)
+        self.correlation_index.add_file_accesses(batch)
+
     def _handle_trace_record(self, record):
         """
         Actual code that handles a trace record. You can do anything here.
         """
+        if record.is_write:
+            return None
+        if record.type == 'block':
+            # Block offsets are in sectors, detect in bytes so sizes and offsets are comparable
+            prediction = self.stream_detector.observe(('block', record.pid), record.offset * SECTOR_SIZE, record.size)
+            if prediction is None:
+                return None
+            pattern, offset, size = prediction
+            return make_hint(HINT_PREFETCH, offset // SECTOR_SIZE, size, pattern=pattern, pid=record.pid)
         return None
-
-    def _empty_hint(self, block_trace_record):
-        hint_type = 0
-        hint_data = None
-        offset = block_trace_record['offset']
-        size = block_trace_record['size']
-        hint = dict(offset=offset, size=size, hint_type=0)
-
-        return hint
@@ -1,10 +1,50 @@
+import os
+import time
 import asyncio
 import struct
-from collections import namedtuple
 import logging
 import signal
 
+from metrics import counter
+from trace_records import FileRecord, PostCacheRecord, BlockRecord, RecordBatch
+
 NODATA_SLEEP_TIME = 0.1
+MIN_NODATA_SLEEP_TIME = 0.001
+MAX_BATCH_RECORDS = 256
+BLKTRACE_READ_SIZE = 64 * 1024
+MAX_BLKTRACE_RESTART_DELAY = 1
+
+# struct blk_io_trace from linux/blktrace_api.h: magic, sequence, time, sector, bytes, action, pid, device, cpu,
+# error, pdu_len. blktrace writes it in native byte order, followed by pdu_len bytes of payload.
+BLK_IO_TRACE = struct.Struct('=IIQQIIIIIHH')
+BLK_IO_TRACE_MAGIC = 0x65617400
+BLK_IO_TRACE_MAGIC_MASK = 0xffffff00
+BLK_IO_TRACE_VERSION = 0x07
+BLK_IO_TRACE_MAGIC_BYTES = struct.pack('=I', BLK_IO_TRACE_MAGIC | BLK_IO_TRACE_VERSION)
+BLK_TA_ISSUE = 7
+BLK_TC_SHIFT = 16
+BLK_TC_WRITE = 1 << 1 << BLK_TC_SHIFT
+BLK_TC_PC = 1 << 9 << BLK_TC_SHIFT
+BLK_TC_NOTIFY = 1 << 10 << BLK_TC_SHIFT
+BLK_TC_DISCARD = 1 << 13 << BLK_TC_SHIFT
+
+class AdaptiveBackoff:
+    """
+    Sleep times for polling a source that has no data. Starts at min_delay and doubles on every consecutive
+    empty poll, up to max_delay. Call reset() once data arrives again.
+    """
+    def __init__(self, min_delay=MIN_NODATA_SLEEP_TIME, max_delay=NODATA_SLEEP_TIME):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._delay = min_delay
+
+    def next_delay(self):
+        delay = self._delay
+        self._delay = min(self._delay * 2, self.max_delay)
+        return delay
+
+    def reset(self):
+        self._delay = self.min_delay
 
 class TraceSource:
     """
@@ -13,73 +53,300 @@ class TraceSource:
     To use it, subclass it and define the following:
         * type - a string type name for this trace, to be used for differentiating different traces
         * _unpack_format - the binary format of the entry (see struct.unpack)
-        * RecordFormat - a namedtuple that gives a name for each part of the entry
+        * record_class - the class of the records (see trace_records), whose fields are the parts of the entry
     """
-    def __init__(self, devpath):
+    def __init__(self, devpath, max_batch_records=MAX_BATCH_RECORDS, record_filter=None, sampler=None):
         """
         Open a trace log file
 
         devpath - path to /dev file that outputs the trace events
+        max_batch_records - maximum number of records to read from the device in one read call
+        record_filter - a TraceFilter (see trace_filter) of the records to keep, they're all kept if it's missing
+        sampler - an AdaptiveSampler (see trace_filter) to sample records with, once the queue they're read into
+        gets too deep. Only queues with qsize() can be sampled for.
         """
         self.devpath = devpath
         self.nodata_sleep_time = NODATA_SLEEP_TIME
-        self._trace_file = open(devpath, 'rb')
-        self._record_length = struct.calcsize(self._unpack_format)
+        self.max_batch_records = max_batch_records
+        self.record_filter = record_filter
+        self.sampler = sampler
+        # Unbuffered, so every read() is a single read syscall. The trace device only ever returns whole records.
+        self._trace_file = open(devpath, 'rb', 0)
+        # Reads happen on the event loop thread, they must never block
+        os.set_blocking(self._trace_file.fileno(), False)
+        self._decoder = self.make_decoder()
+        self._record_length = self._decoder.record_length
         self._logger = logging.getLogger(self.type)
+        self._records_read = counter(f'source.{self.type}.records')
+        self._records_filtered = counter(f'source.{self.type}.filtered')
 
     def read_record(self):
         """
-        Read one record from the log. If no entry is available, return None.
+        Read one record from the log. If no entry is available, or record_filter drops it, return None.
+        """
+        records = self.read_records(1)
+        if not records:
+            return None
+        return records[0]
+
+    def read_records(self, max_records=None):
+        """
+        Read as many whole records as are available in the log (up to max_records, default is max_batch_records)
+        with a single read call, and decode them in one pass.
+
+        Returns a RecordBatch of the records record_filter keeps, or None if no entry is available. Records are
+        stamped with the time they were read (see metrics).
+        """
+        if max_records is None:
+            max_records = self.max_batch_records
+        partial_length = len(self._decoder.leftover)
+        data = self._trace_file.read(max_records * self._record_length - partial_length)
+        if not data:
+            return None
+        records = self._decoder.decode(data, time.time_ns())
+        read_count = (partial_length + len(data)) // self._record_length
+        self._records_read.inc(read_count)
+        self._records_filtered.inc(read_count - len(records))
+        return records
+
+    def read_chunk(self):
+        """
+        Read as many entries as are available in the log (up to max_batch_records) with a single read call, without
+        decoding them. Returns the bytes read, or None if no entry is available.
         """
-        data = self._trace_file.read(self._record_length)
-        self._logger.debug(f'Read {len(data)} bytes')
+        data = self._trace_file.read(self.max_batch_records * self._record_length)
         if not data:
             return None
-        unpacked_data = struct.unpack(self._unpack_format, data)
-        record = self.RecordFormat(*unpacked_data)
-        record_dict = record._asdict()
-        record_dict['type'] = self.type
-        return record_dict
+        self._records_read.inc(len(data) // self._record_length)
+        return data
+
+    def make_decoder(self):
+        """
+        A new RecordDecoder for what read_chunk() returns
+        """
+        return RecordDecoder(self.record_class, self._unpack_format, self.record_filter)
 
     async def async_read_into(self, queue):
         """
         Continually (async) read from the log and put the results into the given queue.
         If an error occurs, print it and continue reading.
-        
+
+        Reads are driven by the device's readiness (see loop.add_reader), so an idle source doesn't use any CPU.
+        If the device can't be polled, fall back to polling it with an adaptive backoff (see AdaptiveBackoff).
+        The device is only watched while waiting for it: the reader callback is level triggered, so leaving it
+        registered while blocked on a full queue would wake the loop up on every iteration.
+
+        With a sampler, records are sampled according to the depth of queue.
+
+        Queues with put_chunk() (see ShardedGenerator) are given what's read as is, to be decoded by whoever takes it
+        out (see make_decoder()), with the time it was read: await queue.put_chunk(type, data, timestamp).
+
         This is an asyncio coroutine. queue should be an asyncio queue. 
         """
         loop = asyncio.get_event_loop()
+        backoff = AdaptiveBackoff(max_delay=self.nodata_sleep_time)
+        polled = self._can_poll(loop)
+        chunked = hasattr(queue, 'put_chunk')
+        sampler = self.sampler
+        if sampler and not hasattr(queue, 'qsize'):
+            self._logger.info(f'{type(queue).__name__} has no depth to sample by, not sampling')
+            sampler = None
         while True:
             try:
-                self._logger.debug("Reading from log device")
-                record = await loop.run_in_executor(None, self.read_record)
-                if record:
-                    self._logger.debug("Read log record", record)
-                    await queue.put(record)
+                if chunked:
+                    data = self.read_chunk()
+                    if data:
+                        backoff.reset()
+                        await queue.put_chunk(self.type, data, time.time_ns())
+                        continue
                 else:
-                    self._logger.debug(f"Read nothing, sleeping for {NODATA_SLEEP_TIME}")
-                    await asyncio.sleep(self.nodata_sleep_time)
+                    records = self.read_records()
+                    if records is not None:
+                        backoff.reset()
+                        if sampler:
+                            sampler.adjust(queue.qsize())
+                        for record in records:
+                            if not sampler or sampler.sample(record):
+                                await queue.put(record)
+                        continue
+                if polled:
+                    await self._wait_readable(loop)
+                else:
+                    await asyncio.sleep(backoff.next_delay())
             except asyncio.CancelledError:
                 self._logger.info(f'cancelling')
                 raise
             except Exception as e:
                 self._logger.exception('error while reading record')
 
+    def _can_poll(self, loop):
+        """
+        Whether the trace device can be watched with the event loop
+        """
+        try:
+            loop.add_reader(self._trace_file.fileno(), lambda: None)
+        except (OSError, ValueError, NotImplementedError) as e:
+            self._logger.info(f'{self.devpath} can\'t be polled ({e}), using adaptive backoff instead')
+            return False
+        loop.remove_reader(self._trace_file.fileno())
+        self._logger.info(f'Waiting for {self.devpath} to become readable')
+        return True
+
+    async def _wait_readable(self, loop):
+        """
+        Wait for the trace device to become readable
+
+        This is an asyncio coroutine
+        """
+        readable = asyncio.Event()
+        fileno = self._trace_file.fileno()
+        loop.add_reader(fileno, readable.set)
+        try:
+            await readable.wait()
+        finally:
+            loop.remove_reader(fileno)
+
 class FileTraceSource(TraceSource):
     """
     pre-cache (syscall level) file trace
     """
-    type = "file"
+    type = FileRecord.type
     _unpack_format = "=IIIQqQ?"
-    RecordFormat = namedtuple('FileTraceRecord', ['pid', 'major', 'minor', 'inode', 'offset', 'size', 'is_write'])
+    record_class = FileRecord
 
 class PostCacheTraceSource(TraceSource):
     """
     post-cache file trace
     """
-    type = "post_cache"
+    type = PostCacheRecord.type
     _unpack_format = "=IIIQqQ??"
-    RecordFormat = namedtuple('FileTraceRecord', ['pid', 'major', 'minor', 'inode', 'offset', 'size', 'is_readahead', 'is_write'])
+    record_class = PostCacheRecord
+
+class RecordDecoder:
+    """
+    Decodes the entries of a TraceSource as they're read, into RecordBatches of the records record_filter keeps.
+    Trailing bytes of an incomplete entry are kept for the next read, which only happens when reading regular files.
+    """
+    def __init__(self, record_class, unpack_format, record_filter=None):
+        self.record_class = record_class
+        self.unpack_format = unpack_format
+        self.record_filter = record_filter
+        self._struct = struct.Struct(unpack_format)
+        self.record_length = self._struct.size
+        self._matches = record_filter.matcher(record_class) if record_filter else None
+        self._partial = b''
+
+    def __reduce__(self):
+        # The matcher is a closure, which can't be pickled, so decoders are sent to other processes as new ones
+        return (type(self), (self.record_class, self.unpack_format, self.record_filter))
+
+    @property
+    def leftover(self):
+        """
+        Bytes of an incomplete entry, kept for the next read
+        """
+        return self._partial
+
+    def prime(self, leftover):
+        """
+        Set the bytes kept from earlier reads, e.g. to pick up decoding where another decoder left off
+        """
+        self._partial = bytes(leftover)
+
+    def decode(self, data, timestamp):
+        """
+        Decode the whole entries in the kept bytes followed by data, and keep what's left. Returns a RecordBatch,
+        stamped with timestamp.
+        """
+        if self._partial:
+            data = self._partial + data
+        whole_length = len(data) - len(data) % self.record_length
+        self._partial = bytes(data[whole_length:])
+        values = self._struct.iter_unpack(memoryview(data)[:whole_length])
+        if self._matches:
+            values = filter(self._matches, values)
+        return RecordBatch.from_tuples(self.record_class, values, timestamp)
+
+def decode_blk_io_traces(data, keep_sector=None):
+    """
+    Decode the binary blktrace events in data (bytes or a bytearray), keeping only issue events of fs requests, and if
+    keep_sector is given, only those of the sectors it returns True for.
+
+    Returns (records, consumed): records is a RecordBatch of BlockRecords, and consumed is the number of bytes used
+    up, which excludes a trailing incomplete event. Garbage between events is skipped.
+    """
+    records = RecordBatch(BlockRecord)
+    pids, offsets, sizes, is_writes = records.columns
+    unpack_from = BLK_IO_TRACE.unpack_from
+    header_size = BLK_IO_TRACE.size
+    length = len(data)
+    pos = 0
+    while length - pos >= header_size:
+        magic, sequence, timestamp, sector, size, action, pid, device, cpu, error, pdu_len = unpack_from(data, pos)
+        if magic & BLK_IO_TRACE_MAGIC_MASK != BLK_IO_TRACE_MAGIC:
+            # Out of sync, skip to the next thing that looks like an event
+            pos = _find_blk_io_trace_magic(data, pos + 1)
+            continue
+        if length - pos < header_size + pdu_len:
+            break
+        pos += header_size + pdu_len
+        if action & 0xffff != BLK_TA_ISSUE or action & (BLK_TC_NOTIFY | BLK_TC_PC):
+            continue
+        # Like blkparse's RWBS: discards and writes are writes, other requests with data are reads
+        if action & (BLK_TC_DISCARD | BLK_TC_WRITE):
+            is_write = True
+        elif size:
+            is_write = False
+        else:
+            continue
+        if keep_sector and not keep_sector(sector):
+            continue
+        pids.append(pid)
+        offsets.append(sector)
+        sizes.append(size)
+        is_writes.append(is_write)
+    return records, pos
+
+def _find_blk_io_trace_magic(data, start):
+    # Searched in place, data is the source's whole buffer
+    pos = data.find(BLK_IO_TRACE_MAGIC_BYTES, start)
+    if pos == -1:
+        # Keep the last few bytes, they might be the start of the next event's magic
+        return max(start, len(data) - len(BLK_IO_TRACE_MAGIC_BYTES) + 1)
+    return pos
+
+class BlkIoTraceDecoder:
+    """
+    Decodes binary blktrace events as they're read (see decode_blk_io_traces), into RecordBatches. Trailing bytes of
+    an incomplete event are kept for the next read.
+    """
+    def __init__(self, keep_sector=None):
+        self.keep_sector = keep_sector
+        self._buffer = bytearray()
+
+    @property
+    def leftover(self):
+        """
+        Bytes of an incomplete event, kept for the next read
+        """
+        return self._buffer
+
+    def prime(self, leftover):
+        """
+        Set the bytes kept from earlier reads, e.g. to pick up decoding where another decoder left off
+        """
+        self._buffer[:] = leftover
+
+    def decode(self, data, timestamp):
+        """
+        Decode the whole events in the kept bytes followed by data, and keep what's left. Returns a RecordBatch,
+        stamped with timestamp.
+        """
+        self._buffer += data
+        records, consumed = decode_blk_io_traces(self._buffer, self.keep_sector)
+        del self._buffer[:consumed]
+        records.timestamp = timestamp
+        return records
 
 class BlockTraceSource:
     """
@@ -87,7 +354,7 @@ class BlockTraceSource:
 
     This is implemented differently, because we don't control the scsi client module. Instead we wrap blktrace.
     """
-    type = "block"
+    type = BlockRecord.type
 
     def __init__(self, devpath):
         self._shell_command = f'exec blktrace -a issue -o - -d {devpath} | blkparse -i - -f "%p,%S,%N,%d\n"'
@@ -134,13 +401,8 @@ class BlockTraceSource:
 
     async def async_read_record(self):
         """
-        Read a single record. Expects the start_blktrace() to have been called already.
-
-        Record format is:
-            - pid
-            - offset (sectors)
-            - size (bytes)
-            - is_write (bool)
+        Read a single BlockRecord, stamped with the time it was read (see metrics). Expects the start_blktrace() to
+        have been called already.
 
         This is an asyncio coroutine
         """
@@ -148,7 +410,6 @@ class BlockTraceSource:
         if not line:
             await self.stop_blktrace()
             raise ValueError("unexpected EOF")
-        self._logger.debug(f"read line: {line}")
         pid, offset, size, op = line.strip().split(b",")
         pid = int(pid)
         offset = int(offset)
@@ -157,9 +418,7 @@ class BlockTraceSource:
         if is_write is None:
             return None
 
-        record = dict(pid=pid, offset=offset, size=size, is_write=is_write, type=self.type)
-
-        return record
+        return BlockRecord(pid, offset, size, is_write, time.time_ns())
 
     async def async_read_into(self, queue):
         """
@@ -171,13 +430,9 @@ class BlockTraceSource:
         await self.start_blktrace()
         while True:
             try:
-                self._logger.debug("Reading from blkparse")
                 record = await self.async_read_record()
                 if record:
-                    self._logger.debug("Read log record", record)
                     await queue.put(record)
-                else:
-                    self._logger.debug("Ignored record with N op")
             except asyncio.CancelledError:
                 self._logger.info(f'cancelling')
                 await self.stop_blktrace()
@@ -195,3 +450,129 @@ class BlockTraceSource:
         # neither read nor write, ignore it
         return None
 
+
+class BinaryBlockTraceSource:
+    """
+    Block trace, read as binary blk_io_trace events straight from blktrace's output, without blkparse and its text
+    round trip. Records are BlockRecords, like BlockTraceSource's.
+
+    Events are read in chunks of up to read_size bytes and decoded in one pass each (see decode_blk_io_traces).
+
+    If input_path is given, events are read from that file instead, e.g. the output of blktrace -o - saved earlier.
+    Reading stops at the end of the file.
+    """
+    type = BlockRecord.type
+
+    def __init__(self, devpath, input_path=None, read_size=BLKTRACE_READ_SIZE):
+        self.devpath = devpath
+        self.input_path = input_path
+        self.read_size = read_size
+        self._blktrace = None
+        self._input_file = None
+        self._decoder = self.make_decoder()
+        self._logger = logging.getLogger(self.type)
+        self._records_read = counter(f'source.{self.type}.records')
+
+    async def start(self):
+        """
+        Start blktrace, or open the input file
+        """
+        if self.input_path:
+            self._input_file = open(self.input_path, 'rb')
+            return
+        self._logger.debug("Cleaning previous blktrace")
+        pkill = await asyncio.create_subprocess_exec("pkill", "blktrace")
+        await pkill.wait()
+        self._logger.debug("Starting blktrace")
+        self._blktrace = await asyncio.create_subprocess_exec("blktrace", "-a", "issue", "-o", "-", "-d", self.devpath,
+                stdout=asyncio.subprocess.PIPE)
+
+    async def stop(self):
+        """
+        Stop blktrace, or close the input file
+        """
+        if self._input_file:
+            self._input_file.close()
+            self._input_file = None
+        if self._blktrace:
+            try:
+                self._blktrace.terminate()
+            except ProcessLookupError:
+                pass
+            await self._blktrace.wait()
+            self._blktrace = None
+        self._decoder = self.make_decoder()
+
+    async def read_chunk(self):
+        """
+        Read a chunk of events, without decoding it. Returns the bytes read, or None at EOF.
+
+        This is an asyncio coroutine
+        """
+        if self._input_file:
+            data = self._input_file.read(self.read_size)
+        else:
+            data = await self._blktrace.stdout.read(self.read_size)
+        return data or None
+
+    async def read_records(self):
+        """
+        Read a chunk of events and decode it. Returns a RecordBatch, stamped with the time it was read, or None at
+        EOF.
+
+        This is an asyncio coroutine
+        """
+        data = await self.read_chunk()
+        if data is None:
+            return None
+        records = self._decoder.decode(data, time.time_ns())
+        self._records_read.inc(len(records))
+        return records
+
+    def make_decoder(self):
+        """
+        A new BlkIoTraceDecoder for what read_chunk() returns
+        """
+        return BlkIoTraceDecoder()
+
+    async def async_read_into(self, queue):
+        """
+        Continually (async) read events and put the resulting records into the given queue.
+        If blktrace exits, restart it with an adaptive backoff.
+
+        Like with TraceSource.async_read_into(), queues with put_chunk() are given the events undecoded. Records aren't
+        counted then.
+
+        This is an asyncio coroutine. queue should be an asyncio queue.
+        """
+        backoff = AdaptiveBackoff(max_delay=MAX_BLKTRACE_RESTART_DELAY)
+        chunked = hasattr(queue, 'put_chunk')
+        await self.start()
+        try:
+            while True:
+                try:
+                    if not self._input_file and not self._blktrace:
+                        await self.start()
+                    read = await (self.read_chunk() if chunked else self.read_records())
+                    if read is None:
+                        if self.input_path:
+                            self._logger.info(f"Done reading {self.input_path}")
+                            return
+                        self._logger.error("blktrace exited, restarting it")
+                        await self.stop()
+                        await asyncio.sleep(backoff.next_delay())
+                        continue
+                    backoff.reset()
+                    if chunked:
+                        await queue.put_chunk(self.type, read, time.time_ns())
+                        continue
+                    for record in read:
+                        await queue.put(record)
+                except asyncio.CancelledError:
+                    self._logger.info('cancelling')
+                    raise
+                except Exception:
+                    self._logger.exception('error while reading events')
+                    await asyncio.sleep(backoff.next_delay())
+        finally:
+            await self.stop()
@@ -1,46 +1,83 @@
 #!/usr/bin/python
+import os
 import sys
 import asyncio
 import logging
 import argparse
 import signal
 import functools
+import time
 
-from hint_generator import HintGenerator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from hint_generator import HintGenerator, is_write_path
 from hint_client import HintClient, stdout_hint_consumer
-from hint_sources import FileTraceSource, PostCacheTraceSource, BlockTraceSource
+from hint_protocol import PROTOCOLS
+from hint_compaction import COMPACTION_WINDOW, HintCompactor
+from load_shedding import SHED_DEADLINE, SHED_WATERMARK, SHED_SAMPLE_EVERY, LoadShedder
+from hint_queues import STATS_INTERVAL, TimedQueue, PriorityLanes, report_queue_delays
+from metrics import counter, histogram, gauge, report_metrics, serve_metrics
+from hint_sources import FileTraceSource, PostCacheTraceSource, BlockTraceSource, BinaryBlockTraceSource
+from trace_replay import TraceRecorder, ReplayTraceSource
+from trace_filter import SAMPLE_WATERMARK, MAX_SAMPLE_LEVEL, TraceFilter, AdaptiveSampler
+from shm_ring import DEFAULT_RING_SIZE
 
 DEFAULT_PORT = 1337
 DEFAULT_HOST = 'localhost'
 HINT_CLIENTS = dict(remote=HintClient, stdout=stdout_hint_consumer)
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
 
 logger = logging.getLogger('main') 
 
+def parse_device(spec):
+    """
+    Parse MAJOR:MINOR
+    """
+    try:
+        major, minor = spec.split(':', 1)
+        return int(major), int(minor)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad device {spec}, should be MAJOR:MINOR")
+
 def shutdown(loop):
     logger.info('received stop signal, cancelling tasks...')
     for task in asyncio.Task.all_tasks():
         task.cancel()
     logger.info('bye, exiting in a minute...')
 
-async def consume_trace(trace_queue, handle_trace_record, handle_hint):
+async def consume_trace(trace_queue, handle_trace_record, handle_hint, shedder=None):
     """
     Continuously does the following:
         - Read from the given asyncio queue
+        - Drop the trace record if shedder (see LoadShedder) says so
         - Feed the trace record to handle_trace_record, returning an optional hint
         - If there's a hint, feed it to  handle_hint.
 
         handle_trace_record and handle_hint should be asyncio coroutines.
     """
     logger.info('Consuming from trace queue')
+    debug = logger.isEnabledFor(logging.DEBUG)
+    records = counter('generator.records')
+    # Sampled records stand for weight records each (see trace_filter), this is the count of records they stand for
+    weighted_records = counter('generator.weighted_records')
+    hints = counter('generator.hints')
+    read_to_hint = histogram('generator.read_to_hint')
     while True:
         try:
             trace_record = await trace_queue.get()
+            records.inc()
+            weighted_records.inc(trace_record.weight)
+            if shedder and shedder.should_shed(trace_record, trace_queue.qsize()):
+                trace_queue.task_done()
+                continue
             hint = await handle_trace_record(trace_record)
             if hint:
-                logger.debug("Writing hint", hint)
+                if debug:
+                    logger.debug("Writing hint %s", hint)
+                hints.inc()
+                if hint.timestamp:
+                    read_to_hint.record(time.time_ns() - hint.timestamp)
                 await handle_hint(hint)
-            else:
-                logger.debug("No hint returned")
             trace_queue.task_done()
         except asyncio.CancelledError:
             logger.info('Stopping reading from queue')
@@ -49,41 +86,151 @@ async def consume_trace(trace_queue, handle_trace_record, handle_hint):
             logger.exception('Got error, skipping')
             trace_queue.task_done()
 
+async def replay_trace(replay, handle_trace_record, handle_hint, flush=None):
+    """
+    Replay a trace (see ReplayTraceSource) straight into handle_trace_record, one record at a time and in the order
+    they were recorded, feeding hints to handle_hint. Unlike consume_trace(), nothing is queued or shed on the way,
+    so the same trace always makes the same hints. Awaits flush(), if given, once the trace is replayed.
+
+    handle_trace_record, handle_hint and flush should be asyncio coroutines.
+    """
+    records = counter('generator.records')
+    hints = counter('generator.hints')
+
+    async def handle_record(trace_record):
+        records.inc()
+        try:
+            hint = await handle_trace_record(trace_record)
+            if hint:
+                hints.inc()
+                await handle_hint(hint)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Got error, skipping')
+
+    await replay.replay(handle_record)
+    if flush:
+        await flush()
+
 async def main(options):
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=options.log_level)
     logger.info('Initializing')
     logger.debug('Creating trace sources')
-    traces = [
-            FileTraceSource('/dev/file_trace'),
-            PostCacheTraceSource('/dev/post_cache_trace'),
-            BlockTraceSource('/dev/sdb')
-            ]
-    logger.debug('Creating queue')
-    trace_queue = asyncio.Queue(maxsize=1000)
+    replay = None
+    if options.replay:
+        replay = ReplayTraceSource(options.replay, options.replay_speed)
+        traces = [replay]
+    else:
+        record_filter = TraceFilter(options.trace_devices, options.trace_pids, options.trace_cgroups,
+                                    options.trace_min_size)
+        def sampler(source_class):
+            if not options.sample_watermark:
+                return None
+            return AdaptiveSampler(source_class.type, is_write_path, options.sample_watermark,
+                                   options.max_sample_level)
+        traces = [
+                FileTraceSource('/dev/file_trace', record_filter=record_filter,
+                                sampler=sampler(FileTraceSource)),
+                PostCacheTraceSource('/dev/post_cache_trace', record_filter=record_filter,
+                                     sampler=sampler(PostCacheTraceSource)),
+                ]
+        if options.block_trace == 'binary' or options.block_trace_file:
+            traces.append(BinaryBlockTraceSource('/dev/sdb', input_path=options.block_trace_file))
+        else:
+            traces.append(BlockTraceSource('/dev/sdb'))
+    logger.debug('Creating queues')
+    # block writes produce match hints that hold a write in btier, so they get a lane of their own, along with the
+    # post cache writes they're correlated with
+    block_write_queue = TimedQueue(maxsize=1000)
+    trace_queue = TimedQueue(maxsize=1000)
+    # A replay is expected to come out the same every time, which it can't if records are dropped for lack of room
+    shedder = LoadShedder('generator', is_write_path, options.shed_deadline, options.shed_watermark,
+                          options.shed_sample_every, when_full=not (options.no_shed_full or replay))
+    destination = PriorityLanes(is_write_path, block_write_queue, trace_queue, shedder)
     logger.debug('Creating generator')
-    generator = HintGenerator()
+    # A replay drives the generator's clock, so its windows are those of the recording
+    generator = HintGenerator(read_hints=options.read_hints, clock=replay.clock if replay else time.monotonic)
+    recorder = None
+    if options.record:
+        destination = recorder = TraceRecorder(options.record, destination)
     logger.debug('Creating client')
     if options.hint_client == 'stdout':
         client = stdout_hint_consumer
     else:
-        client = HintClient(options.host, options.port).send_hint
+        hint_client = HintClient(options.host, options.port, protocol=options.protocol, unix_path=options.unix_socket,
+                                 ring_size=options.ring_size)
+        await hint_client.start()
+        client = hint_client.send_hint
+    compactor = None
+    if options.compaction_window:
+        compactor = HintCompactor(client, options.compaction_window, name='client.compaction',
+                                  clock=replay.clock if replay else None)
+        client = compactor.handle_hint
 
     tasks = []
     for t in traces:
-        task = asyncio.ensure_future(t.async_read_into(trace_queue))
+        if t is replay:
+            # Replayed straight into the generator, see below
+            continue
+        task = asyncio.ensure_future(t.async_read_into(destination))
         tasks.append(task)
     logger.info('Started all sources')
 
-    tasks.append(asyncio.ensure_future(consume_trace(trace_queue, generator.handle_trace_record, client)))
-    logger.info('Started consumer')
+    if replay:
+        tasks.append(asyncio.ensure_future(replay_trace(replay, generator.handle_trace_record, client,
+                                                        compactor.flush if compactor else None)))
+    else:
+        tasks.append(asyncio.ensure_future(consume_trace(block_write_queue, generator.handle_trace_record, client)))
+        tasks.append(asyncio.ensure_future(consume_trace(trace_queue, generator.handle_trace_record, client, shedder)))
+        queues = dict(block_write=block_write_queue, trace=trace_queue)
+        tasks.append(asyncio.ensure_future(report_queue_delays(queues, options.stats_interval)))
+        for name, queue in queues.items():
+            gauge(f'queue.{name}.depth', queue.qsize)
+    logger.info('Started consumers')
 
-    await asyncio.gather(*tasks)
+    if options.hint_client != 'stdout':
+        gauge('client.pending_bytes', lambda: hint_client.pending_bytes)
+    tasks.append(asyncio.ensure_future(report_metrics(options.stats_interval)))
+    if options.metrics_socket:
+        await serve_metrics(options.metrics_socket)
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if compactor:
+            await compactor.close()
+        if recorder:
+            recorder.close()
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process IO activity trace and genereate hints')
     parser.add_argument('--hint-client', type=str, default='remote', help=f'Hint client type', choices=['remote', 'stdout'])
     parser.add_argument('--host', type=str, default=DEFAULT_HOST, help=f'Remote host to send hints to (default: {DEFAULT_HOST})')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Remote port to send hints to (default: {DEFAULT_PORT})')
+    parser.add_argument('--unix-socket', type=str, help='Send hints to a receiver on this host, over its UNIX socket at this path (see the receiver\'s --unix-socket), instead of to --host and --port')
+    parser.add_argument('--ring-size', type=int, default=DEFAULT_RING_SIZE, help=f'Bytes of the shared memory ring of the shm protocol (default: {DEFAULT_RING_SIZE})')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL, help=f'Seconds between queue delay and metrics reports (default: {STATS_INTERVAL})')
+    parser.add_argument('--metrics-socket', type=str, help='Serve metrics as json on a UNIX socket at this path')
+    parser.add_argument('--log-level', type=str.upper, default='INFO', choices=LOG_LEVELS, help='Log level. Unless it is DEBUG, nothing is logged per record or hint (default: INFO)')
+    parser.add_argument('--block-trace', type=str, default='text', choices=['binary', 'text'], help='Read block traces as text through blkparse, or as binary blktrace events, decoded in-process without blkparse (default: text)')
+    parser.add_argument('--block-trace-file', type=str, help='Read binary block trace events from this file, as saved by blktrace -o -, instead of running blktrace. Implies --block-trace binary')
+    parser.add_argument('--trace-device', type=parse_device, action='append', dest='trace_devices', default=[], metavar='MAJOR:MINOR', help='Only trace file I/O to this device, e.g. the btier LUN. Can be given several times (default: all devices)')
+    parser.add_argument('--trace-pid', type=int, action='append', dest='trace_pids', default=[], metavar='PID', help='Only trace file I/O of this pid. Can be given several times (default: all pids)')
+    parser.add_argument('--trace-cgroup', type=str, action='append', dest='trace_cgroups', default=[], metavar='PATH', help='Only trace file I/O of processes in this cgroup, e.g. /system.slice/db.service, or in its descendants. Can be given several times (default: all cgroups)')
+    parser.add_argument('--trace-min-size', type=int, default=0, help='Only trace file I/O of at least this many bytes (default: 0)')
+    parser.add_argument('--sample-watermark', type=int, default=SAMPLE_WATERMARK, help=f'Once more than this many trace records are queued, sample the file and post cache records that only make advisory hints, keeping fewer streams the longer the queue stays this deep. 0 disables sampling (default: {SAMPLE_WATERMARK})')
+    parser.add_argument('--max-sample-level', type=int, default=MAX_SAMPLE_LEVEL, help=f'Keep at least 1 in 2 ** this many streams when sampling (default: {MAX_SAMPLE_LEVEL})')
+    parser.add_argument('--record', type=str, help='Record the trace records to this file, for replaying later with --replay')
+    parser.add_argument('--replay', type=str, help='Replay trace records from this file, recorded with --record, instead of reading live traces. Records go to the generator one at a time and in order, timed by the recording, so a replay always makes the same hints')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='Speed factor for --replay. 0 replays as fast as possible (default: 1)')
+    parser.add_argument('--read-hints', action='store_true', help='Send a null hint for every block read that makes no other hint, for receivers that place blocks by heat (see the receiver\'s --tiers). By default only block writes do')
+    parser.add_argument('--compaction-window', type=float, default=COMPACTION_WINDOW, help=f'Seconds advisory hints are held to be merged with hints for adjacent or overlapping ranges before they are sent. 0 sends every hint as is (default: {COMPACTION_WINDOW})')
+    parser.add_argument('--shed-deadline', type=float, default=SHED_DEADLINE, help=f'Drop trace records that only make advisory hints once they are older than this many seconds. 0 never drops them for age (default: {SHED_DEADLINE})')
+    parser.add_argument('--shed-watermark', type=int, default=SHED_WATERMARK, help=f'Once more than this many such records are queued, only handle one in every --shed-sample-every of them. 0 disables this (default: {SHED_WATERMARK})')
+    parser.add_argument('--shed-sample-every', type=int, default=SHED_SAMPLE_EVERY, help=f'See --shed-watermark (default: {SHED_SAMPLE_EVERY})')
+    parser.add_argument('--no-shed-full', action='store_true', help='Wait for room in a full queue for records that only make advisory hints, instead of dropping them. Always the case with --replay')
+    parser.add_argument('--protocol', type=str, default='binary', choices=PROTOCOLS, help='Wire protocol for remote hints. shm passes hints through shared memory, and needs --unix-socket. Falls back to binary if the receiver doesn\'t support shm, and to json if it only speaks json (default: binary)')
 
     return parser.parse_args()
 
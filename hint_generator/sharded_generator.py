@@ -0,0 +1,377 @@
+import time
+import struct
+import asyncio
+import logging
+import functools
+import multiprocessing
+from collections import deque
+
+from shm_ring import ShmRing, DEFAULT_RING_SIZE, MIN_POLL_DELAY, MAX_POLL_DELAY
+from metrics import counter
+from hint_types import SECTOR_SIZE
+from hint_generator import HintGenerator, is_block_write, empty_hint
+
+SUPERVISE_INTERVAL = 1.0
+ACK_POLL_INTERVAL = 0.01
+STOP_TIMEOUT = 5
+# Chunks are trimmed every this many chunks
+TRIM_EVERY = 64
+# Block records are dealt out to the shards by region of the device. A region is a whole number of btier blocks.
+SHARD_REGION_SIZE = 16 * 1024 * 1024
+# sequence number, source id, timestamp. Followed by the chunk as the source read it.
+CHUNK_HEADER = struct.Struct('=QBq')
+# Source id of the chunk that tells a shard to stop
+STOP_CHUNK = 0xFF
+
+def owns_sector(shard, shard_count, sector):
+    """
+    Whether the block records of a sector offset go to shard. All the records of a region (see SHARD_REGION_SIZE) go to
+    the same shard, and so all the hints of a btier block come from it.
+    """
+    return sector * SECTOR_SIZE // SHARD_REGION_SIZE % shard_count == shard
+
+class ShardProgress:
+    """
+    How far a shard got, in shared memory, for the shard that replaces it to pick up from: the last chunk whose match
+    hints were all handled, how many match hints of the chunk after it were, and how many bytes of each source the
+    shard's decoders kept after that chunk (see RecordDecoder.leftover). Also the CPU time the shard spent generating,
+    once it stopped.
+
+    Only the shard writes it. A write goes to the slot that isn't current, which is then made current, so a shard that
+    dies halfway through a write leaves the last whole one behind.
+    """
+    def __init__(self, source_count, context=multiprocessing):
+        self._slot_size = 2 + source_count
+        self._current = 2 * self._slot_size
+        self._cpu_time = self._current + 1
+        self._values = context.RawArray('q', 2 * self._slot_size + 2)
+        # No chunk yet
+        self._values[0] = -1
+
+    def read(self):
+        """
+        Returns (sequence number of the last chunk handled, match hints of the next one handled, leftover bytes per
+        source)
+        """
+        start = self._values[self._current] * self._slot_size
+        values = self._values[start:start + self._slot_size]
+        return values[0], values[1], values[2:]
+
+    def write(self, sequence, matches, leftovers):
+        slot = 1 - self._values[self._current]
+        start = slot * self._slot_size
+        self._values[start:start + self._slot_size] = [sequence, matches] + list(leftovers)
+        self._values[self._current] = slot
+
+    @property
+    def cpu_time(self):
+        """
+        Seconds of CPU time the shard spent generating, or 0 if it didn't stop yet
+        """
+        return self._values[self._cpu_time] / 1e9
+
+    @cpu_time.setter
+    def cpu_time(self, seconds):
+        self._values[self._cpu_time] = int(seconds * 1e9)
+
+class ShardedGenerator:
+    """
+    Generates hints on shard_count worker processes, each running its own HintGenerator and sending its hints with its
+    own client, to get past the GIL.
+
+    Sources read into it like into a queue, but with put_chunk() (see TraceSource.async_read_into()). What they read is
+    passed on to every shard as is, through a shared memory ring per shard (see ShmRing), so nothing is done per record
+    in this process. Each shard decodes every chunk with a decoder of its source (see TraceSource.make_decoder()). It
+    keeps all the file and post cache records, which its correlation index needs, but only the block records of its
+    own regions of the device (see owns_sector()). A btier block's match hints are all sent by one shard, through one
+    client, in the order its block writes were traced. Records aren't sampled.
+
+    client_factory is called in each shard for the client to send hints with. It should be picklable, e.g. a
+    functools.partial of HintClient, and make an object with the asyncio coroutines start(), send_hint(hint) and
+    close(). If the client has acked_matches (see HintClient), a match hint counts as handled once acknowledged,
+    otherwise once it's sent.
+
+    run() checks on the shards every supervise_interval seconds, and replaces shards whose process is gone. The new
+    shard picks up where the old one left off (see ShardProgress): it decodes the chunks after the last one whose match
+    hints were all handled, and sends their hints, skipping the match hints that were already handled. Chunks are kept
+    in this process until every shard is done with them.
+    """
+    def __init__(self, shard_count, sources, client_factory, generator_factory=HintGenerator,
+                 ring_size=DEFAULT_RING_SIZE, supervise_interval=SUPERVISE_INTERVAL):
+        self.shard_count = shard_count
+        self.client_factory = client_factory
+        self.generator_factory = generator_factory
+        self.supervise_interval = supervise_interval
+        for source in sources:
+            if not hasattr(source, 'make_decoder'):
+                raise ValueError(f"{type(source).__name__} can't be sharded, its records can't be read undecoded")
+        self._source_ids = {source.type: source_id for source_id, source in enumerate(sources)}
+        self._decoders = [source.make_decoder() for source in sources]
+        self._context = multiprocessing.get_context('spawn')
+        self._rings = [ShmRing.create(ring_size) for i in range(shard_count)]
+        self._progress = [ShardProgress(len(sources), self._context) for i in range(shard_count)]
+        self._processes = [None] * shard_count
+        # A shard's ring is written by one put_chunk() at a time, and not at all while the shard is replaced
+        self._locks = [asyncio.Lock() for i in range(shard_count)]
+        # Sequence number of the last chunk written to each shard's ring
+        self._written = [-1] * shard_count
+        self._sequence = 0
+        # (sequence number, source id, chunk) of the chunks a shard might still need
+        self._chunks = deque()
+        self._logger = logging.getLogger('sharded_generator')
+        self._chunks_put = counter('generator.chunks')
+        self._chunk_bytes = counter('generator.chunk_bytes')
+        self._restarts = counter('generator.shard_restarts')
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        for shard in range(self.shard_count):
+            self._start_shard(shard)
+        self._logger.info("Started %d generator shards", self.shard_count)
+
+    def _start_shard(self, shard, leftovers=None):
+        process = self._context.Process(target=run_shard, name=f'hint_shard_{shard}', daemon=True,
+                                        args=(shard, self.shard_count, self._rings[shard].name, self._decoders,
+                                              self._progress[shard], self.generator_factory, self.client_factory,
+                                              leftovers, logging.getLogger().getEffectiveLevel()))
+        process.start()
+        self._processes[shard] = process
+
+    async def put_chunk(self, source_type, data, timestamp):
+        """
+        Pass a chunk of a source on to every shard. Blocks while a shard's ring is full.
+
+        This is an asyncio coroutine
+        """
+        sequence = self._sequence
+        self._sequence += 1
+        source_id = self._source_ids[source_type]
+        chunk = CHUNK_HEADER.pack(sequence, source_id, timestamp) + data
+        self._chunks.append((sequence, source_id, chunk))
+        self._chunks_put.inc()
+        self._chunk_bytes.inc(len(data))
+        for shard, ring in enumerate(self._rings):
+            lock = self._locks[shard]
+            if not lock.locked() and self._written[shard] == sequence - 1 and ring.try_write(chunk):
+                self._written[shard] = sequence
+                continue
+            async with lock:
+                await self._catch_up(shard)
+        if not sequence % TRIM_EVERY:
+            self._trim()
+
+    async def _catch_up(self, shard):
+        """
+        Write the chunks the shard didn't get yet to its ring, waiting for room, and replace the shard if its process
+        is gone meanwhile. Should be called with the shard's lock held.
+        """
+        ring = self._rings[shard]
+        delay = MIN_POLL_DELAY
+        while self._written[shard] < self._sequence - 1:
+            # Chunks are kept by sequence number, from the first one some shard still needs
+            sequence, source_id, chunk = self._chunks[self._written[shard] + 1 - self._chunks[0][0]]
+            if ring.try_write(chunk):
+                self._written[shard] = sequence
+                delay = MIN_POLL_DELAY
+            elif not self._processes[shard].is_alive():
+                self._restart(shard)
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_POLL_DELAY)
+
+    def _trim(self):
+        """
+        Forget the chunks no shard needs anymore: those every shard handled, but for the ones the leftover bytes of
+        their decoders came from
+        """
+        states = [progress.read() for progress in self._progress]
+        handled = min(sequence for sequence, matches, leftovers in states)
+        needed = [max(leftovers[source_id] for sequence, matches, leftovers in states)
+                  for source_id in range(len(self._decoders))]
+        first_kept = handled + 1
+        for sequence, source_id, chunk in reversed(self._chunks):
+            if not any(length > 0 for length in needed):
+                break
+            if sequence <= handled and needed[source_id] > 0:
+                needed[source_id] -= len(chunk) - CHUNK_HEADER.size
+                first_kept = sequence
+        while self._chunks and self._chunks[0][0] < first_kept:
+            self._chunks.popleft()
+
+    async def run(self):
+        """
+        Replace shards whose process is gone, until cancelled
+
+        This is an asyncio coroutine
+        """
+        while True:
+            await asyncio.sleep(self.supervise_interval)
+            for shard in range(self.shard_count):
+                if not self._processes[shard].is_alive():
+                    async with self._locks[shard]:
+                        if not self._processes[shard].is_alive():
+                            self._restart(shard)
+                        await self._catch_up(shard)
+            self._trim()
+
+    def _restart(self, shard):
+        """
+        Replace a shard whose process is gone with a new one, that picks up where it left off. The chunks after that
+        are written to its ring by _catch_up().
+        """
+        self._logger.error("Generator shard %d exited with code %s, restarting it", shard,
+                           self._processes[shard].exitcode)
+        self._restarts.inc()
+        # Whatever the shard didn't get to is kept in self._chunks too
+        self._rings[shard].read_many()
+        handled, matches, leftovers = self._progress[shard].read()
+        self._start_shard(shard, self._leftover_bytes(handled, leftovers))
+        self._written[shard] = handled
+
+    def _leftover_bytes(self, handled, lengths):
+        """
+        The last lengths[source id] bytes of each source, up to the chunk with sequence number handled
+        """
+        parts = [[] for length in lengths]
+        sizes = [0] * len(lengths)
+        for sequence, source_id, chunk in reversed(self._chunks):
+            if sequence <= handled and sizes[source_id] < lengths[source_id]:
+                parts[source_id].append(chunk[CHUNK_HEADER.size:])
+                sizes[source_id] += len(chunk) - CHUNK_HEADER.size
+        return [b''.join(reversed(source_parts))[-length:] if length else b''
+                for source_parts, length in zip(parts, lengths)]
+
+    def cpu_times(self):
+        """
+        Seconds of CPU time each shard spent generating, once they stopped (see close())
+        """
+        return [progress.cpu_time for progress in self._progress]
+
+    async def close(self, timeout=STOP_TIMEOUT):
+        """
+        Stop the worker processes once they're done with the chunks put so far, terminating those that aren't done in
+        timeout seconds, and free the rings
+
+        This is an asyncio coroutine
+        """
+        stop = CHUNK_HEADER.pack(self._sequence, STOP_CHUNK, 0)
+        deadline = time.monotonic() + timeout
+        for shard, ring in enumerate(self._rings):
+            async with self._locks[shard]:
+                while (not ring.try_write(stop) and self._processes[shard].is_alive()
+                       and time.monotonic() < deadline):
+                    await asyncio.sleep(MAX_POLL_DELAY)
+        for process in self._processes:
+            while process.is_alive() and time.monotonic() < deadline:
+                await asyncio.sleep(ACK_POLL_INTERVAL)
+            if process.is_alive():
+                self._logger.warning("Generator shard %s didn't stop in time, terminating it", process.name)
+                process.terminate()
+            process.join()
+        for ring in self._rings:
+            ring.close()
+            ring.unlink()
+
+class ShardAcks:
+    """
+    Keeps a shard's ShardProgress up to date with the match hints its client handled
+    """
+    def __init__(self, progress, client):
+        self._progress = progress
+        self._client = client
+        handled, matches, leftovers = progress.read()
+        # The match hints of the chunk after the last handled one that a shard before this one had handled
+        self.skipped = matches
+        # Match hints sent, counting the skipped ones
+        self.sent = matches
+        # (sequence number, match hints sent up to and including it, leftover bytes per source) of the chunks that
+        # had match hints that weren't handled yet
+        self._chunks = deque()
+        self._handled = (handled, 0, leftovers)
+        self._written = (handled, matches)
+
+    def chunk_done(self, sequence, leftovers):
+        self._chunks.append((sequence, self.sent, leftovers))
+        self.update()
+
+    def update(self):
+        acked = getattr(self._client, 'acked_matches', None)
+        handled_matches = self.sent if acked is None else self.skipped + acked
+        while self._chunks and self._chunks[0][1] <= handled_matches:
+            self._handled = self._chunks.popleft()
+        sequence, sent, leftovers = self._handled
+        if self._written != (sequence, handled_matches - sent):
+            self._written = (sequence, handled_matches - sent)
+            self._progress.write(sequence, handled_matches - sent, leftovers)
+
+def run_shard(shard, shard_count, ring_name, decoders, progress, generator_factory, client_factory, leftovers,
+              log_level):
+    """
+    Entry point of a shard's worker process. leftovers are the bytes of each source the decoders of the shard this one
+    replaces had kept, if it replaces one.
+    """
+    logging.basicConfig(level=log_level)
+    keep_sector = functools.partial(owns_sector, shard, shard_count)
+    for source_id, decoder in enumerate(decoders):
+        if hasattr(decoder, 'keep_sector'):
+            decoder.keep_sector = keep_sector
+        if leftovers:
+            decoder.prime(leftovers[source_id])
+    ring = ShmRing.attach(ring_name)
+    try:
+        asyncio.run(_generate(ring, decoders, progress, generator_factory(), client_factory()))
+    finally:
+        ring.close()
+
+async def _generate(ring, decoders, progress, generator, client):
+    logger = logging.getLogger('hint_shard')
+    await client.start()
+    acks = ShardAcks(progress, client)
+    if acks.skipped:
+        logger.info("Picking up after chunk %d, skipping %d match hints that were handled", *progress.read()[:2])
+    poller = asyncio.ensure_future(_poll_acks(acks))
+    start_time = time.process_time()
+    handle_trace_record = generator.handle_trace_record
+    send_hint = client.send_hint
+    skip = acks.skipped
+    try:
+        while True:
+            for chunk in await ring.read():
+                sequence, source_id, timestamp = CHUNK_HEADER.unpack_from(chunk)
+                if source_id == STOP_CHUNK:
+                    return
+                records = decoders[source_id].decode(memoryview(chunk)[CHUNK_HEADER.size:], timestamp)
+                if records.record_class.type != 'block':
+                    # Every shard gets these, they'd better be cheap
+                    generator.index_file_records(records)
+                    acks.chunk_done(sequence, [len(decoder.leftover) for decoder in decoders])
+                    continue
+                for record in records:
+                    try:
+                        hint = await handle_trace_record(record)
+                    except Exception:
+                        logger.exception('Got error, skipping')
+                        # btier holds block writes until they get a match hint
+                        hint = empty_hint(record) if is_block_write(record) else None
+                        if hint:
+                            hint.match = True
+                    if not hint:
+                        continue
+                    if hint.match:
+                        if skip:
+                            skip -= 1
+                            continue
+                        acks.sent += 1
+                    await send_hint(hint)
+                acks.chunk_done(sequence, [len(decoder.leftover) for decoder in decoders])
+    finally:
+        poller.cancel()
+        await client.close()
+        progress.cpu_time = time.process_time() - start_time
+
+async def _poll_acks(acks):
+    while True:
+        await asyncio.sleep(ACK_POLL_INTERVAL)
+        acks.update()
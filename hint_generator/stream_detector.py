@@ -0,0 +1,84 @@
+from collections import OrderedDict
+
+from hint_types import PATTERN_SEQUENTIAL, PATTERN_STRIDED, PATTERN_RANDOM
+
+MAX_STREAMS = 4096
+MIN_RUN_LENGTH = 3
+PREFETCH_DEPTH = 8
+
+class StreamState:
+    __slots__ = ['last_offset', 'last_end', 'stride', 'run_length', 'prefetched_until']
+
+    def __init__(self, offset, size):
+        self.last_offset = offset
+        self.last_end = offset + size
+        self.stride = 0
+        self.run_length = 0
+        self.prefetched_until = 0
+
+class StreamDetector:
+    """
+    Detects sequential and strided access streams, and predicts the next ranges they'll access.
+
+    Streams are identified by a key (e.g. (inode, pid)), and their state is kept in an LRU of up to max_streams
+    entries, so the cost per access is constant and memory is bounded.
+
+    A stream is sequential once min_run_length accesses in a row start where the previous one ended, and strided once
+    they're the same distance apart. Anything else is random. For non-random streams, observe() predicts the next
+    prefetch_depth accesses, but only once the stream gets halfway through the range it predicted last time, so the
+    same range isn't predicted over and over.
+    """
+    def __init__(self, max_streams=MAX_STREAMS, min_run_length=MIN_RUN_LENGTH, prefetch_depth=PREFETCH_DEPTH):
+        self.max_streams = max_streams
+        self.min_run_length = min_run_length
+        self.prefetch_depth = prefetch_depth
+        self._streams = OrderedDict()
+
+    def observe(self, key, offset, size, is_readahead=False):
+        """
+        Account an access of size bytes at offset for the stream key.
+        The kernel only reads ahead for streams it considers sequential, so is_readahead accesses count as such.
+
+        Returns (pattern, offset, size) of the predicted range, or None if there's nothing to predict.
+        """
+        state = self._streams.get(key)
+        if state is None:
+            self._streams[key] = StreamState(offset, size)
+            if len(self._streams) > self.max_streams:
+                self._streams.popitem(last=False)
+            return None
+        self._streams.move_to_end(key)
+
+        stride = offset - state.last_offset
+        if offset == state.last_end or is_readahead:
+            pattern = PATTERN_SEQUENTIAL
+            state.run_length = max(state.run_length + 1, self.min_run_length if is_readahead else 0)
+        elif stride and stride == state.stride:
+            pattern = PATTERN_STRIDED
+            state.run_length += 1
+        else:
+            pattern = PATTERN_RANDOM
+            state.run_length = 0
+            state.prefetched_until = 0
+        state.stride = stride
+        state.last_offset = offset
+        state.last_end = offset + size
+
+        if pattern == PATTERN_RANDOM or state.run_length < self.min_run_length:
+            return None
+        if pattern == PATTERN_SEQUENTIAL:
+            step = size
+            predicted_offset = max(state.last_end, state.prefetched_until)
+        else:
+            step = stride
+            predicted_offset = max(offset + stride, state.prefetched_until)
+        # The next prefetch_depth accesses start at offset + step, offset + 2 * step and so on, the last of them
+        # ending here
+        window_end = offset + step * self.prefetch_depth + size
+        if state.prefetched_until - offset > step * self.prefetch_depth // 2 or predicted_offset >= window_end:
+            return None
+        state.prefetched_until = window_end
+        return pattern, predicted_offset, window_end - predicted_offset
+
+    def __len__(self):
+        return len(self._streams)
@@ -0,0 +1,210 @@
+"""
+Source side filtering and sampling of file and post cache traces.
+
+The file trace modules see every syscall on the client, most of which may be I/O to local disks that never reaches the
+btier LUN. TraceFilter drops such records as they're decoded, before they're made into objects or queued. Once the
+queue the sources read into fills up anyway, AdaptiveSampler keeps only a share of the remaining advisory records, and
+gives the kept ones a weight, so statistics summed over records stay unbiased.
+"""
+import time
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+
+from metrics import counter, gauge
+
+MAX_CGROUP_PIDS = 4096
+SAMPLE_WATERMARK = 250
+MAX_SAMPLE_LEVEL = 4
+SAMPLE_ADJUST_INTERVAL = 0.1
+# Fibonacci hashing: the top bits of a key times this are well mixed, even for keys that differ only in low bits
+STREAM_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+STREAM_HASH_BITS = 32
+
+class TraceFilter:
+    """
+    Which records of a trace to keep:
+        * devices - (major, minor) pairs of the devices to keep I/O of
+        * pids - pids to keep I/O of
+        * cgroups - cgroup paths, e.g. /system.slice/iscsi.service, to keep I/O of processes in, or in their
+          descendants
+        * min_size - smallest I/O size to keep, in bytes
+    A missing or empty option keeps everything.
+
+    The cgroup of every pid is looked up in /proc once, and remembered for the last max_cgroup_pids pids. On an event
+    loop, the lookup is done on its default executor, so /proc is never read on the loop, and records of the pid are
+    dropped until it's done. Pids whose cgroup can't be read, i.e. that have exited already, are dropped, but not
+    remembered, since their pid may be reused.
+    """
+    def __init__(self, devices=None, pids=None, cgroups=None, min_size=0, max_cgroup_pids=MAX_CGROUP_PIDS):
+        self.devices = set(devices) if devices else None
+        self.pids = set(pids) if pids else None
+        self.cgroups = [cgroup.rstrip('/') for cgroup in cgroups] if cgroups else None
+        self.min_size = min_size
+        self.max_cgroup_pids = max_cgroup_pids
+        # pid -> whether it's in one of cgroups, least recently used first
+        self._pid_in_cgroups = OrderedDict()
+        # pids whose cgroup is being looked up
+        self._pending_pids = set()
+        self._logger = logging.getLogger('trace_filter')
+
+    def __bool__(self):
+        return bool(self.devices or self.pids or self.cgroups or self.min_size)
+
+    def matcher(self, record_class):
+        """
+        A function of the field values of a record of record_class (see trace_records), in the order of its fields,
+        that returns whether to keep the record. Filtering on values lets sources skip making objects of records they
+        drop.
+        """
+        fields = record_class.fields
+        pid_index = fields.index('pid')
+        major_index = fields.index('major')
+        minor_index = fields.index('minor')
+        size_index = fields.index('size')
+        devices = self.devices
+        pids = self.pids
+        cgroups = self.cgroups
+        min_size = self.min_size
+        in_cgroups = self.in_cgroups
+
+        def matches(values):
+            if devices is not None and (values[major_index], values[minor_index]) not in devices:
+                return False
+            if values[size_index] < min_size:
+                return False
+            if pids is not None and values[pid_index] not in pids:
+                return False
+            if cgroups is not None and not in_cgroups(values[pid_index]):
+                return False
+            return True
+        return matches
+
+    def in_cgroups(self, pid):
+        """
+        Whether pid is in one of cgroups, or in a descendant of one. False while its cgroup is being looked up.
+        """
+        try:
+            self._pid_in_cgroups.move_to_end(pid)
+            return self._pid_in_cgroups[pid]
+        except KeyError:
+            pass
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on an event loop, there's nothing to hold up
+            return self._remember(pid, self._cgroup_paths(pid))
+        if pid not in self._pending_pids:
+            self._pending_pids.add(pid)
+            lookup = loop.run_in_executor(None, self._cgroup_paths, pid)
+            lookup.add_done_callback(functools.partial(self._looked_up, pid))
+        return False
+
+    def _looked_up(self, pid, lookup):
+        self._pending_pids.discard(pid)
+        if not lookup.cancelled():
+            self._remember(pid, lookup.result())
+
+    def _remember(self, pid, paths):
+        """
+        Remember whether pid is in one of cgroups, given its cgroup paths, and return it. Pids that are gone aren't
+        remembered.
+        """
+        if paths is None:
+            return False
+        result = any(self._is_under(path) for path in paths)
+        self._pid_in_cgroups[pid] = result
+        if len(self._pid_in_cgroups) > self.max_cgroup_pids:
+            self._pid_in_cgroups.popitem(last=False)
+        return result
+
+    def _is_under(self, path):
+        for cgroup in self.cgroups:
+            if path == cgroup or path.startswith(cgroup + '/'):
+                return True
+        return False
+
+    def _cgroup_paths(self, pid):
+        """
+        The cgroup paths of pid, one per hierarchy (see cgroups(7)). None if it's gone.
+        """
+        try:
+            with open(f'/proc/{pid}/cgroup') as cgroup_file:
+                return [line.rstrip('\n').split(':', 2)[2] for line in cgroup_file]
+        except (OSError, IndexError) as e:
+            self._logger.debug(f"Can't get the cgroup of pid {pid}: {e}")
+            return None
+
+def stream_hash(pid, inode):
+    """
+    A STREAM_HASH_BITS bits hash of a stream
+    """
+    return ((inode ^ pid << 40) * STREAM_HASH_MULTIPLIER & 0xFFFFFFFFFFFFFFFF) >> (64 - STREAM_HASH_BITS)
+
+class AdaptiveSampler:
+    """
+    Samples records put into a queue once it's overloaded. Records for which is_urgent(record) is true are always
+    kept.
+
+    Call adjust() with the queue's depth before every batch of records. While the queue holds more than watermark
+    records, the sampling level goes up by one every adjust_interval seconds, up to max_level, and while it holds less
+    than half of that, it goes back down. The watermark should be below the consumer's LoadShedder's, so streams are
+    sampled at the source before single records are shed off the queue.
+
+    At level n, one in 2 ** n streams (records of a pid and inode) is kept, rather than one in 2 ** n records, so the
+    kept streams still look sequential to the StreamDetector. Kept records get a weight of 2 ** n, the number of
+    records each stands for. Sums of weights are unbiased estimates of the sums of records, but when a few streams do
+    most of the I/O they're noisy at high levels (see benchmarks/trace_filter.py).
+
+    Counts are kept under source.{name}.*: sampled counts the records kept while sampling, and sampled_out the ones
+    that were dropped. The current level is the source.{name}.sample_level gauge.
+    """
+    def __init__(self, name, is_urgent, watermark=SAMPLE_WATERMARK, max_level=MAX_SAMPLE_LEVEL,
+                 adjust_interval=SAMPLE_ADJUST_INTERVAL):
+        self.is_urgent = is_urgent
+        self.watermark = watermark
+        self.max_level = max_level
+        self.adjust_interval = adjust_interval
+        self.level = 0
+        self._shift = STREAM_HASH_BITS
+        self._last_adjust = 0
+        self._logger = logging.getLogger(name)
+        self._sampled = counter(f'source.{name}.sampled')
+        self._sampled_out = counter(f'source.{name}.sampled_out')
+        gauge(f'source.{name}.sample_level', lambda: self.level)
+
+    def adjust(self, queue_depth):
+        """
+        Raise or lower the sampling level according to the depth of the queue records are put into
+        """
+        now = time.monotonic()
+        if now - self._last_adjust < self.adjust_interval:
+            return
+        if queue_depth > self.watermark and self.level < self.max_level:
+            self._set_level(self.level + 1)
+        elif queue_depth < self.watermark // 2 and self.level:
+            self._set_level(self.level - 1)
+        else:
+            return
+        self._last_adjust = now
+
+    def _set_level(self, level):
+        self._logger.info(f"Keeping 1 in {1 << level} streams")
+        self.level = level
+        self._shift = STREAM_HASH_BITS - level
+
+    def sample(self, record):
+        """
+        Whether to keep record. Kept records are given their weight.
+        """
+        if not self.level or self.is_urgent(record):
+            return True
+        # Streams are kept if the top level bits of their hash are 0, so the streams kept at a level are a subset of
+        # those kept at the one below it
+        if stream_hash(record.pid, record.inode) >> self._shift:
+            self._sampled_out.inc()
+            return False
+        record.weight = 1 << self.level
+        self._sampled.inc()
+        return True
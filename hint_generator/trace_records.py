@@ -0,0 +1,143 @@
+"""
+Trace records, as the trace sources (see hint_sources) read them and HintGenerator handles them.
+
+Every trace has a record class, with a slot for each of its fields, and a timestamp: when the record was read (see
+metrics), or 0 if that's unknown. Records of sampled traces also have a weight, the number of records each stands for
+(see trace_filter). Sources that decode many records at once return them as a RecordBatch, which keeps
+every field in an array and only makes record objects once they're iterated over, e.g. as they're put into a queue.
+"""
+from array import array
+from operator import attrgetter
+
+class TraceRecord:
+    """
+    Base class of trace records. Subclasses define:
+        * type - the type name of their trace (see TraceSource)
+        * fields - the names of their fields, in the order of the trace's binary format, which is also the order
+          __init__ takes them in, before timestamp
+        * typecodes - the array typecode of each field, for RecordBatch
+    """
+    __slots__ = ()
+    type = None
+    fields = ()
+    typecodes = ()
+    # Only post cache reads can tell
+    is_readahead = False
+    # Only file and post cache traces are sampled
+    weight = 1
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._values = attrgetter(*cls.fields)
+
+    def values(self):
+        """
+        The record's fields, in the order of fields
+        """
+        return self._values(self)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return (self.values() == other.values() and self.timestamp == other.timestamp and
+                self.weight == other.weight)
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={value!r}" for field, value in zip(self.fields, self.values()))
+        weight = f", weight={self.weight}" if self.weight != 1 else ""
+        return f"{type(self).__name__}({fields}, timestamp={self.timestamp}{weight})"
+
+class FileRecord(TraceRecord):
+    """
+    pre-cache (syscall level) file trace record
+    """
+    __slots__ = ['pid', 'major', 'minor', 'inode', 'offset', 'size', 'is_write', 'timestamp', 'weight']
+    type = 'file'
+    fields = ('pid', 'major', 'minor', 'inode', 'offset', 'size', 'is_write')
+    typecodes = ('I', 'I', 'I', 'Q', 'q', 'Q', 'B')
+
+    def __init__(self, pid, major, minor, inode, offset, size, is_write, timestamp=0, weight=1):
+        self.pid = pid
+        self.major = major
+        self.minor = minor
+        self.inode = inode
+        self.offset = offset
+        self.size = size
+        self.is_write = is_write
+        self.timestamp = timestamp
+        self.weight = weight
+
+class PostCacheRecord(FileRecord):
+    """
+    post-cache file trace record
+    """
+    __slots__ = ['is_readahead']
+    type = 'post_cache'
+    fields = ('pid', 'major', 'minor', 'inode', 'offset', 'size', 'is_readahead', 'is_write')
+    typecodes = ('I', 'I', 'I', 'Q', 'q', 'Q', 'B', 'B')
+
+    def __init__(self, pid, major, minor, inode, offset, size, is_readahead, is_write, timestamp=0, weight=1):
+        self.pid = pid
+        self.major = major
+        self.minor = minor
+        self.inode = inode
+        self.offset = offset
+        self.size = size
+        self.is_readahead = is_readahead
+        self.is_write = is_write
+        self.timestamp = timestamp
+        self.weight = weight
+
+class BlockRecord(TraceRecord):
+    """
+    Block trace record: offset is in sectors and size in bytes
+    """
+    __slots__ = ['pid', 'offset', 'size', 'is_write', 'timestamp']
+    type = 'block'
+    fields = ('pid', 'offset', 'size', 'is_write')
+    typecodes = ('I', 'Q', 'I', 'B')
+
+    def __init__(self, pid, offset, size, is_write, timestamp=0):
+        self.pid = pid
+        self.offset = offset
+        self.size = size
+        self.is_write = is_write
+        self.timestamp = timestamp
+
+class RecordBatch:
+    """
+    Records of record_class that were read together, and share a timestamp, as a struct of arrays: columns has an
+    array per field of record_class. Iterating over the batch, or indexing it, makes record objects.
+    """
+    __slots__ = ['record_class', 'columns', 'timestamp']
+
+    def __init__(self, record_class, columns=None, timestamp=0):
+        self.record_class = record_class
+        self.columns = columns or [array(typecode) for typecode in record_class.typecodes]
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_tuples(cls, record_class, tuples, timestamp=0):
+        """
+        Make a batch from tuples of field values, e.g. from struct.iter_unpack()
+        """
+        columns = [array(typecode, column) for typecode, column in zip(record_class.typecodes, zip(*tuples))]
+        return cls(record_class, columns, timestamp)
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        return self.record_class(*[column[index] for column in self.columns], self.timestamp)
+
+    def __iter__(self):
+        record_class = self.record_class
+        timestamp = self.timestamp
+        for values in zip(*self.columns):
+            yield record_class(*values, timestamp)
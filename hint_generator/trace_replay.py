@@ -0,0 +1,168 @@
+"""
+Trace files hold a merged stream of trace records, as the hint generator got them, for replaying later.
+
+The file starts with TRACE_FILE_HEADER (magic and version). Each record follows as a RECORD_HEADER (nanoseconds since
+the recording started, and a type code) and the record's fields, packed with the struct format of its type. The top
+bits of the type code are the log2 of the record's weight, which is a power of two for sampled records (see
+trace_filter) and 1 for the rest.
+"""
+import mmap
+import time
+import struct
+import asyncio
+import logging
+
+from hint_sources import FileTraceSource, PostCacheTraceSource
+from trace_records import FileRecord, PostCacheRecord, BlockRecord
+
+TRACE_FILE_HEADER = struct.Struct('=8sI')
+TRACE_FILE_MAGIC = b'HINTTRAC'
+TRACE_FILE_VERSION = 1
+RECORD_HEADER = struct.Struct('=QB')
+RECORD_BUFFER_SIZE = 1024 * 1024
+WEIGHT_SHIFT = 4
+TYPE_CODE_MASK = (1 << WEIGHT_SHIFT) - 1
+
+# type code -> (record class, struct of its fields)
+RECORD_TYPES = {
+        0: (FileRecord, struct.Struct(FileTraceSource._unpack_format)),
+        1: (PostCacheRecord, struct.Struct(PostCacheTraceSource._unpack_format)),
+        2: (BlockRecord, struct.Struct('=IQI?')),
+        }
+TYPE_CODES = {record_class.type: code for code, (record_class, record_struct) in RECORD_TYPES.items()}
+
+def pack_record(timestamp, record):
+    """
+    Pack a record and an integer timestamp into their trace file representation
+    """
+    code = TYPE_CODES[record.type]
+    record_class, record_struct = RECORD_TYPES[code]
+    weight_bits = (record.weight.bit_length() - 1) << WEIGHT_SHIFT
+    return RECORD_HEADER.pack(timestamp, code | weight_bits) + record_struct.pack(*record.values())
+
+def unpack_record(data, pos):
+    """
+    Unpack the record packed by pack_record() at pos of data.
+    Returns (timestamp, record, position after it), or None if data ends before the record does.
+    """
+    if len(data) - pos < RECORD_HEADER.size:
+        return None
+    timestamp, code = RECORD_HEADER.unpack_from(data, pos)
+    record_class, record_struct = RECORD_TYPES[code & TYPE_CODE_MASK]
+    pos += RECORD_HEADER.size
+    if len(data) - pos < record_struct.size:
+        return None
+    record = record_class(*record_struct.unpack_from(data, pos))
+    if code >> WEIGHT_SHIFT:
+        record.weight = 1 << (code >> WEIGHT_SHIFT)
+    return timestamp, record, pos + record_struct.size
+
+class TraceRecorder:
+    """
+    Write every record put into it to a trace file, then pass it on to queue.
+
+    Sources can read into it like they do into a queue.
+    """
+    def __init__(self, path, queue):
+        self.path = path
+        self.queue = queue
+        self.records = 0
+        self._file = open(path, 'wb', RECORD_BUFFER_SIZE)
+        self._file.write(TRACE_FILE_HEADER.pack(TRACE_FILE_MAGIC, TRACE_FILE_VERSION))
+        self._start = time.monotonic_ns()
+        self._logger = logging.getLogger('trace_recorder')
+
+    def record(self, record):
+        """
+        Append record to the trace file
+        """
+        self._file.write(pack_record(time.monotonic_ns() - self._start, record))
+        self.records += 1
+
+    async def put(self, record):
+        self.record(record)
+        await self.queue.put(record)
+
+    def put_nowait(self, record):
+        self.record(record)
+        self.queue.put_nowait(record)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def close(self):
+        self._file.close()
+        self._logger.info(f"Recorded {self.records} records to {self.path}")
+
+class ReplayTraceSource:
+    """
+    Replay a trace file written by TraceRecorder.
+
+    Records are replayed in the order they were recorded, at the recorded pace divided by speed, e.g. speed=2 replays
+    twice as fast. speed=0 replays as fast as they're taken.
+
+    For a deterministic replay, use replay() to hand records straight to the generator one by one, and clock() as
+    the generator's clock (see HintGenerator), so time is that of the recording however fast it's replayed.
+    async_read_into() puts records into a queue instead, like the live sources do.
+    """
+    type = "replay"
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        # Seconds since the recording started, of the record being replayed
+        self.now = 0.0
+        self._logger = logging.getLogger(self.type)
+
+    def clock(self):
+        """
+        The recorded time of the record being replayed, in seconds
+        """
+        return self.now
+
+    def records(self):
+        """
+        Iterate over the (timestamp, record) pairs in the trace file. Timestamps are in seconds since the recording
+        started.
+        """
+        with open(self.path, 'rb') as trace_file, mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version = TRACE_FILE_HEADER.unpack_from(data, 0)
+            if magic != TRACE_FILE_MAGIC or version != TRACE_FILE_VERSION:
+                raise ValueError(f"{self.path} isn't a version {TRACE_FILE_VERSION} trace file")
+            pos = TRACE_FILE_HEADER.size
+            while True:
+                unpacked = unpack_record(data, pos)
+                if unpacked is None:
+                    break
+                timestamp, record, pos = unpacked
+                yield timestamp / 1e9, record
+            if pos != len(data):
+                self._logger.warning(f"{self.path} ends with a partial record, it was probably cut short")
+
+    async def replay(self, handle_record):
+        """
+        Replay the trace, awaiting handle_record(record) for every record in turn, and return once it's all replayed.
+
+        This is an asyncio coroutine, and so should handle_record be.
+        """
+        self._logger.info(f"Replaying {self.path}" + (f" at {self.speed}x speed" if self.speed else ""))
+        start = time.monotonic()
+        count = 0
+        for timestamp, record in self.records():
+            if self.speed:
+                delay = start + timestamp / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.now = timestamp
+            record.timestamp = time.time_ns()
+            await handle_record(record)
+            count += 1
+        self._logger.info(f"Replayed {count} records in {time.monotonic() - start:.2f} seconds")
+
+    async def async_read_into(self, queue):
+        """
+        Replay the trace into the given queue, returning once it's all replayed.
+
+        This is an asyncio coroutine. queue should be an asyncio queue.
+        """
+        await self.replay(queue.put)
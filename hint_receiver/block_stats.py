@@ -0,0 +1,183 @@
+import time
+import heapq
+import asyncio
+import logging
+from array import array
+
+from tier_manager import BlockInfo
+
+BLOCK_STATS_TTL = 60
+SWEEP_BLOCKS_PER_SEC = 5000
+SWEEP_CHUNK_BLOCKS = 256
+NO_DEVICE = -1
+
+class BlockStatsCache:
+    """
+    A snapshot of btier's per-block stats (see TierManager.get_block_info), so placement policies can look at many
+    blocks without a sysfs round trip per block.
+
+    Stats are kept in compact arrays indexed by block number, and are filled by a background sweep (see sweep()) that
+    refreshes blocks older than ttl seconds, at most sweep_blocks_per_sec of them per second. Blocks we migrated
+    ourselves are invalidated (see invalidate()) and refreshed first.
+
+    Blocks that weren't fetched yet have device NO_DEVICE. The blocks of every tier are also indexed in a set, so
+    looking at a tier's blocks (see hottest() and coldest()) doesn't scan the whole device, and the sweep moves a
+    cursor over the device a chunk at a time, so no step of it is O(block count) either.
+    """
+    def __init__(self, tier_manager, ttl=BLOCK_STATS_TTL, sweep_blocks_per_sec=SWEEP_BLOCKS_PER_SEC):
+        self._tier_manager = tier_manager
+        self.ttl = ttl
+        self.sweep_blocks_per_sec = sweep_blocks_per_sec
+        self.block_count = 0
+        self.device = array('b')
+        self.offset = array('Q')
+        self.atime = array('L')
+        self.readcount = array('L')
+        self.writecount = array('L')
+        self._refreshed = array('d')
+        self._invalidated = set()
+        # tier -> block numbers on it
+        self._tier_blocks = {}
+        self._sweep_cursor = 0
+        self._sweep_started = None
+        self._logger = logging.getLogger('block_stats')
+
+    def resize(self, block_count):
+        """
+        Set the number of blocks tracked. Called by sweep() according to the size of the btier device.
+        """
+        extra = block_count - self.block_count
+        if extra > 0:
+            self.device.extend(array('b', [NO_DEVICE]) * extra)
+            for stat in (self.offset, self.atime, self.readcount, self.writecount):
+                stat.extend(array(stat.typecode, [0]) * extra)
+            self._refreshed.extend(array('d', [0]) * extra)
+        self.block_count = block_count
+
+    def update(self, blocknr, block_info):
+        """
+        Store block_info, a BlockInfo, as the current stats of blocknr
+        """
+        old_device = self.device[blocknr]
+        if old_device != block_info.device:
+            if old_device != NO_DEVICE:
+                self._tier_blocks[old_device].discard(blocknr)
+            self._tier_blocks.setdefault(block_info.device, set()).add(blocknr)
+        self.device[blocknr] = block_info.device
+        self.offset[blocknr] = block_info.offset
+        self.atime[blocknr] = block_info.atime
+        self.readcount[blocknr] = block_info.readcount
+        self.writecount[blocknr] = block_info.writecount
+        self._refreshed[blocknr] = time.monotonic()
+
+    def get(self, blocknr):
+        """
+        Return the cached BlockInfo of blocknr, or None if it wasn't fetched yet
+        """
+        if blocknr >= self.block_count or self.device[blocknr] == NO_DEVICE:
+            return None
+        return BlockInfo(self.device[blocknr], self.offset[blocknr], self.atime[blocknr],
+                         self.readcount[blocknr], self.writecount[blocknr])
+
+    def age(self, blocknr):
+        """
+        Seconds since blocknr was last fetched. Infinite if it was never fetched or was invalidated.
+        """
+        refreshed = self._refreshed[blocknr]
+        return time.monotonic() - refreshed if refreshed else float('inf')
+
+    def invalidate(self, blocknr):
+        """
+        Mark blocknr's stats as stale, e.g. after we migrated it
+        """
+        if blocknr < self.block_count:
+            self._refreshed[blocknr] = 0
+            self._invalidated.add(blocknr)
+
+    def invalidate_many(self, migrations):
+        """
+        Invalidate blocks of a batch of (blocknr, dest_tier) migrations (see MigrationScheduler)
+        """
+        for blocknr, dest_tier in migrations:
+            self.invalidate(blocknr)
+
+    def hottest(self, tier, k, counts=None):
+        """
+        Return the block numbers of the k blocks on tier with the highest counts, hottest first.
+        counts is one of the count arrays (self.readcount, self.writecount), default is read+write.
+        """
+        return heapq.nlargest(k, self._blocks_on(tier), key=self._count_key(counts))
+
+    def coldest(self, tier, k, counts=None):
+        """
+        Return the block numbers of the k blocks on tier with the lowest counts, coldest first.
+        counts is one of the count arrays (self.readcount, self.writecount), default is read+write.
+        """
+        return heapq.nsmallest(k, self._blocks_on(tier), key=self._count_key(counts))
+
+    def _blocks_on(self, tier):
+        return self._tier_blocks.get(tier, ())
+
+    def _count_key(self, counts):
+        if counts is not None:
+            return counts.__getitem__
+        readcount, writecount = self.readcount, self.writecount
+        return lambda blocknr: readcount[blocknr] + writecount[blocknr]
+
+    async def sweep(self):
+        """
+        Keep refreshing the stats in the background. The sysfs reads run in the default executor.
+
+        This is an asyncio coroutine
+        """
+        loop = asyncio.get_event_loop()
+        if not self.block_count:
+            try:
+                self.resize(await loop.run_in_executor(None, self._tier_manager.get_block_count))
+            except OSError:
+                self._logger.exception("Can't get the number of blocks, block stats are disabled")
+                return
+            self._logger.info("Tracking %d blocks", self.block_count)
+        while True:
+            chunk = self._stale_chunk(SWEEP_CHUNK_BLOCKS)
+            if chunk is None:
+                await asyncio.sleep(min(self.ttl, 1))
+                continue
+            if chunk:
+                try:
+                    fetched = await loop.run_in_executor(None, self._fetch, chunk)
+                except Exception:
+                    self._logger.exception("Failed fetching block stats")
+                    fetched = []
+                for blocknr, block_info in fetched:
+                    self.update(blocknr, block_info)
+            # Also yields to the loop between chunks that were all fresh
+            await asyncio.sleep(len(chunk) / self.sweep_blocks_per_sec)
+
+    def _stale_chunk(self, max_blocks):
+        """
+        Return up to max_blocks blocks that need a refresh: invalidated ones first, then the stale ones among the next
+        max_blocks blocks from the sweep cursor. Returns None once the cursor went over the whole device, until ttl
+        seconds passed since it started doing so.
+        """
+        chunk = []
+        while self._invalidated and len(chunk) < max_blocks:
+            chunk.append(self._invalidated.pop())
+        if chunk:
+            return chunk
+        now = time.monotonic()
+        if self._sweep_cursor >= self.block_count or self._sweep_started is None:
+            if self._sweep_started is not None and now - self._sweep_started < self.ttl:
+                return None
+            self._sweep_cursor = 0
+            self._sweep_started = now
+        start = self._sweep_cursor
+        end = min(start + max_blocks, self.block_count)
+        self._sweep_cursor = end
+        deadline = now - self.ttl
+        refreshed = self._refreshed
+        return [blocknr for blocknr in range(start, end) if refreshed[blocknr] < deadline]
+
+    def _fetch(self, blocks):
+        get_block_info = self._tier_manager.get_block_info
+        return [(blocknr, get_block_info(blocknr)) for blocknr in blocks]
@@ -0,0 +1,88 @@
+import os
+import errno
+import fcntl
+import struct
+import logging
+
+TIER_HINTINJECT = 0xFE0B
+# offset, size, placement decision. See btier's TIER_HINTINJECT
+HINT_ENTRY = struct.Struct('qQi')
+# What writing to a device that has no write operation fails with
+WRITE_UNSUPPORTED_ERRORS = (errno.EINVAL, errno.EBADF, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY)
+
+class BtierControl:
+    """
+    btier's control device, used for injecting hints for pending write requests.
+
+    Hints are passed as a buffer of packed HINT_ENTRY entries, and a batch is submitted with a single write of the
+    buffer on the control device, so a batch costs one syscall however big it is. This needs btier to accept writes of
+    HINT_ENTRY arrays on the control device. If it rejects them (see WRITE_UNSUPPORTED_ERRORS), that's logged once,
+    and from then on every entry is injected with its own TIER_HINTINJECT ioctl, which takes a single entry. The
+    entries still go straight from the buffer, without copying or re-packing, but batching saves no syscalls then.
+    """
+    def __init__(self, device='/dev/tiercontrol'):
+        self.device = device
+        self._control = open(device, 'wb', 0)
+        self.batch_writes = True
+        self._logger = logging.getLogger('btier_control')
+
+    def inject(self, entries, count):
+        """
+        Inject the first count entries from the buffer entries
+        """
+        fd = self._control.fileno()
+        view = memoryview(entries)[:count * HINT_ENTRY.size]
+        if self.batch_writes:
+            try:
+                while view:
+                    # btier takes whole entries, so a short write leaves whole entries to write
+                    view = view[os.write(fd, view):]
+                return
+            except OSError as e:
+                if e.errno not in WRITE_UNSUPPORTED_ERRORS:
+                    raise
+                self._logger.warning(f"{self.device} doesn't take batches of hints ({e}), injecting them one by one")
+                self.batch_writes = False
+        for position in range(0, len(view), HINT_ENTRY.size):
+            fcntl.ioctl(fd, TIER_HINTINJECT, view[position:position + HINT_ENTRY.size])
+
+    def close(self):
+        self._control.close()
+
+class FakeBtierControl:
+    """
+    A stand-in for the btier control device, for testing and benchmarking without btier.
+
+    Injected entries are written to the file in path, a batch in one write call like BtierControl does, or with
+    batch_writes false, each entry with its own write call, like BtierControl's ioctl per entry. Use read_entries()
+    to get back what was injected, calls for the number of inject() calls, i.e. of batches, and syscalls for the
+    number of writes.
+    """
+    def __init__(self, path, batch_writes=True):
+        self.device = path
+        self.batch_writes = batch_writes
+        self._control = open(path, 'wb', 0)
+        self.calls = 0
+        self.syscalls = 0
+
+    def inject(self, entries, count):
+        fd = self._control.fileno()
+        view = memoryview(entries)[:count * HINT_ENTRY.size]
+        if self.batch_writes:
+            os.write(fd, view)
+            self.syscalls += 1
+        else:
+            for position in range(0, len(view), HINT_ENTRY.size):
+                os.write(fd, view[position:position + HINT_ENTRY.size])
+            self.syscalls += count
+        self.calls += 1
+
+    def read_entries(self):
+        """
+        Return a list of (offset, size, placement decision) of all the injected entries
+        """
+        with open(self.device, 'rb') as control:
+            return list(HINT_ENTRY.iter_unpack(control.read()))
+
+    def close(self):
+        self._control.close()
@@ -0,0 +1,151 @@
+import time
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from hint_queues import STATS_INTERVAL, DelayStats
+
+MIGRATION_THREADS = 2
+MAX_PENDING_MIGRATIONS = 1024
+
+class WorkerStats:
+    """
+    Stats of one kind of btier work: how much is queued, and how long it takes from submission to completion.
+
+    Work is submitted on the event loop and completes on worker threads, so the stats are only updated through
+    submit(), drop() and complete(), under a lock.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = DelayStats()
+        self._lock = threading.Lock()
+
+    def submit(self):
+        with self._lock:
+            self.submitted += 1
+
+    def drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def complete(self, submit_time, failed=False):
+        latency = time.monotonic() - submit_time
+        with self._lock:
+            self.completed += 1
+            if failed:
+                self.failed += 1
+            self.latency.add(latency)
+
+    @property
+    def depth(self):
+        with self._lock:
+            return self.submitted - self.completed
+
+    def report(self):
+        """
+        Return a summary of the stats, and start measuring latency anew
+        """
+        with self._lock:
+            summary = str(self)
+            self.latency.reset()
+        return summary
+
+    def __str__(self):
+        return "{} depth {}, {} dropped, {} failed, {}".format(self.name, self.submitted - self.completed,
+                                                              self.dropped, self.failed, self.latency)
+
+class BtierWorkers:
+    """
+    Runs blocking btier work (ioctls, sysfs writes) off the event loop, so it never stalls the receivers.
+
+    Injections run on a dedicated thread, in submission order. Since they're on the write path, submitting one is
+    just a put into the thread's queue: no futures and no event loop round trip on completion.
+    Migrations run on a separate thread pool, so a migration backlog never delays an injection. Migrations are only
+    an optimization, so once max_pending_migrations are waiting, new ones are dropped.
+    """
+    def __init__(self, migration_threads=MIGRATION_THREADS, max_pending_migrations=MAX_PENDING_MIGRATIONS):
+        self.max_pending_migrations = max_pending_migrations
+        self.inject_stats = WorkerStats('inject')
+        self.migration_stats = WorkerStats('migration')
+        self._logger = logging.getLogger('btier_workers')
+        self._inject_queue = queue.SimpleQueue()
+        self._inject_thread = threading.Thread(target=self._run_injections, name='btier_inject', daemon=True)
+        self._inject_thread.start()
+        self._migration_executor = ThreadPoolExecutor(max_workers=migration_threads, thread_name_prefix='btier_migrate')
+
+    def submit_injection(self, func, *args):
+        """
+        Run func(*args) on the injection thread
+        """
+        self.inject_stats.submit()
+        self._inject_queue.put((time.monotonic(), func, args))
+
+    async def wait_for_injections(self):
+        """
+        Wait until all the injections submitted so far are done
+
+        This is an asyncio coroutine
+        """
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        self.inject_stats.submit()
+        self._inject_queue.put((time.monotonic(), loop.call_soon_threadsafe, (done.set_result, None)))
+        await done
+
+    def _run_injections(self):
+        stats = self.inject_stats
+        while True:
+            item = self._inject_queue.get()
+            if item is None:
+                return
+            submit_time, func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                self._logger.error("inject failed: %r", e)
+                stats.complete(submit_time, failed=True)
+            else:
+                stats.complete(submit_time)
+
+    def submit_migration(self, func, *args):
+        """
+        Run func(*args) on the migration thread pool. Returns an asyncio future, or None if the migration was dropped.
+        """
+        stats = self.migration_stats
+        if stats.depth >= self.max_pending_migrations:
+            stats.drop()
+            return None
+        loop = asyncio.get_event_loop()
+        submit_time = time.monotonic()
+        stats.submit()
+        future = loop.run_in_executor(self._migration_executor, func, *args)
+
+        def done(future):
+            error = None if future.cancelled() else future.exception()
+            if error:
+                self._logger.error("migration failed: %r", error)
+            stats.complete(submit_time, failed=bool(error))
+        future.add_done_callback(done)
+        return future
+
+    async def report_stats(self, interval=STATS_INTERVAL):
+        """
+        Periodically log the queue depth and latency of injections and migrations
+
+        This is an asyncio coroutine
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for stats in (self.inject_stats, self.migration_stats):
+                self._logger.info("%s", stats.report())
+
+    def shutdown(self):
+        self._inject_queue.put(None)
+        self._inject_thread.join()
+        self._migration_executor.shutdown(cancel_futures=True)
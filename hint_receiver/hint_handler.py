@@ -1,12 +1,28 @@
+import time
 import asyncio
-import fcntl
-import struct
 import logging
+from collections import deque
 
-from tier_manager import TierManager
+from hint_types import HINT_NONE, HINT_PREFETCH, hint_weight
+from tier_manager import TierManager, BTIER_BLOCK_SIZE, SECTOR_SIZE, SYSFS_ROOT
+from btier_control import BtierControl, HINT_ENTRY
+from btier_workers import BtierWorkers
+from migration_scheduler import MigrationScheduler, MAX_BLOCKS_PER_SEC
+from block_stats import BlockStatsCache, BLOCK_STATS_TTL
+from metrics import counter, histogram
 
-TIER_HINTINJECT = 0xFE0B
 PLACEMENT_DONTCARE = -1
+INJECT_BATCH_SIZE = 32
+INJECT_BATCH_DELAY = 0.0002
+FASTEST_TIER = 0
+MAX_PREFETCH_BLOCKS = 64
+MAX_FREE_INJECT_BUFFERS = 64
+
+def is_match_hint(hint):
+    """
+    Whether the hint is for a pending write request in btier
+    """
+    return hint.match
 
 class HintHandler:
     """
@@ -17,22 +33,66 @@ class HintHandler:
           for a placement decision. Generate this decision and inject it to btier (see inject_to_btier)
         * Optionally migrate blocks based on this hint (see trigger_block_migration)
 
-    Format of the hint should be a dictionary with the following keys:
+    Hints are Hint objects (see hint_types):
         * offset - block offset into the device of the corresponding io request
         * size - size of the reqest, in blocks
-        * hint_type: int, specifying the hint type (you can choose anything here). Zero means a null hint.
-        * hint_data: data for the hint. Can be missing if hint_type==0. Can be anything.
+        * hint_type: int, specifying the hint type (see hint_types). Zero means a null hint.
+        * hint_data: data for the hint. Can be None if hint_type==0. Depends on hint_type.
         * match: bool. Should be True if the hint is for a pending write request.
+
+    Injections are batched: up to inject_batch_size hints are packed into one buffer and submitted together (see
+    BtierControl), at most inject_batch_delay seconds after the first of them arrived. A batch size of 1 injects every
+    hint right away. Buffers go back to a pool once they're injected, and are reused for later batches.
+
+    The blocking btier calls (ioctls and sysfs writes) run on worker threads (see BtierWorkers), never on the
+    event loop. Migrations go through a MigrationScheduler, whose run() should be running in the background.
+
+    Policies that need btier's per-block stats should use self.block_stats (see BlockStatsCache) rather than
+    TierManager.get_block_info(). Its sweep() should be running in the background.
+
+    Placement decisions come from placement_policy (see HeatPlacementPolicy), which is fed every null hint, as those
+    stand for actual accesses: writes if they're marked with 'match', reads otherwise (see the generator's
+    --read-hints). Without one, or for blocks it has no heat history of, btier decides on its own (PLACEMENT_DONTCARE).
+
+    Blocks in the range of a HINT_PREFETCH hint are promoted to the fastest tier. Hints in file space
+    (HINT_FILE_PREFETCH) can't be placed and are ignored.
+
+    Metrics are kept under handler.*. handler.read_to_inject is the time from reading the trace record of the oldest
+    hint in an injection batch on the generator until the batch is injected.
     """
-    def __init__(self, btier_control_device='/dev/tiercontrol', btier_data_device='/dev/sdtiera'):
+    def __init__(self, btier_control_device='/dev/tiercontrol', btier_data_device='/dev/sdtiera', btier_control=None,
+                 inject_batch_size=INJECT_BATCH_SIZE, inject_batch_delay=INJECT_BATCH_DELAY, workers=None,
+                 max_migrations_per_sec=MAX_BLOCKS_PER_SEC, block_stats_ttl=BLOCK_STATS_TTL, placement_policy=None,
+                 sysfs_root=SYSFS_ROOT):
         """
-        Init the handler, controlling the tiered device in btier_data_device using btier_control_device
+        Init the handler, controlling the tiered device in btier_data_device using btier_control_device.
+        btier_control can be given instead of btier_control_device, e.g. a FakeBtierControl for running without btier.
+        sysfs_root is where btier's sysfs directory of btier_data_device is looked for (see TierManager).
         """
         self.btier_control_device = btier_control_device
         self.btier_data_device = btier_data_device
-        self._btier_control = open(btier_control_device, 'wb', 0)
-        self._tier_manager = TierManager(btier_data_device)
+        self._btier_control = btier_control or BtierControl(btier_control_device)
+        self._tier_manager = TierManager(btier_data_device, sysfs_root)
+        self.workers = workers or BtierWorkers()
+        self.placement_policy = placement_policy
+        self.block_stats = BlockStatsCache(self._tier_manager, block_stats_ttl)
+        self.migration_scheduler = MigrationScheduler(self._tier_manager, self.workers, max_migrations_per_sec,
+                                                      on_submit=self.block_stats.invalidate_many)
         self._logger = logging.getLogger('hint_handler')
+        # Decided once, so the hot path doesn't even format log messages unless debug logging is on
+        self._debug = self._logger.isEnabledFor(logging.DEBUG)
+        self._injected = counter('handler.injected')
+        self._read_to_inject = histogram('handler.read_to_inject')
+
+        self.inject_batch_size = inject_batch_size
+        self.inject_batch_delay = inject_batch_delay
+        # Free injection buffers. Taken on the event loop and given back on the injection worker, which is safe
+        # with a deque
+        self._free_inject_buffers = deque()
+        self._inject_buffer = self._take_inject_buffer()
+        self._inject_count = 0
+        self._inject_oldest = None
+        self._inject_flush_handle = None
 
     async def handle_hint(self, hint):
         """
@@ -40,36 +100,111 @@ class HintHandler:
 
         This is an asyncio coroutine
         """
-        self._logger.debug("Handling hint", hint)
-        if hint.get('match'):
-            self._logger.debug("Hint should be injected")
+        if self._debug:
+            self._logger.debug("Handling hint %s", hint)
+        if hint.match:
             self.inject_to_btier(hint)
+        # Only once the target tier was chosen, so a write is placed by the heat its block had before it
+        if self.placement_policy and hint.hint_type == HINT_NONE:
+            self.placement_policy.record(hint.offset, hint.size, hint.match, hint_weight(hint))
         self.trigger_block_migration(hint)
 
     def inject_to_btier(self, hint):
         """
         For a hint that is to be injected, decide on a target tier for the request it represents,
-        then inject it into btier using TIER_HINTINJECT ioctl
+        then inject it into btier using TIER_HINTINJECT ioctl (see BtierControl).
+
+        The hint is packed into the current injection batch, which is submitted once it's full or once
+        inject_batch_delay passes.
         """
         target_tier = self._get_target_tier(hint)
-        packed_hint = self._pack_hint_entry(hint, target_tier)
-        self._logger.debug("Injecting hint: {} with target tier: {}".format(hint, target_tier))
-        fcntl.ioctl(self._btier_control, TIER_HINTINJECT, packed_hint)
+        if self._debug:
+            self._logger.debug("Injecting hint: %s with target tier: %s", hint, target_tier)
+        HINT_ENTRY.pack_into(self._inject_buffer, self._inject_count * HINT_ENTRY.size,
+                             hint.offset, hint.size, target_tier)
+        if not self._inject_count:
+            self._inject_oldest = hint.timestamp
+        self._inject_count += 1
+        if self._inject_count >= self.inject_batch_size:
+            self.flush_injections()
+        elif not self._inject_flush_handle:
+            self._inject_flush_handle = asyncio.get_event_loop().call_later(self.inject_batch_delay, self.flush_injections)
+
+    def flush_injections(self):
+        """
+        Submit the current injection batch to btier on the injection worker
+        """
+        if self._inject_flush_handle:
+            self._inject_flush_handle.cancel()
+            self._inject_flush_handle = None
+        count, self._inject_count = self._inject_count, 0
+        if not count:
+            return
+        # The worker owns the submitted buffer until it's injected
+        buffer, self._inject_buffer = self._inject_buffer, self._take_inject_buffer()
+        self.workers.submit_injection(self._inject, buffer, count, self._inject_oldest)
+
+    def _take_inject_buffer(self):
+        try:
+            return self._free_inject_buffers.pop()
+        except IndexError:
+            return bytearray(HINT_ENTRY.size * self.inject_batch_size)
+
+    def _inject(self, buffer, count, oldest_timestamp):
+        """
+        Inject a batch to btier. Runs on the injection worker.
+        """
+        try:
+            self._btier_control.inject(buffer, count)
+        finally:
+            if len(self._free_inject_buffers) < MAX_FREE_INJECT_BUFFERS:
+                self._free_inject_buffers.append(buffer)
+        self._injected.inc(count)
+        if oldest_timestamp:
+            self._read_to_inject.record(time.time_ns() - oldest_timestamp)
 
     def trigger_block_migration(self, hint):
         """
-        Optionally triggers block migrations based on the given hint
+        Optionally triggers block migrations based on the given hint.
+
+        Blocks the placement policy wants on a faster tier than the one they're on are promoted, and so are blocks
+        that are about to be prefetched. Demotions are left to btier's auto migration. Blocks that are already
+        pending migration or being migrated are skipped, without looking up their stats.
+        """
+        if hint.hint_type == HINT_PREFETCH:
+            self._prefetch_blocks(hint)
+            return
+        if not self.placement_policy or hint.match:
+            return
+        blocknr = self.placement_policy.block_of(hint.offset)
+        if self.migration_scheduler.is_pending(blocknr):
+            return
+        block_info = self.block_stats.get(blocknr)
+        if not block_info:
+            return
+        target_tier = self.placement_policy.target_tier(blocknr)
+        if target_tier is not None and target_tier < block_info.device:
+            self.migrate_block(blocknr, target_tier)
+
+    def migrate_block(self, blocknr, dest_tier):
         """
-        self._logger.debug("Trigerring block migration for hint", hint)
-        # Example: self._tier_manager.migrate(hint['offset'], TIER_NUM) See TierManager for more info
+        Schedule blocknr to be migrated to tier number dest_tier (see MigrationScheduler). Safe to call for every hint.
+        """
+        self.migration_scheduler.request(blocknr, dest_tier)
+
+    def _prefetch_blocks(self, hint):
+        first_block = hint.offset * SECTOR_SIZE // BTIER_BLOCK_SIZE
+        last_block = (hint.offset * SECTOR_SIZE + max(hint.size, 1) - 1) // BTIER_BLOCK_SIZE
+        for blocknr in range(first_block, min(last_block + 1, first_block + MAX_PREFETCH_BLOCKS)):
+            if self.migration_scheduler.is_pending(blocknr):
+                continue
+            block_info = self.block_stats.get(blocknr)
+            if block_info and block_info.device > FASTEST_TIER:
+                self.migrate_block(blocknr, FASTEST_TIER)
 
     def _get_target_tier(self, hint):
-        return PLACEMENT_DONTCARE
-
-    def _pack_hint_entry(self, hint_entry, placement_decision):
-        pack_format = 'qQi'
-        pack_fields = (hint_entry['offset'],
-                       hint_entry['size'],
-                       placement_decision)
-        packed_hint = struct.pack(pack_format, *pack_fields)
-        return packed_hint
+        if not self.placement_policy:
+            return PLACEMENT_DONTCARE
+        target_tier = self.placement_policy.target_tier(self.placement_policy.block_of(hint.offset))
+        # A block the policy knows nothing about yet is left to btier
+        return PLACEMENT_DONTCARE if target_tier is None else target_tier
@@ -1,17 +1,39 @@
+import os
+import time
 import asyncio
-import json
 import logging
 
+from hint_protocol import HELLO, SHM_HELLO, SHM_SLOT, MATCH_ACK, decode_json, decode_slots, read_frame
+from metrics import counter, histogram
+from shm_ring import ShmSlotRing, Doorbell
+
+# Hints are read from a shm ring this many at a time, so a full ring doesn't hold up other connections
+MAX_SHM_READ_HINTS = 1024
 
 class TCPHintReceiver:
     """
-    Receives hints using TCP
+    Receives hints using TCP, from any number of generators
+
+    Every connection gets its own lanes from lanes (see FairPriorityLanes), with the weight weights gives its peer's
+    host (default: 1). Once a connection's match lane is full, it isn't read from until there's room, so a generator
+    that sends match hints faster than they're handled is slowed down by TCP, without holding back the others.
+    Advisory hints that don't fit in their lane are shed if lanes has a shedder (see LoadShedder), rather than left
+    to block the connection, and the match hints behind them.
+
+    Metrics are kept under receiver.*. receiver.read_to_receive is the time from reading the trace record a hint came
+    from on the generator until it's received.
     """
-    def __init__(self, queue, host, port):
+    def __init__(self, lanes, host, port, weights=None):
         self.host = host
         self.port = port
-        self.queue = queue
+        self.lanes = lanes
+        self.weights = weights or {}
+        self.connections = 0
         self._logger = logging.getLogger('receiver')
+        self._connections = counter('receiver.connections')
+        self._hints_received = counter('receiver.hints')
+        self._bad_messages = counter('receiver.bad_messages')
+        self._read_to_receive = histogram('receiver.read_to_receive')
 
     async def start(self):
         """
@@ -33,26 +55,188 @@ class TCPHintReceiver:
 
         await self._server.wait_closed()
 
+    def _peer(self, writer):
+        """
+        Name of the peer of a connection, and the host weights are looked up by
+        """
+        addr = writer.get_extra_info('peername')
+        return addr, addr[0]
+
+    def _attach_ring(self, message):
+        """
+        Attach to the ring and open the doorbell named in a shm protocol handshake. Returns them, or None if that
+        can't be done.
+        """
+        self._logger.info("Shared memory was asked for over TCP, refusing")
+        return None
+
     async def _serve_client(self, reader, writer):
         """
         Handles a connected client. Meant to be used by asyncio.start_server().
 
-        Expects each message to be a json-encoded line.
+        Clients that open with the binary protocol handshake send frames of hints, those that open with the shm one
+        write hints to a shared memory ring, and others send json-encoded lines. See hint_protocol for details.
         """
-        addr = writer.get_extra_info('peername')
+        addr, host = self._peer(writer)
         self._logger.info("Got connection from {}".format(addr))
+        self._connections.inc()
+        self.connections += 1
+        queue = self.lanes.open(addr, self.weights.get(host, 1))
         try:
-            while True:
+            message = await reader.readline()
+            if message.startswith(SHM_HELLO + b' '):
+                attached = self._attach_ring(message)
+                if attached is not None:
+                    ring, doorbell = attached
+                    self._logger.info("Using shm protocol with {}".format(addr))
+                    try:
+                        writer.write(SHM_HELLO + b'\n')
+                        await writer.drain()
+                        await self._serve_shm(reader, writer, ring, doorbell, queue)
+                    finally:
+                        ring.close()
+                        doorbell.close()
+                    return
+                # The client reconnects to ask for the binary protocol, but it may as well ask on this connection
                 message = await reader.readline()
-                if not message:
-                    break
-                message = message.decode().strip()
-                try:
-                    parsed_message = json.loads(message)
-                    await self.queue.put(parsed_message)
-                except ValueError as e:
-                    self._logger.info("Bad message, ignoring")
-                    self._logger.debug("Message:", message, "Caused error:", e)
+            if message == HELLO:
+                self._logger.info("Using binary protocol with {}".format(addr))
+                writer.write(HELLO)
+                await writer.drain()
+                await self._serve_binary(reader, writer, queue)
+            else:
+                await self._serve_json(reader, message, queue)
         finally:
+            self.lanes.close(queue)
+            self.connections -= 1
             writer.close()
             self._logger.info("Connection to {} closed".format(addr))
+
+    async def _serve_json(self, reader, message, queue):
+        """
+        Read json-encoded lines, starting with the already read message
+        """
+        while message:
+            try:
+                hint = decode_json(message)
+                self._hints_received.inc()
+                if hint.timestamp:
+                    self._read_to_receive.record(time.time_ns() - hint.timestamp)
+                await queue.put(hint)
+            except ValueError as e:
+                self._bad_messages.inc()
+                self._logger.info("Bad message, ignoring")
+                self._logger.debug("Message: %s Caused error: %s", message, e)
+            message = await reader.readline()
+
+    async def _serve_binary(self, reader, writer, queue):
+        """
+        Read binary frames of hints, acknowledging the match hints in them
+        """
+        match_count = 0
+        while True:
+            try:
+                hints = await read_frame(reader)
+            except ValueError as e:
+                self._bad_messages.inc()
+                self._logger.info("Bad frame, ignoring")
+                self._logger.debug("Frame caused error: %s", e)
+                continue
+            if hints is None:
+                break
+            frame_matches = await self._receive_frame(hints, queue)
+            if frame_matches:
+                match_count += frame_matches
+                writer.write(MATCH_ACK.pack(match_count))
+
+    async def _serve_shm(self, reader, writer, ring, doorbell, queue):
+        """
+        Read hints from the slots of a shared memory ring whenever the client rings the doorbell, acknowledging the
+        match hints among them, until the client disconnects
+        """
+        # Nothing more comes over the socket, this only finishes when it's closed. The doorbell is rung to notice.
+        closed = asyncio.ensure_future(reader.read())
+        wake = lambda closed: doorbell.ring()
+        closed.add_done_callback(wake)
+        match_count = 0
+        try:
+            # Whatever the client wrote before it disconnected is still read
+            while not closed.done() or len(ring):
+                if len(ring):
+                    # Still catching up, let the other connections in
+                    await asyncio.sleep(0)
+                else:
+                    await doorbell.wait()
+                try:
+                    hints = decode_slots(ring.read_many(MAX_SHM_READ_HINTS))
+                except ValueError as e:
+                    self._bad_messages.inc()
+                    self._logger.info("Bad slots, ignoring")
+                    self._logger.debug("Slots caused error: %s", e)
+                    continue
+                slot_matches = await self._receive_frame(hints, queue)
+                if slot_matches:
+                    match_count += slot_matches
+                    writer.write(MATCH_ACK.pack(match_count))
+        finally:
+            closed.remove_done_callback(wake)
+            closed.cancel()
+
+    async def _receive_frame(self, hints, queue):
+        """
+        Put the hints of a frame into queue. Returns the number of match hints among them.
+        """
+        self._hints_received.inc(len(hints))
+        now = time.time_ns()
+        frame_matches = 0
+        for hint in hints:
+            if hint.timestamp:
+                self._read_to_receive.record(now - hint.timestamp)
+            await queue.put(hint)
+            if hint.match:
+                frame_matches += 1
+        return frame_matches
+
+class UnixHintReceiver(TCPHintReceiver):
+    """
+    Receives hints on a UNIX socket, from generators on this host, which may also use the shm protocol (see
+    hint_protocol). All its connections get the weight weights gives to 'localhost'.
+    """
+    def __init__(self, lanes, path, weights=None):
+        super().__init__(lanes, None, None, weights)
+        self.path = path
+        self._peer_count = 0
+
+    async def start(self):
+        """
+        Start listening on the socket, replacing any stale one at its path.
+
+        This is an asyncio coroutine
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_client, path=self.path)
+        self._logger.info("Listening on {}".format(self.path))
+
+    def _peer(self, writer):
+        # Peers of UNIX sockets are usually unnamed
+        self._peer_count += 1
+        return f"{self.path}#{self._peer_count}", 'localhost'
+
+    def _attach_ring(self, message):
+        try:
+            name, path = message[len(SHM_HELLO) + 1:].decode().split()
+        except ValueError:
+            self._logger.warning("Bad shm protocol handshake: %s", message)
+            return None
+        try:
+            ring = ShmSlotRing.attach(name, track=False, slot_size=SHM_SLOT.size)
+        except (OSError, ValueError) as e:
+            self._logger.warning("Can't attach to ring %s: %s", name, e)
+            return None
+        try:
+            return ring, Doorbell.open(path)
+        except OSError as e:
+            self._logger.warning("Can't open doorbell %s: %s", path, e)
+            ring.close()
+            return None
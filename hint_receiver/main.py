@@ -1,24 +1,46 @@
 #!/usr/bin/python
+import os
 import asyncio
 import sys
+import time
 import logging
 import argparse
 
-from hint_handler import HintHandler
-from hint_receiver import TCPHintReceiver
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from hint_handler import HintHandler, is_match_hint, INJECT_BATCH_SIZE, INJECT_BATCH_DELAY
+from migration_scheduler import MAX_BLOCKS_PER_SEC
+from block_stats import BLOCK_STATS_TTL
+from placement import HEAT_HALF_LIFE, TierLayout, HeatPlacementPolicy
+from hint_receiver import TCPHintReceiver, UnixHintReceiver
+from load_shedding import SHED_WATERMARK, SHED_SAMPLE_EVERY, LoadShedder
+from hint_queues import STATS_INTERVAL, LANE_SIZE, FairFanIn, FairPriorityLanes, report_queue_delays
+from metrics import histogram, gauge, report_metrics, serve_metrics
 
 DEFAULT_PORT = 1337
 DEFAULT_LISTEN_HOST = '0.0.0.0'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
 
 logger = logging.getLogger('main')
 
-async def consume_hints(hint_queue, handle_hint):
+async def consume_hints(hint_queue, handle_hint, shedder=None):
+    """
+    Pass hints from hint_queue on to handle_hint, dropping those shedder (see LoadShedder) says to
+    """
     logger.info("Consuming from hint queue")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    read_to_handle = histogram('handler.read_to_handle')
     while True:
         try:
             hint = await hint_queue.get()
-            logger.debug("Received hint", hint)
+            if shedder and shedder.should_shed(hint, hint_queue.qsize()):
+                hint_queue.task_done()
+                continue
+            if debug:
+                logger.debug("Received hint %s", hint)
             await handle_hint(hint)
+            if hint.timestamp:
+                read_to_handle.record(time.time_ns() - hint.timestamp)
             hint_queue.task_done()
         except asyncio.CancelledError:
             logger.info('cancelled')
@@ -27,24 +49,137 @@ async def consume_hints(hint_queue, handle_hint):
             logger.exception('Error handling hint, skipping')
             hint_queue.task_done()
 
-async def main():
-    logging.basicConfig(level=logging.DEBUG)
+class DeviceSpec:
+    """
+    A btier device hints are received for, and the port they're received on
+    """
+    def __init__(self, port, data_device, tiers):
+        self.port = port
+        self.data_device = data_device
+        self.tiers = tiers
+        self.name = os.path.basename(data_device)
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parse PORT=DATA_DEVICE[,TIERS], e.g. 1338=/dev/sdtierb,/dev/ram1:/dev/sdc. Without TIERS, placement is left
+        to btier.
+        """
+        try:
+            port, device = spec.split('=', 1)
+            data_device, _, tiers = device.partition(',')
+            return cls(int(port), data_device, tiers)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad device {spec}, should be PORT=DATA_DEVICE[,TIERS]")
+
+def parse_weight(spec):
+    """
+    Parse HOST=WEIGHT
+    """
+    try:
+        host, weight = spec.split('=', 1)
+        return host, int(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad client weight {spec}, should be HOST=WEIGHT")
+
+def create_handler(device, options):
+    placement_policy = None
+    if device.tiers:
+        try:
+            layout = TierLayout.from_devices(device.tiers)
+            placement_policy = HeatPlacementPolicy(layout, half_life=options.heat_half_life)
+            logger.info("Placing blocks of %s by heat on tiers of %s blocks", device.name, layout.capacities)
+        except OSError:
+            logger.exception("Can't get tier sizes of %s, placement is left to btier", device.name)
+    return HintHandler(options.control_device, device.data_device,
+                       inject_batch_size=options.inject_batch_size, inject_batch_delay=options.inject_batch_delay,
+                       max_migrations_per_sec=options.max_migrations_per_sec, block_stats_ttl=options.block_stats_ttl,
+                       placement_policy=placement_policy)
+
+async def serve_device(device, options):
+    """
+    Receive hints for one btier device on its own port (and UNIX socket, with --unix-socket), and handle them with its
+    own HintHandler.
+
+    Every generator connected to the port gets its own bounded lanes, drained in weighted round-robin.
+
+    This is an asyncio coroutine
+    """
+    logger.debug("Creating queues for %s", device.name)
+    # match hints hold a write request in btier, don't let them wait behind advisory hints
+    match_queue = FairFanIn(options.lane_size)
+    advisory_queue = FairFanIn(options.lane_size)
+    shedder = LoadShedder('handler', is_match_hint, options.shed_deadline, options.shed_watermark,
+                          options.shed_sample_every, when_full=not options.no_shed_full)
+    # Unless --no-shed-full, advisory hints that don't fit in their lane are shed, so a connection is never left unread
+    # because of them
+    lanes = FairPriorityLanes(is_match_hint, match_queue, advisory_queue, shedder)
+    logger.debug("Creating receivers for %s", device.name)
+    receivers = [TCPHintReceiver(lanes, options.host, device.port, weights=dict(options.client_weights))]
+    if options.unix_socket:
+        path = options.unix_socket if not options.devices else f"{options.unix_socket}.{device.port}"
+        receivers.append(UnixHintReceiver(lanes, path, weights=dict(options.client_weights)))
+    logger.debug("Creating handler for %s", device.name)
+    handler = create_handler(device, options)
+
+    logger.debug('Starting up receivers for %s', device.name)
+    for receiver in receivers:
+        await receiver.start()
+
+    queues = {f'{device.name}.match': match_queue, f'{device.name}.advisory': advisory_queue}
+    for name, queue in queues.items():
+        gauge(f'queue.{name}.depth', queue.qsize)
+    gauge(f'receiver.{device.name}.connections', lambda: sum(receiver.connections for receiver in receivers))
+    gauge(f'workers.{device.name}.inject.depth', lambda: handler.workers.inject_stats.depth)
+    gauge(f'workers.{device.name}.migration.depth', lambda: handler.workers.migration_stats.depth)
+    gauge(f'migrations.{device.name}.pending', lambda: handler.migration_scheduler.pending_count)
+    await asyncio.gather(consume_hints(match_queue, handler.handle_hint),
+                         consume_hints(advisory_queue, handler.handle_hint, shedder),
+                         report_queue_delays(queues, options.stats_interval),
+                         handler.migration_scheduler.run(),
+                         handler.block_stats.sweep(),
+                         handler.workers.report_stats(options.stats_interval),
+                         handler.migration_scheduler.report_stats(options.stats_interval))
+
+async def main(options):
+    logging.basicConfig(level=options.log_level)
     logger.info("Initializing")
-    logger.debug("Creating queue")
-    queue = asyncio.Queue()
-    logger.debug("Creating receiver")
-    receiver = TCPHintReceiver(queue, DEFAULT_LISTEN_HOST, DEFAULT_PORT)
-    logger.debug("Creating handler")
-    handler = HintHandler()
+    devices = options.devices or [DeviceSpec(options.port, options.data_device, options.tiers)]
+    if options.metrics_socket:
+        await serve_metrics(options.metrics_socket)
+    await asyncio.gather(report_metrics(options.stats_interval),
+                         *[serve_device(device, options) for device in devices])
 
-    logger.debug('Starting up receiver')
-    await receiver.start()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Receive hints and control btier accordingly')
+    parser.add_argument('--host', type=str, default=DEFAULT_LISTEN_HOST, help=f'Address to listen on (default: {DEFAULT_LISTEN_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on for hints for --data-device (default: {DEFAULT_PORT})')
+    parser.add_argument('--unix-socket', type=str, help='Also listen for hints from generators on this host on a UNIX socket at this path, which allows the shm protocol. With --device, every device listens on PATH.PORT')
+    parser.add_argument('--control-device', type=str, default='/dev/tiercontrol', help='btier control device (default: /dev/tiercontrol)')
+    parser.add_argument('--data-device', type=str, default='/dev/sdtiera', help='btier data device (default: /dev/sdtiera)')
+    parser.add_argument('--device', type=DeviceSpec.parse, action='append', dest='devices', metavar='PORT=DATA_DEVICE[,TIERS]', help='Listen on PORT for hints for the btier device DATA_DEVICE, with tier devices TIERS (see --tiers, default: placement is left to btier). Can be given several times, in place of --port, --data-device and --tiers')
+    parser.add_argument('--client-weight', type=parse_weight, action='append', dest='client_weights', default=[], metavar='HOST=WEIGHT', help='Share of hint handling generators on HOST get when generators compete, relative to a default of 1. Can be given several times')
+    parser.add_argument('--lane-size', type=int, default=LANE_SIZE, help=f'Match hints buffered per generator connection before it is read from no more, and advisory hints buffered per connection before more of them are shed (default: {LANE_SIZE})')
+    parser.add_argument('--shed-deadline', type=float, default=0, help='Drop advisory hints older than this many seconds, going by the generator\'s clock, so only if the clocks of the generator and receiver hosts are in sync (default: 0, never drop them for age)')
+    parser.add_argument('--shed-watermark', type=int, default=SHED_WATERMARK, help=f'Once more than this many advisory hints of a device are queued, only handle one in every --shed-sample-every of them. 0 disables this (default: {SHED_WATERMARK})')
+    parser.add_argument('--shed-sample-every', type=int, default=SHED_SAMPLE_EVERY, help=f'See --shed-watermark (default: {SHED_SAMPLE_EVERY})')
+    parser.add_argument('--no-shed-full', action='store_true', help='Stop reading from a generator connection while its advisory lane is full, instead of dropping the advisory hints that do not fit, e.g. when the generator replays a trace')
+    parser.add_argument('--inject-batch-size', type=int, default=INJECT_BATCH_SIZE, help=f'Maximum number of hints to inject to btier together, in one write on the control device. 1 injects every hint right away (default: {INJECT_BATCH_SIZE})')
+    parser.add_argument('--inject-batch-delay', type=float, default=INJECT_BATCH_DELAY, help=f'Maximum seconds a hint waits for its injection batch to fill (default: {INJECT_BATCH_DELAY})')
+    parser.add_argument('--max-migrations-per-sec', type=float, default=MAX_BLOCKS_PER_SEC, help=f'Budget of btier block migrations per second (default: {MAX_BLOCKS_PER_SEC})')
+    parser.add_argument('--block-stats-ttl', type=float, default=BLOCK_STATS_TTL, help=f'Seconds before cached btier block stats are refreshed (default: {BLOCK_STATS_TTL})')
+    parser.add_argument('--tiers', type=str, default='', help='Tier devices of the btier device, fastest first, as given to btier_setup (e.g. /dev/ram0:/dev/sda:/dev/sdb2), to place blocks by heat. Run the generator with --read-hints so reads count too (default: placement is left to btier)')
+    parser.add_argument('--heat-half-life', type=float, default=HEAT_HALF_LIFE, help=f'Seconds for block access heat to decay by half (default: {HEAT_HALF_LIFE})')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL, help=f'Seconds between queue delay, worker, migration and metrics reports (default: {STATS_INTERVAL})')
+    parser.add_argument('--metrics-socket', type=str, help='Serve metrics as json on a UNIX socket at this path')
+    parser.add_argument('--log-level', type=str.upper, default='INFO', choices=LOG_LEVELS, help='Log level. Unless it is DEBUG, nothing is logged per hint (default: INFO)')
 
-    await consume_hints(queue, handler.handle_hint)
+    return parser.parse_args()
 
 if __name__ == '__main__':
+    options = parse_args()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(main(options))
     loop.close()
     #if len(sys.argv) > 1:
     #    btier_hints_file_name = sys.argv[1]
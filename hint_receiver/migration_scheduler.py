@@ -0,0 +1,153 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from hint_queues import STATS_INTERVAL
+
+MAX_BLOCKS_PER_SEC = 100
+MAX_BATCH_BLOCKS = 64
+INFLIGHT_TIMEOUT = 5
+
+class MigrationStats:
+    def __init__(self):
+        self.requested = 0
+        self.merged = 0
+        self.skipped_inflight = 0
+        self.submitted = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def __str__(self):
+        return "migrations: {} requested, {} merged, {} skipped in flight, {} submitted in {} batches, {} dropped".format(
+                self.requested, self.merged, self.skipped_inflight, self.submitted, self.batches, self.dropped)
+
+class MigrationScheduler:
+    """
+    Schedules block migrations on top of TierManager, so request() can be called for every hint without flooding btier.
+
+        * Requests for a block that's already pending are merged, keeping the latest target tier.
+        * Requests to move a block to the tier it's already being migrated to are skipped. btier doesn't report when a
+          migration is done, so a submitted migration counts as in flight for inflight_timeout seconds.
+        * Pending migrations are submitted in batches of up to max_batch_blocks to the migration workers (see
+          BtierWorkers), pausing auto migration once per batch (see TierManager.migrate_many). One batch runs at a time.
+        * A token bucket limits the rate to max_blocks_per_sec. btier migrates whole blocks, so this is also the
+          bandwidth budget, in block size units.
+
+    run() should be running in the background for migrations to happen. on_submit, if given, is called with every
+    submitted batch of (blocknr, dest_tier) pairs.
+    """
+    def __init__(self, tier_manager, workers, max_blocks_per_sec=MAX_BLOCKS_PER_SEC, max_batch_blocks=MAX_BATCH_BLOCKS,
+                 inflight_timeout=INFLIGHT_TIMEOUT, on_submit=None):
+        self._tier_manager = tier_manager
+        self._workers = workers
+        self.on_submit = on_submit
+        self.max_blocks_per_sec = max_blocks_per_sec
+        self.max_batch_blocks = max_batch_blocks
+        self.inflight_timeout = inflight_timeout
+        self.stats = MigrationStats()
+        # blocknr -> dest_tier, in request order
+        self._pending = OrderedDict()
+        # blocknr -> (dest_tier, submit time), in submission order
+        self._inflight = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._logger = logging.getLogger('migration_scheduler')
+
+    def request(self, blocknr, dest_tier):
+        """
+        Ask for blocknr to be migrated to tier number dest_tier
+        """
+        self.stats.requested += 1
+        inflight = self._inflight.get(blocknr)
+        if inflight and inflight[0] == dest_tier and time.monotonic() - inflight[1] < self.inflight_timeout:
+            self.stats.skipped_inflight += 1
+            return
+        if blocknr in self._pending:
+            self.stats.merged += 1
+        self._pending[blocknr] = dest_tier
+        self._wakeup.set()
+
+    @property
+    def pending_count(self):
+        """
+        Number of migrations waiting to be submitted
+        """
+        return len(self._pending)
+
+    def take(self, max_blocks):
+        """
+        Take up to max_blocks pending migrations out, oldest first, as a list of (blocknr, dest_tier) pairs. For
+        carrying out migrations without run(), e.g. in a simulation.
+        """
+        batch_size = min(len(self._pending), max_blocks)
+        return [self._pending.popitem(last=False) for i in range(batch_size)]
+
+    def is_pending(self, blocknr):
+        """
+        Whether blocknr is waiting for migration, or is being migrated (see inflight_timeout)
+        """
+        if blocknr in self._pending:
+            return True
+        inflight = self._inflight.get(blocknr)
+        return inflight is not None and time.monotonic() - inflight[1] < self.inflight_timeout
+
+    async def run(self):
+        """
+        Submit pending migrations, subject to the rate limit.
+
+        This is an asyncio coroutine
+        """
+        tokens = float(self.max_batch_blocks)
+        last_refill = time.monotonic()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                now = time.monotonic()
+                tokens = min(tokens + (now - last_refill) * self.max_blocks_per_sec, self.max_batch_blocks)
+                last_refill = now
+                if tokens < 1:
+                    await asyncio.sleep((1 - tokens) / self.max_blocks_per_sec)
+                    continue
+
+                batch_size = min(len(self._pending), self.max_batch_blocks, int(tokens))
+                batch = [self._pending.popitem(last=False) for i in range(batch_size)]
+                tokens -= batch_size
+                await self._submit(batch)
+
+    async def _submit(self, batch):
+        now = time.monotonic()
+        self._expire_inflight(now)
+        future = self._workers.submit_migration(self._tier_manager.migrate_many, batch)
+        if future is None:
+            self.stats.dropped += len(batch)
+            return
+        for blocknr, dest_tier in batch:
+            self._inflight.pop(blocknr, None)
+            self._inflight[blocknr] = (dest_tier, now)
+        self.stats.submitted += len(batch)
+        self.stats.batches += 1
+        if self.on_submit:
+            self.on_submit(batch)
+        try:
+            await future
+        except Exception:
+            # already logged by the workers
+            pass
+
+    def _expire_inflight(self, now):
+        while self._inflight:
+            blocknr, (dest_tier, submit_time) = next(iter(self._inflight.items()))
+            if now - submit_time < self.inflight_timeout:
+                break
+            del self._inflight[blocknr]
+
+    async def report_stats(self, interval=STATS_INTERVAL):
+        """
+        Periodically log the migration stats
+
+        This is an asyncio coroutine
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self._logger.info("%s, %d pending, %d in flight", self.stats, len(self._pending), len(self._inflight))
@@ -0,0 +1,204 @@
+import os
+import time
+import random
+import logging
+from array import array
+
+from tier_manager import BTIER_BLOCK_SIZE, SECTOR_SIZE
+
+SYSFS_CLASS_BLOCK = '/sys/class/block'
+HEAT_HALF_LIFE = 300
+HEAT_EPOCH = 1.0
+MAX_DECAY_EPOCHS = 4096
+THRESHOLD_SAMPLE_SIZE = 4096
+THRESHOLD_REFRESH_INTERVAL = 10000
+WRITE_WEIGHT = 1.0
+READ_WEIGHT = 1.0
+# Blocks with any heat at all qualify for a tier when the tier has room for all of them
+MIN_PLACEMENT_HEAT = 1e-6
+# The last epoch of blocks that were never recorded
+NEVER = -1
+
+class TierLayout:
+    """
+    Capacities of btier's tiers, in btier blocks, fastest tier first
+    """
+    def __init__(self, capacities):
+        self.capacities = list(capacities)
+
+    @property
+    def block_count(self):
+        return sum(self.capacities)
+
+    @classmethod
+    def from_devices(cls, devices, sysfs_root=SYSFS_CLASS_BLOCK):
+        """
+        Build the layout from the devices the btier device was created with, as given to btier_setup -f
+        (e.g. /dev/ram0:/dev/sda:/dev/sdb2)
+        """
+        capacities = []
+        for device in devices.split(':'):
+            with open("{}/{}/size".format(sysfs_root, os.path.basename(device))) as size:
+                capacities.append(int(size.read()) * SECTOR_SIZE // BTIER_BLOCK_SIZE)
+        return cls(capacities)
+
+class HeatTracker:
+    """
+    Per-block read and write counts, each decaying exponentially with the given half life (in seconds). A block's
+    heat is its reads times read_weight plus its writes times write_weight.
+
+    Counts are kept in arrays sized to the btier device, and are only decayed when a block is touched: each block
+    stores its counts as of the epoch it was last touched in, and the decay since then is looked up in a precomputed
+    table. This keeps record(), counts() and heat() O(1). Blocks that were never touched have no epoch, see seen().
+
+    Time is taken from clock, which returns seconds (default: time.monotonic). A simulation can pass its own.
+    """
+    def __init__(self, block_count, half_life=HEAT_HALF_LIFE, read_weight=READ_WEIGHT, write_weight=WRITE_WEIGHT,
+                 epoch=HEAT_EPOCH, clock=time.monotonic):
+        self.block_count = block_count
+        self.half_life = half_life
+        self.read_weight = read_weight
+        self.write_weight = write_weight
+        self.epoch = epoch
+        self.clock = clock
+        self._reads = array('d', [0]) * block_count
+        self._writes = array('d', [0]) * block_count
+        self._last_epoch = array('l', [NEVER]) * block_count
+        self._start = clock()
+        self._decay = [0.5 ** (epochs * epoch / half_life) for epochs in range(MAX_DECAY_EPOCHS)]
+
+    def current_epoch(self):
+        return int((self.clock() - self._start) / self.epoch)
+
+    def record(self, blocknr, is_write, count=1.0, now_epoch=None):
+        """
+        Add count reads or writes of blocknr
+        """
+        if now_epoch is None:
+            now_epoch = self.current_epoch()
+        decay = self._decay_since(blocknr, now_epoch)
+        reads = self._reads[blocknr] * decay
+        writes = self._writes[blocknr] * decay
+        if is_write:
+            writes += count
+        else:
+            reads += count
+        self._reads[blocknr] = reads
+        self._writes[blocknr] = writes
+        self._last_epoch[blocknr] = now_epoch
+
+    def seen(self, blocknr):
+        """
+        Whether blocknr was ever recorded
+        """
+        return self._last_epoch[blocknr] != NEVER
+
+    def counts(self, blocknr, now_epoch=None):
+        """
+        Current (reads, writes) of blocknr
+        """
+        if now_epoch is None:
+            now_epoch = self.current_epoch()
+        decay = self._decay_since(blocknr, now_epoch)
+        return self._reads[blocknr] * decay, self._writes[blocknr] * decay
+
+    def heat(self, blocknr, now_epoch=None):
+        """
+        Current heat of blocknr
+        """
+        if now_epoch is None:
+            now_epoch = self.current_epoch()
+        return self._heat(blocknr, now_epoch)
+
+    def _heat(self, blocknr, now_epoch):
+        return ((self._reads[blocknr] * self.read_weight + self._writes[blocknr] * self.write_weight) *
+                self._decay_since(blocknr, now_epoch))
+
+    def _decay_since(self, blocknr, now_epoch):
+        elapsed = now_epoch - self._last_epoch[blocknr]
+        if elapsed >= MAX_DECAY_EPOCHS:
+            return 0.0
+        return self._decay[elapsed]
+
+    def sample(self, size, now_epoch=None):
+        """
+        Return the current heat of a uniform random sample of blocks
+        """
+        if now_epoch is None:
+            now_epoch = self.current_epoch()
+        size = min(size, self.block_count)
+        return [self._heat(blocknr, now_epoch) for blocknr in random.sample(range(self.block_count), size)]
+
+class HeatPlacementPolicy:
+    """
+    Places blocks by heat: the hottest blocks go to the fastest tier, up to its capacity, the next ones to the next
+    tier and so on.
+
+    The heat that separates tiers is estimated from a random sample of blocks, refreshed every
+    threshold_refresh_interval accesses, so target_tier() is just a few comparisons.
+
+    Blocks without any heat history, e.g. on their first write, have no target tier, and are left to btier, which
+    allocates them on the fastest tier with room.
+    """
+    def __init__(self, layout, half_life=HEAT_HALF_LIFE, write_weight=WRITE_WEIGHT, read_weight=READ_WEIGHT,
+                 threshold_refresh_interval=THRESHOLD_REFRESH_INTERVAL, sample_size=THRESHOLD_SAMPLE_SIZE,
+                 clock=time.monotonic):
+        self.layout = layout
+        self.tracker = HeatTracker(layout.block_count, half_life, read_weight, write_weight, clock=clock)
+        self.threshold_refresh_interval = threshold_refresh_interval
+        self.sample_size = sample_size
+        # Minimal heat for each tier but the last one
+        self.thresholds = [MIN_PLACEMENT_HEAT] * (len(layout.capacities) - 1)
+        self._accesses = 0
+        self._logger = logging.getLogger('placement')
+
+    def block_of(self, sector):
+        """
+        btier block number of a sector offset, as found in block hints
+        """
+        return sector * SECTOR_SIZE // BTIER_BLOCK_SIZE
+
+    def record(self, sector, size, is_write, count=1.0):
+        """
+        Record count reads or writes of size bytes at the given sector offset
+        """
+        first_block = self.block_of(sector)
+        if size <= 0 or not 0 <= first_block < self.tracker.block_count:
+            return
+        last_block = min((sector * SECTOR_SIZE + size - 1) // BTIER_BLOCK_SIZE, self.tracker.block_count - 1)
+        now_epoch = self.tracker.current_epoch()
+        for blocknr in range(first_block, last_block + 1):
+            self.tracker.record(blocknr, is_write, count, now_epoch)
+
+        self._accesses += 1
+        if self._accesses >= self.threshold_refresh_interval:
+            self._accesses = 0
+            self.refresh_thresholds()
+
+    def target_tier(self, blocknr):
+        """
+        The tier blocknr should be on, according to its current heat. None if it was never accessed.
+        """
+        if not self.tracker.seen(blocknr):
+            return None
+        heat = self.tracker.heat(blocknr)
+        for tier, threshold in enumerate(self.thresholds):
+            if heat >= threshold:
+                return tier
+        return len(self.thresholds)
+
+    def refresh_thresholds(self):
+        """
+        Re-estimate the heat thresholds between tiers
+        """
+        sample = sorted(self.tracker.sample(self.sample_size), reverse=True)
+        block_count = self.layout.block_count
+        thresholds = []
+        rank = 0
+        for capacity in self.layout.capacities[:-1]:
+            rank += capacity
+            index = rank * len(sample) // block_count
+            threshold = sample[index] if index < len(sample) else 0.0
+            thresholds.append(max(threshold, MIN_PLACEMENT_HEAT))
+        self.thresholds = thresholds
+        self._logger.debug("Heat thresholds: %s", thresholds)
@@ -1,53 +1,119 @@
 #!/usr/bin/python
+import os
+import threading
 from collections import namedtuple
 from contextlib import contextmanager
 
 BlockInfo = namedtuple('BlockInfo', ['device', 'offset', 'atime', 'readcount', 'writecount'])
 
+SYSFS_ROOT = '/sys/block'
+# btier moves data between tiers in blocks of this size
+BTIER_BLOCK_SIZE = 1024 * 1024
+SECTOR_SIZE = 512
+BLOCKINFO_READ_SIZE = 256
+
 class TierManager:
     """
     Manage btier's block location manually. Uses the btier sysfs inteface to get block info and manually migrate a block.
+    The sysfs files are opened once and kept open.
+
+    It's safe to use from several threads at once (see BtierWorkers): the open files are shared under a lock, block
+    info queries (a write and a read of the same file) don't interleave, and auto migration stays paused until the
+    last of the concurrent migrate_many() calls is done.
 
     Examples:
     manager = TierManager('/dev/sdtiera')
     block1_info = manager.get_block_info(1)
     print('Block 1 has been read {} times'.format(block1_info.readcount))
-    manager.migrate_block(1, 2)
+    manager.migrate(1, 2)
     print('Block 1 is being migrated to tier number 2')
+    manager.migrate_many([(1, 0), (2, 0)])
+    print('Blocks 1 and 2 are being migrated to tier number 0')
     """
-    def __init__(self, device_name):
+    def __init__(self, device_name, sysfs_root=SYSFS_ROOT):
+        """
+        device_name - the btier device, e.g. /dev/sdtiera or sdtiera
+        sysfs_root - where to look for the device's sysfs directory
+        """
         self.device_name = device_name
+        self.sysfs_root = sysfs_root
+        self._sysfs_files = {}
+        self._files_lock = threading.Lock()
+        self._block_info_lock = threading.Lock()
+        self._pause_lock = threading.Lock()
+        self._pause_count = 0
 
     def migrate(self, blocknr, dest_tier):
         """
         Migrate blocknr to tier number dest_tier. Will re-enable auto migration afterwards.
         Note that the migration process is async, and may fail silently. Currently failure is only reported in dmesg
         """
-        path = self._get_sysfs_path('migrate_block')
-        with self.pause_auto_migration(), open(path, 'w') as migrate_block:
-                migrate_block.write("{}/{}\n".format(blocknr, dest_tier))
+        self.migrate_many([(blocknr, dest_tier)])
+
+    def migrate_many(self, migrations):
+        """
+        Migrate several blocks, given as a list of (blocknr, dest_tier) pairs.
+        Auto migration is paused once for the whole batch and re-enabled afterwards.
+        """
+        migrate_block = self._get_sysfs_file('migrate_block')
+        with self.pause_auto_migration():
+            for blocknr, dest_tier in migrations:
+                os.write(migrate_block, "{}/{}\n".format(blocknr, dest_tier).encode())
 
     def get_block_info(self, blocknr):
         """
         Get btier's statistics about a block.
-        Return type is BlockInfo, which is a namedtuple of the fields from btier
+        Return type is BlockInfo, which is a namedtuple of the fields from btier, parsed as ints
         """
-        path = self._get_sysfs_path('show_blockinfo')
-        with open(path, 'w+') as show_blockinfo:
-            show_blockinfo.write("{}\n".format(blocknr))
-            block_info = show_blockinfo.read()
-        return BlockInfo(*block_info.split(','))
+        show_blockinfo = self._get_sysfs_file('show_blockinfo', os.O_RDWR)
+        with self._block_info_lock:
+            os.write(show_blockinfo, "{}\n".format(blocknr).encode())
+            block_info = os.pread(show_blockinfo, BLOCKINFO_READ_SIZE, 0)
+        return BlockInfo(*(int(field) for field in block_info.split(b',')))
+
+    def get_block_count(self):
+        """
+        Number of btier blocks in the device
+        """
+        with open("{}/{}/size".format(self.sysfs_root, os.path.basename(self.device_name))) as size:
+            sectors = int(size.read())
+        return sectors * SECTOR_SIZE // BTIER_BLOCK_SIZE
 
     @contextmanager
     def pause_auto_migration(self):
         """
-        A context manager that can be used to pause the auto migration of blocks while your code runs and re-enable it afterwards
+        A context manager that can be used to pause the auto migration of blocks while your code runs and re-enable it afterwards.
+        When it's used by several threads at once, auto migration is re-enabled once the last of them is done.
         """
-        path = self._get_sysfs_path('migration_enabled')
-        with open(path, 'w') as migration_enabled:
-            migration_enabled.write("0\n")
+        migration_enabled = self._get_sysfs_file('migration_enabled')
+        with self._pause_lock:
+            if not self._pause_count:
+                os.write(migration_enabled, b"0\n")
+            self._pause_count += 1
+        try:
             yield
-            migration_enabled.write("1\n")
+        finally:
+            with self._pause_lock:
+                self._pause_count -= 1
+                if not self._pause_count:
+                    os.write(migration_enabled, b"1\n")
+
+    def close(self):
+        with self._files_lock:
+            for fd in self._sysfs_files.values():
+                os.close(fd)
+            self._sysfs_files = {}
+
+    def _get_sysfs_file(self, entry, flags=os.O_WRONLY):
+        """
+        Return an fd of a sysfs entry, opening it on first use
+        """
+        with self._files_lock:
+            fd = self._sysfs_files.get(entry)
+            if fd is None:
+                fd = os.open(self._get_sysfs_path(entry), flags)
+                self._sysfs_files[entry] = fd
+            return fd
 
     def _get_sysfs_path(self, entry):
-        return "/sys/block/{}/tier/{}".format(self.device_name, entry)
+        return "{}/{}/tier/{}".format(self.sysfs_root, os.path.basename(self.device_name), entry)
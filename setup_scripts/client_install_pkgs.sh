@@ -7,6 +7,13 @@ echo '*** Installing base packages'
 sudo apt-get update
 sudo apt-get install -y git open-iscsi build-essential blktrace
 
+# The hint generator needs Python 3.9, newer than the distribution's
+echo '*** Installing Python 3.9'
+sudo apt-get install -y software-properties-common
+sudo add-apt-repository -y ppa:deadsnakes/ppa
+sudo apt-get update
+sudo apt-get install -y python3.9
+
 # build and start the file trace modules
 echo '*** Building trace modules'
 cd $REPOSITORY_ROOT/client_traces
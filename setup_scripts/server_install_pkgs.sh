@@ -12,6 +12,13 @@ echo '*** Installing basic packages'
 apt-get update
 apt-get install -y build-essential tgt libsystemd-dev
 
+# The hint receiver needs Python 3.9, newer than the distribution's
+echo '*** Installing Python 3.9'
+apt-get install -y software-properties-common
+add-apt-repository -y ppa:deadsnakes/ppa
+apt-get update
+apt-get install -y python3.9
+
 echo Building btier
 if [ ! -d "$TARGET_REPO_DIR/btier" ]; then 
     git clone http://github.com/hkariti/btier $TARGET_REPO_DIR/btier